@@ -0,0 +1,157 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Deque, Dict, Optional
+
+from .service_exceptions import AgentNotAvailable
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many requests, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    # Caps the turns running in this worker at an adaptive limit (AIMD). Each
+    # turn that finishes within latency_target_seconds while the limit is at
+    # least half used raises it by 1/limit; a slower turn, or one where the
+    # agent was unavailable, multiplies it by backoff_ratio. Requests over the
+    # limit wait in a bounded queue, served round robin across clients so one
+    # client can't fill it, and are rejected straight away when it is full.
+    def __init__(
+        self,
+        initial_limit: int = 20,
+        min_limit: int = 1,
+        max_limit: int = 200,
+        latency_target_seconds: float = 10.0,
+        backoff_ratio: float = 0.9,
+        max_queue: int = 100,
+        max_queue_per_client: int = 10,
+        queue_timeout_seconds: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target_seconds
+        self.backoff_ratio = backoff_ratio
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.queue_timeout = queue_timeout_seconds
+        self.clock = clock
+        self.in_flight = 0
+        self.queued = 0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self.latency_ewma: Optional[float] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.backoffs = 0
+
+    def _capacity(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def retry_after(self) -> int:
+        # Roughly how long until the queue ahead has drained
+        latency = self.latency_ewma or 1.0
+        return max(1, math.ceil(latency * (self.queued / self._capacity() + 1)))
+
+    def _reject(self) -> Overloaded:
+        self.rejected += 1
+        return Overloaded(self.retry_after())
+
+    async def acquire(self, client: str) -> None:
+        if self.in_flight < self._capacity() and not self.queued:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        queue = self._queues.get(client)
+        if self.queued >= self.max_queue or (
+            queue is not None and len(queue) >= self.max_queue_per_client
+        ):
+            raise self._reject()
+        if queue is None:
+            queue = self._queues[client] = deque()
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Granted a slot just as the wait ended, hand it on
+                self.in_flight -= 1
+                self._dispatch()
+            else:
+                self._forget(client, future)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise self._reject()
+        self.admitted += 1
+
+    def _forget(self, client: str, future: asyncio.Future) -> None:
+        queue = self._queues.get(client)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self.queued -= 1
+            if not queue:
+                del self._queues[client]
+
+    def _dispatch(self) -> None:
+        while self._queues and self.in_flight < self._capacity():
+            client, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                # The client goes to the back of the line for its next request
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def release(self, latency: float, failed: bool = False) -> None:
+        used = self.in_flight / self._capacity()
+        self.in_flight -= 1
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += 0.2 * (latency - self.latency_ewma)
+        if failed or latency > self.latency_target:
+            self.backoffs += 1
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        elif used >= 0.5:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, client: str):
+        await self.acquire(client)
+        start = self.clock()
+        failed = False
+        try:
+            yield
+        except AgentNotAvailable:
+            failed = True
+            raise
+        finally:
+            self.release(self.clock() - start, failed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self._capacity(),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queued_clients": len(self._queues),
+            "latency_ewma_seconds": self.latency_ewma,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "backoffs": self.backoffs,
+        }
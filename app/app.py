@@ -1,107 +1,1132 @@
-from fastapi import FastAPI, HTTPException, status
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from starlette.requests import HTTPConnection
 from .sessions import *
-from .models import ChatResponse, ChatRequest
+from .models import ChatResponse, ChatRequest, ChatSocketMessage
 from .insurance_agent import InsuranceAgent
+from .cache import SessionCache
+from .plate_filter import PlateFilter
+from .prompts import Prompt, PromptRegistry
+from .admission import AdmissionController, Overloaded
+from .archive import SessionArchiver
+from .idempotency import IdempotencyStore, SessionLocks
+from .limits import BudgetExhausted, RateLimited, RateLimiter, TokenBudget, TokenUsage
+from .record_writer import RecordWriter
+from .reports import InvalidCursor, RecordFilter, RecordReports
+from .response_parser import ResponseParser
+from .response_cache import MemoryBackend, MongoBackend, ResponseCache
+from .session_writer import SessionWriter
+from .config.config import Config
+from .context import latest_form_state
+from .form_state import FormState, FormTracker
+from .streaming import NextQuestionExtractor, ndjson
+import asyncio
 import dotenv
-import json
-from . import db
+from . import db, limits, metrics
 from .service_exceptions import *
 from pymongo.errors import PyMongoError
-from typing import Optional
+from contextlib import AsyncExitStack, aclosing, asynccontextmanager, nullcontext
+from dataclasses import dataclass, field
+from datetime import datetime
+from pydantic import ValidationError
+from typing import AsyncIterator, List, Literal, Optional, Tuple, Union
+import ipaddress
 import logging
+import os
+import secrets
 
 dotenv.load_dotenv()
 
 insurance_agent = InsuranceAgent()
-app = FastAPI(title="Insurance AI App")
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(chat_request: ChatRequest):
-    global insurance_agent
-    session_id: Optional[str] = None
-    message_history: List[Message] = []
-    duplicate = False
+def build_session_cache(config: Config) -> Optional[SessionCache]:
+    settings = config.session_cache
+    if not settings["enabled"]:
+        return None
+    return SessionCache(
+        max_size=settings["max_size"],
+        ttl_seconds=settings["ttl_seconds"],
+        mode=settings["mode"],
+    )
+
+
+def build_plate_filter(config: Config) -> Optional[PlateFilter]:
+    settings = config.plate_filter
+    if not settings["enabled"]:
+        return None
+    return PlateFilter(capacity=settings["capacity"], error_rate=settings["error_rate"])
+
+
+async def build_response_cache(config: Config) -> Optional[ResponseCache]:
+    settings = config.response_cache
+    if not settings["enabled"]:
+        return None
+    if settings["backend"] == "mongo":
+        backend = MongoBackend(db.llm_responses, ttl_seconds=settings["ttl_seconds"])
+        try:
+            await backend.ensure_indexes()
+        except PyMongoError as e:
+            logging.error(f"Database error while creating response cache index: {e}")
+    else:
+        backend = MemoryBackend(
+            max_size=settings["max_size"], ttl_seconds=settings["ttl_seconds"]
+        )
+    return ResponseCache(
+        backend,
+        bypass_patterns=settings["bypass_patterns"],
+        max_messages=settings["max_messages"],
+    )
+
+
+def build_admission(config: Config) -> Optional[AdmissionController]:
+    settings = config.admission
+    if not settings["enabled"]:
+        return None
+    return AdmissionController(
+        initial_limit=settings["initial_limit"],
+        min_limit=settings["min_limit"],
+        max_limit=settings["max_limit"],
+        latency_target_seconds=settings["latency_target_seconds"],
+        backoff_ratio=settings["backoff_ratio"],
+        max_queue=settings["max_queue"],
+        max_queue_per_client=settings["max_queue_per_client"],
+        queue_timeout_seconds=settings["queue_timeout_seconds"],
+    )
+
+
+def build_form_tracker(config: Config) -> Optional[FormTracker]:
+    settings = config.form_state
+    if not settings["enabled"]:
+        return None
+    return FormTracker(deterministic_completion=settings["deterministic_completion"])
+
+
+def build_token_budget(config: Config) -> Optional[TokenBudget]:
+    settings = config.token_budget
+    if not settings["enabled"]:
+        return None
+    return TokenBudget(session_tokens=settings["session_tokens"])
+
+
+async def build_rate_limiter(config: Config) -> Optional[RateLimiter]:
+    settings = config.rate_limits
+    if not settings["enabled"]:
+        return None
+    if settings["backend"] == "mongo":
+        backend = limits.MongoBackend(db.rate_limits)
+        try:
+            await backend.ensure_indexes()
+        except PyMongoError as e:
+            logging.error(f"Database error while creating rate limit index: {e}")
+    else:
+        backend = limits.MemoryBackend(max_keys=settings["max_keys"])
+    return RateLimiter(
+        backend,
+        client_turns_per_minute=settings["client_turns_per_minute"],
+        client_burst=settings["client_burst"],
+        session_turns_per_minute=settings["session_turns_per_minute"],
+        session_burst=settings["session_burst"],
+    )
+
+
+def build_record_writer(config: Config) -> Optional[RecordWriter]:
+    settings = config.record_writer
+    if not settings["enabled"]:
+        return None
+    return RecordWriter(
+        db.records,
+        db.sessions,
+        max_batch=settings["max_batch"],
+        flush_interval_seconds=settings["flush_interval_seconds"],
+        durability=settings["durability"],
+        max_pending=settings["max_pending"],
+        plate_filter=plate_filter,
+        session_cache=session_cache,
+    )
+
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def build_trusted_proxies(config: Config) -> List[IPNetwork]:
+    return [
+        ipaddress.ip_network(proxy, strict=False)
+        for proxy in config.client_address["trusted_proxies"]
+    ]
+
+
+session_cache = build_session_cache(Config())
+plate_filter = build_plate_filter(Config())
+concurrent_io = Config().pipeline["concurrent_io"]
+session_locks = SessionLocks() if Config().pipeline["session_locks"] else None
+admission = build_admission(Config())
+form_tracker = build_form_tracker(Config())
+token_budget = build_token_budget(Config())
+trusted_proxies = build_trusted_proxies(Config())
+
+
+async def complete_fields(history, partial, missing, usage=None):
+    return await insurance_agent.complete_fields(history, partial, missing, usage)
+
+
+response_parser = ResponseParser(
+    complete_fields if Config().response_parser["reprompt"] else None
+)
+# Bound in the lifespan, once the collections exist
+record_writer: Optional[RecordWriter] = None
+idempotency_store: Optional[IdempotencyStore] = None
+session_archiver: Optional[SessionArchiver] = None
+record_reports: Optional[RecordReports] = None
+rate_limiter: Optional[RateLimiter] = None
+metrics.configure(Config().metrics)
+prompt_registry = PromptRegistry(
+    Config().system_prompt, retain=Config().hot_reload["retain_prompts"]
+)
+# What /ready waits for, set by the warm-up tasks started in the lifespan
+readiness = {"database": False, "agent": False}
+
+
+async def warm_up_database():
+    readiness["database"] = await db.warm_up()
+
+
+async def warm_up_agent():
     try:
-        if chat_request.session_id:
-            session_id, history = await get_or_create_session(
-                sessions=db.sessions, session_id=chat_request.session_id
-            )
-        else:
-            session_id, history = await get_or_create_session(sessions=db.sessions)
+        await insurance_agent.warm_up()
+    except Exception as e:
+        logging.error(f"Agent warm-up failed: {e}")
+        return
+    readiness["agent"] = True
+
+
+async def reload_config() -> bool:
+    # Applies a changed config.yaml: model, routing and context settings take
+    # effect for the next model call, the system prompt for sessions started
+    # from now on. The other sections are only read at startup. The router is
+    # built and the prompt saved before anything is swapped, so if either
+    # fails the running configuration stays whole and the next check retries.
+    config = Config()
+    pending = config.changed()
+    if pending is None:
+        return False
+    router = insurance_agent.build_router(pending)
+    prompt = await prompt_registry.publish(pending.system_prompt)
+    config.apply(pending)
+    insurance_agent.reload(router)
+    logging.info(f"Reloaded configuration {config.version}, prompt {prompt.version}")
+    return True
 
-        message_history = [Message.model_validate(h) for h in history]
-        message_history.append(Message(role="user", content=chat_request.message))
+
+async def watch_config(interval_seconds: float) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
         try:
-            agent_response = await insurance_agent.respond(history=message_history)
-        except AgentNotAvailable as e:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="AI Agent is temporarily unavailable",
-            )
+            await reload_config()
+        except Exception as e:
+            logging.error(f"Error reloading configuration: {e}")
 
-        if not agent_response:
-            return ChatResponse(
-                session_id=session_id,
-                agent_response="The Agent is unavailable at the moment",
-                complete=False,
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global record_writer, idempotency_store, session_archiver, record_reports
+    global rate_limiter
+    db.connect()
+    background = [asyncio.create_task(warm_up_database())]
+    if Config().startup["warm_up_agent"]:
+        background.append(asyncio.create_task(warm_up_agent()))
+    else:
+        readiness["agent"] = True
+    prompt_registry.prompts = db.prompts
+    # Records only refer to the prompt by version, the text is stored once
+    background.append(
+        asyncio.create_task(prompt_registry.save(prompt_registry.current))
+    )
+    if Config().hot_reload["enabled"]:
+        background.append(
+            asyncio.create_task(watch_config(Config().hot_reload["interval_seconds"]))
+        )
+    lifecycle = Config().session_lifecycle
+    await db.ensure_indexes(session_ttl_seconds=lifecycle["expire_after_seconds"])
+    insurance_agent.response_cache = await build_response_cache(Config())
+    rate_limiter = await build_rate_limiter(Config())
+    record_writer = build_record_writer(Config())
+    if record_writer is not None:
+        record_writer.start()
+    settings = Config().idempotency
+    if settings["enabled"]:
+        idempotency_store = IdempotencyStore(
+            db.chat_responses, ttl_seconds=settings["ttl_seconds"]
+        )
+        background.append(asyncio.create_task(idempotency_store.ensure_indexes()))
+    if Config().reporting["enabled"]:
+        record_reports = RecordReports(
+            db.records, read_preference=Config().reporting["read_preference"]
+        )
+    if lifecycle["archive_enabled"]:
+        session_archiver = SessionArchiver(
+            db.sessions,
+            db.sessions_archive,
+            archive_after_seconds=lifecycle["archive_after_seconds"],
+            batch_size=lifecycle["batch_size"],
+        )
+        background.append(
+            asyncio.create_task(session_archiver.run(lifecycle["interval_seconds"]))
+        )
+    if plate_filter is not None:
+        # Warmed in the background, duplicate checks go to MongoDB until ready
+        background.append(
+            asyncio.create_task(
+                plate_filter.run(
+                    db.records, Config().plate_filter["sync_interval_seconds"]
+                )
             )
-        try:
-            message_history.append(Message(role="assistant", content=agent_response))
-            agent_response_dict = json.loads(agent_response)
-        except json.JSONDecodeError:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Error processing agent response",
+        )
+    yield
+    if record_writer is not None:
+        # Flushes queued records while the database is still connected
+        await record_writer.close()
+        record_writer = None
+    idempotency_store = None
+    session_archiver = None
+    record_reports = None
+    rate_limiter = None
+    readiness.update(database=False, agent=False)
+    prompt_registry.prompts = None
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    if plate_filter is not None:
+        plate_filter.reset()
+    db.close()
+    metrics.mark_process_dead()
+
+
+app = FastAPI(title="Insurance AI App", lifespan=lifespan)
+
+
+@dataclass
+class ChatTurn:
+    session_id: str
+    turn: int
+    message_history: List[Message]
+    history_length: int
+    # The system prompt the session started with
+    prompt: Prompt
+    form_state: Optional[FormState] = None
+    # Set when the customer's answer completed the form, in place of a reply
+    # from the model
+    form_reply: Optional[str] = None
+    # Duplicate lookup for the plate the customer already gave, started
+    # before the model call so the two overlap
+    prefetched_plate: Optional[str] = None
+    prefetch: Optional[asyncio.Task] = None
+    # Set for turns over /chat/ws, whose messages are written behind
+    writer: Optional[SessionWriter] = None
+    # Tokens of the turn's model calls, added to the session with its messages
+    usage: TokenUsage = field(default_factory=TokenUsage)
+    tokens_written: int = 0
+
+    @property
+    def new_messages(self) -> List[Message]:
+        return self.message_history[self.history_length :]
+
+    @property
+    def form_values(self) -> Optional[dict]:
+        return None if self.form_state is None else self.form_state.values()
+
+    def take_tokens(self) -> int:
+        tokens = self.usage.total - self.tokens_written
+        self.tokens_written = self.usage.total
+        return tokens
+
+    def discard_prefetch(self) -> None:
+        if self.prefetch is None:
+            return
+        if not self.prefetch.done():
+            self.prefetch.cancel()
+        elif not self.prefetch.cancelled():
+            # Retrieved so an unused failed lookup isn't logged as unhandled
+            self.prefetch.exception()
+
+
+async def lookup_duplicate(licence_plate_number: str) -> bool:
+    with metrics.stage("detect_duplicate"):
+        return await detect_duplicate(
+            db.records, licence_plate_number, plate_filter=plate_filter
+        )
+
+
+async def check_duplicate(chat_turn: ChatTurn, licence_plate_number: str) -> bool:
+    if chat_turn.prefetch is not None and normalize_plate(
+        licence_plate_number
+    ) == normalize_plate(chat_turn.prefetched_plate):
+        return await chat_turn.prefetch
+    return await lookup_duplicate(licence_plate_number)
+
+
+async def store_record(chat_turn: ChatTurn, licence_plate_number: str, data) -> bool:
+    data["session_id"] = chat_turn.session_id
+    if record_writer is not None:
+        # Duplicates found when the queue is flushed are reported on the session
+        await record_writer.submit(
+            chat_turn.session_id,
+            licence_plate_number,
+            data,
+            prompt_version=chat_turn.prompt.version,
+        )
+        return True
+    with metrics.stage("save_record"):
+        return await save_record(
+            db.records,
+            licence_plate_number,
+            data,
+            prompt_version=chat_turn.prompt.version,
+            plate_filter=plate_filter,
+        )
+
+
+async def store_messages(
+    chat_turn: ChatTurn,
+    turn: int,
+    messages: List[Message],
+    status: str = SESSION_OPEN,
+) -> int:
+    form_updates = None
+    if chat_turn.form_state is not None:
+        form_updates = chat_turn.form_state.take_updates()
+    tokens = chat_turn.take_tokens()
+    try:
+        if chat_turn.writer is not None:
+            # The writer keeps track of the turn itself
+            return await chat_turn.writer.append(messages, status, form_updates, tokens)
+        with metrics.stage("update_session"):
+            return await append_session_messages(
+                db.sessions,
+                session_id=chat_turn.session_id,
+                messages=messages,
+                turn=turn,
+                cache=session_cache,
+                status=status,
+                form_updates=form_updates,
+                tokens=tokens,
             )
-        licence_plate_number = agent_response_dict.get("licence_plate_number")
-        complete = False
-        reply = None
-
-        if licence_plate_number:
-            duplicate = await detect_duplicate(db.records, licence_plate_number)
-            if duplicate:
-                reply = f"There is already a record for licence plate {licence_plate_number}. Please check if you entered the correct details."
-                message_history.append(Message(role="assistant", content=reply))
-                complete = False
-
-        if agent_response_dict.get("complete"):
-            data = agent_response_dict
-            plate = agent_response_dict.get("licence_plate_number")
-            data["session_id"] = session_id
-
-            await save_record(
-                db.records, plate, data, prompt=insurance_agent.system_prompt
+    except Exception:
+        # Left for store_unwritten_tokens
+        chat_turn.tokens_written -= tokens
+        raise
+
+
+async def store_unwritten_tokens(chat_turn: ChatTurn) -> None:
+    # A turn that failed after calling the model still spent its tokens, or a
+    # session that keeps failing would never use up its budget
+    tokens = chat_turn.take_tokens()
+    if not tokens:
+        return
+    try:
+        await add_session_tokens(
+            db.sessions, chat_turn.session_id, tokens, session_cache
+        )
+    except PyMongoError:
+        # Logged already, and the turn's own error is the one to report
+        pass
+
+
+async def complete_writes(
+    chat_turn: ChatTurn, licence_plate_number: str, data
+) -> Tuple[bool, int]:
+    # Saves the record and appends the completing turn at once. A session
+    # written as complete without a record would be archived with its form
+    # lost, so when the record fails the turn is taken back.
+    saved, turn = await asyncio.gather(
+        store_record(chat_turn, licence_plate_number, data),
+        store_messages(
+            chat_turn, chat_turn.turn, chat_turn.new_messages, status=SESSION_COMPLETE
+        ),
+        return_exceptions=True,
+    )
+    if isinstance(saved, BaseException):
+        if not isinstance(turn, BaseException):
+            try:
+                await reopen_session(
+                    db.sessions,
+                    chat_turn.session_id,
+                    turn,
+                    chat_turn.history_length,
+                    session_cache,
+                )
+            except Exception as e:
+                logging.error(
+                    f"Could not reopen session {chat_turn.session_id} "
+                    f"after its record failed: {e}"
+                )
+        raise saved
+    if isinstance(turn, BaseException):
+        raise turn
+    return saved, turn
+
+
+COMPLETE_REPLY = "Thank you for providing all the necessary information. Here is your insurance quota..."
+
+
+async def load_session(
+    session_id: Optional[str],
+) -> Tuple[str, SessionHistory, Prompt]:
+    with metrics.stage("get_or_create_session"):
+        if session_id:
+            session_id, history = await get_or_create_session(
+                sessions=db.sessions,
+                session_id=session_id,
+                cache=session_cache,
+                prompt_version=prompt_registry.current.version,
             )
-            reply = "Thank you for providing all the necessary information. Here is your insurance quota..."
-            complete = True
         else:
-            if not duplicate:
-                reply = agent_response_dict.get("next_question")
-            if not reply:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="Invalid agent response format",
-                )
+            session_id, history = await get_or_create_session(
+                sessions=db.sessions,
+                cache=session_cache,
+                prompt_version=prompt_registry.current.version,
+            )
+        prompt = await prompt_registry.get(history.prompt_version)
+    return session_id, history, prompt
 
-        await update_session(
-            db.sessions, session_id=session_id, history=message_history
+
+async def start_turn(chat_request: ChatRequest) -> ChatTurn:
+    session_id, history, prompt = await load_session(chat_request.session_id)
+    return begin_turn(session_id, history, prompt, chat_request.message)
+
+
+def begin_turn(
+    session_id: str,
+    history: SessionHistory,
+    prompt: Prompt,
+    message: str,
+    form_state: Optional[FormState] = None,
+) -> ChatTurn:
+    # Validated by get_or_create_session, appended to in place from here on
+    message_history = history
+    chat_turn = ChatTurn(
+        session_id=session_id,
+        turn=history.turn,
+        message_history=message_history,
+        history_length=len(message_history),
+        prompt=prompt,
+    )
+    message_history.append(Message(role="user", content=message))
+    if form_tracker is not None:
+        if form_state is None:
+            form_state = FormState.load(history.form_state, message_history)
+        chat_turn.form_state = form_state
+        chat_turn.form_reply = form_tracker.read_answer(
+            chat_turn.form_state, message_history, chat_turn.turn
         )
+    if concurrent_io:
+        known = chat_turn.form_values
+        if known is None:
+            known = latest_form_state(message_history)
+        known_plate = known.get("licence_plate_number")
+        if known_plate:
+            chat_turn.prefetched_plate = known_plate
+            chat_turn.prefetch = asyncio.create_task(lookup_duplicate(known_plate))
+    return chat_turn
+
+
+async def finish_turn(chat_turn: ChatTurn, agent_response: str | None) -> ChatResponse:
+    session_id = chat_turn.session_id
+    message_history = chat_turn.message_history
+    duplicate = False
 
+    if not agent_response:
         return ChatResponse(
-            session_id=session_id, agent_response=reply, complete=complete
+            session_id=session_id,
+            agent_response="The Agent is unavailable at the moment",
+            complete=False,
         )
+    with metrics.stage("parse_response"):
+        parsed = await response_parser.parse(
+            agent_response,
+            message_history,
+            chat_turn.usage,
+            lambda: check_budget(chat_turn),
+        )
+    licence_plate_number = parsed.data.get("licence_plate_number")
+    complete = False
+    reply = None
 
-    except PyMongoError:
-        raise HTTPException(
+    if licence_plate_number:
+        duplicate = await check_duplicate(chat_turn, licence_plate_number)
+    if not (parsed.data.get("complete") or duplicate):
+        # Only a turn that goes on needs the next question
+        with metrics.stage("parse_response"):
+            parsed = await response_parser.require(
+                parsed,
+                ["next_question"],
+                message_history,
+                chat_turn.usage,
+                lambda: check_budget(chat_turn),
+            )
+    message_history.append(Message(role="assistant", content=parsed.content))
+    agent_response_dict = parsed.data
+    if chat_turn.form_state is not None:
+        form_tracker.record_reply(
+            chat_turn.form_state, parsed.data, chat_turn.turn, message_history
+        )
+        if duplicate:
+            chat_turn.form_state.discard("licence_plate_number")
+
+    if agent_response_dict.get("complete") and not duplicate:
+        # Write-behind appends can't be taken back, so those wait for the record
+        if concurrent_io and chat_turn.writer is None:
+            # The record and the session are separate documents, so both are
+            # written at once. If the unique index rejects the record, the
+            # duplicate notice follows in a second append.
+            complete, turn = await complete_writes(
+                chat_turn, licence_plate_number, agent_response_dict
+            )
+            if complete:
+                reply = COMPLETE_REPLY
+            else:
+                reply = duplicate_reply(licence_plate_number)
+                if chat_turn.form_state is not None:
+                    chat_turn.form_state.discard("licence_plate_number")
+                await store_messages(
+                    chat_turn, turn, [Message(role="assistant", content=reply)]
+                )
+            return ChatResponse(
+                session_id=session_id, agent_response=reply, complete=complete
+            )
+
+        complete = await store_record(
+            chat_turn, licence_plate_number, agent_response_dict
+        )
+        duplicate = not complete
+        if complete:
+            reply = COMPLETE_REPLY
+        elif chat_turn.form_state is not None:
+            chat_turn.form_state.discard("licence_plate_number")
+
+    if duplicate:
+        reply = duplicate_reply(licence_plate_number)
+        message_history.append(Message(role="assistant", content=reply))
+    elif not complete:
+        reply = agent_response_dict["next_question"]
+
+    await store_messages(
+        chat_turn,
+        chat_turn.turn,
+        chat_turn.new_messages,
+        status=SESSION_COMPLETE if complete else SESSION_OPEN,
+    )
+
+    return ChatResponse(session_id=session_id, agent_response=reply, complete=complete)
+
+
+def http_error(e: Exception) -> HTTPException:
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, Overloaded):
+        metrics.record_error("overloaded")
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    if isinstance(e, RateLimited):
+        metrics.record_error("rate_limited")
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    if isinstance(e, BudgetExhausted):
+        metrics.record_error("token_budget")
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="This session has used up its token budget",
+        )
+    if isinstance(e, AgentNotAvailable):
+        metrics.record_error("agent_not_available")
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="AI Agent is temporarily unavailable",
+        )
+    if isinstance(e, MalformedAgentResponse):
+        metrics.record_error("json_decode")
+        return HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Error processing agent response",
+        )
+    if isinstance(e, InvalidAgentResponse):
+        metrics.record_error("invalid_response")
+        return HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Invalid agent response format",
+        )
+    if isinstance(e, IdempotencyKeyReused):
+        metrics.record_error("idempotency_key_reused")
+        return HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency key was already used for a different request",
+        )
+    if isinstance(e, SessionConflict):
+        metrics.record_error("session_conflict")
+        return HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Session was updated by another request, please retry",
+        )
+    if isinstance(e, PyMongoError):
+        metrics.record_error("database")
+        return HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Database service is temporarily unavailable",
         )
-    except HTTPException:
+    logging.error(f"Unexpected error in chat endpoint: {e}")
+    metrics.record_error("unexpected")
+    return HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail="An unexpected error occurred",
+    )
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    # Readiness probe: a worker that is still importing litellm or has not
+    # reached MongoDB yet would make the first chat turns slow or fail
+    if not readiness["database"]:
+        readiness["database"] = await db.warm_up()
+    if not all(readiness.values()):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"ready": all(readiness.values()), **readiness}
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "session_cache": session_cache.stats() if session_cache else None,
+        "plate_filter": plate_filter.stats() if plate_filter else None,
+        "response_cache": (
+            insurance_agent.response_cache.stats()
+            if insurance_agent.response_cache
+            else None
+        ),
+        "record_writer": record_writer.stats() if record_writer else None,
+        "llm_router": insurance_agent.router.stats(),
+        "session_locks": session_locks.stats() if session_locks else None,
+        "admission": admission.stats() if admission else None,
+        "response_parser": response_parser.stats(),
+        "form_state": form_tracker.stats() if form_tracker else None,
+        "rate_limits": rate_limiter.stats() if rate_limiter else None,
+        "token_budget": token_budget.stats() if token_budget else None,
+        "idempotency": idempotency_store.stats() if idempotency_store else None,
+        "session_archive": session_archiver.stats() if session_archiver else None,
+        "prompts": prompt_registry.stats(),
+        "db_pool": db.pool_stats.stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    if not metrics.enabled:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
+def reports() -> RecordReports:
+    if record_reports is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return record_reports
+
+
+def require_ops_token(x_ops_token: Optional[str] = Header(default=None)) -> None:
+    # Reports return customers' personal data, so they are for operators
+    # only; without OPS_TOKEN set nobody gets them
+    expected = os.getenv("OPS_TOKEN")
+    if not expected or not x_ops_token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+    if not secrets.compare_digest(x_ops_token.encode(), expected.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+
+
+@app.get("/reports/records", dependencies=[Depends(require_ops_token)])
+async def report_records(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    car_type: Optional[str] = None,
+    brand: Optional[str] = None,
+    limit: int = Query(default=100, ge=1),
+    cursor: Optional[str] = None,
+):
+    limit = min(limit, Config().reporting["max_page_size"])
+    filters = RecordFilter(start=start, end=end, car_type=car_type, brand=brand)
+    try:
+        records, next_cursor = await reports().page(filters, limit, cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except PyMongoError as e:
+        raise http_error(e)
+    for record in records:
+        record["_id"] = str(record["_id"])
+    return {"records": records, "next_cursor": next_cursor}
+
+
+@app.get("/reports/counts", dependencies=[Depends(require_ops_token)])
+async def report_counts(
+    by: Literal["car_type", "brand", "day"],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    car_type: Optional[str] = None,
+    brand: Optional[str] = None,
+):
+    filters = RecordFilter(start=start, end=end, car_type=car_type, brand=brand)
+    try:
+        return {"counts": await reports().counts(filters, by)}
+    except PyMongoError as e:
+        raise http_error(e)
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(
+    request: Request,
+    chat_request: ChatRequest,
+    idempotency_key: Optional[str] = Header(default=None, max_length=256),
+):
+    key = idempotency_key or chat_request.idempotency_key
+    client = client_id(request)
+    body = IdempotencyStore.fingerprint(
+        chat_request.model_dump(exclude={"idempotency_key"})
+    )
+    lock_id = chat_request.session_id or (f"key:{client}:{key}" if key else None)
+    if session_locks is None or lock_id is None:
+        return await chat_turn_once(chat_request, key, client, body)
+    # Retries carry the same key and body; double submits without a key the
+    # same message
+    fingerprint = ("key", key, body) if key else ("message", chat_request.message)
+    return await session_locks.run(
+        lock_id, fingerprint, lambda: chat_turn_once(chat_request, key, client, body)
+    )
+
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in trusted_proxies)
+
+
+def client_id(connection: HTTPConnection) -> str:
+    # Fair queueing and rate limits are per caller address, for requests and
+    # sockets alike. Behind a trusted proxy that is the nearest X-Forwarded-For
+    # address not itself a trusted proxy; anyone else could put any address in
+    # the header.
+    host = connection.client.host if connection.client else "unknown"
+    if not is_trusted_proxy(host):
+        return host
+    forwarded = connection.headers.get("x-forwarded-for", "").split(",")
+    for address in reversed([a.strip() for a in forwarded if a.strip()]):
+        if not is_trusted_proxy(address):
+            return address
+        host = address
+    return host
+
+
+async def limit_rate(client: str, session_id: Optional[str]) -> None:
+    if rate_limiter is not None:
+        await rate_limiter.check(client, session_id)
+
+
+def check_budget(chat_turn: ChatTurn) -> None:
+    # Before every model call, follow-ups included, counting the calls this
+    # turn has made already; a turn finished from the form state needs none
+    if token_budget is not None:
+        token_budget.check(
+            chat_turn.session_id,
+            chat_turn.message_history.tokens_used + chat_turn.usage.total,
+        )
+
+
+def admitted(client: str):
+    # client comes from client_id, the same key the rate limiter uses
+    if admission is None:
+        return nullcontext()
+    return admission.slot(client)
+
+
+async def chat_turn_once(
+    chat_request: ChatRequest, key: Optional[str], client: str, body: str
+) -> ChatResponse:
+    # body is the fingerprint of the request a stored response must match
+    chat_turn = None
+    try:
+        with metrics.stage("request"):
+            if key and idempotency_store is not None:
+                stored = await idempotency_store.get(
+                    chat_request.session_id, key, client, body
+                )
+                if stored is not None:
+                    return ChatResponse(**stored)
+            await limit_rate(client, chat_request.session_id)
+            async with admitted(client):
+                chat_turn = await start_turn(chat_request)
+                if chat_turn.form_reply is not None:
+                    agent_response = chat_turn.form_reply
+                else:
+                    check_budget(chat_turn)
+                    with metrics.stage("respond"):
+                        agent_response = await insurance_agent.respond(
+                            history=chat_turn.message_history,
+                            system_prompt=chat_turn.prompt.text,
+                            form_state=chat_turn.form_values,
+                            usage=chat_turn.usage,
+                        )
+                response = await finish_turn(chat_turn, agent_response)
+            if key and idempotency_store is not None:
+                await idempotency_store.put(
+                    chat_request.session_id, key, client, body, response.model_dump()
+                )
+            return response
+    except Exception as e:
+        raise http_error(e)
+    finally:
+        if chat_turn is not None:
+            chat_turn.discard_prefetch()
+            await store_unwritten_tokens(chat_turn)
+
+
+async def single_delta(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+async def open_reply(chat_turn: ChatTurn) -> AsyncIterator[str]:
+    if chat_turn.form_reply is not None:
+        return single_delta(chat_turn.form_reply)
+    check_budget(chat_turn)
+    return await insurance_agent.respond_stream(
+        history=chat_turn.message_history,
+        system_prompt=chat_turn.prompt.text,
+        form_state=chat_turn.form_values,
+        usage=chat_turn.usage,
+    )
+
+
+async def turn_events(
+    chat_turn: ChatTurn, deltas: AsyncIterator[str]
+) -> AsyncIterator[dict]:
+    # The events of one streamed turn, shared by /chat/stream and /chat/ws
+    extractor = NextQuestionExtractor()
+    async with aclosing(deltas):
+        with metrics.stage("respond_stream"):
+            async for delta in deltas:
+                text = extractor.feed(delta)
+                if text:
+                    yield {"event": "delta", "text": text}
+    response = await finish_turn(chat_turn, extractor.text)
+    yield {"event": "done", **response.model_dump()}
+
+
+def error_event(e: Exception) -> dict:
+    error = http_error(e)
+    return {"event": "error", "status": error.status_code, "detail": error.detail}
+
+
+async def stream_turn(
+    chat_turn: ChatTurn, deltas: AsyncIterator[str]
+) -> AsyncIterator[bytes]:
+    yield ndjson({"event": "session", "session_id": chat_turn.session_id})
+    try:
+        async with aclosing(turn_events(chat_turn, deltas)) as events:
+            async for event in events:
+                yield ndjson(event)
+    except Exception as e:
+        yield ndjson(error_event(e))
+
+
+class TurnStream(StreamingResponse):
+    # Holds the turn's admission slot until the response is over. The slot is
+    # released here rather than in the body generator, which never runs when
+    # sending fails before the body starts (e.g. the client already left).
+    def __init__(
+        self, chat_turn: ChatTurn, deltas: AsyncIterator[str], slot: AsyncExitStack
+    ):
+        super().__init__(
+            stream_turn(chat_turn, deltas), media_type="application/x-ndjson"
+        )
+        self.chat_turn = chat_turn
+        self.deltas = deltas
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.chat_turn.discard_prefetch()
+            try:
+                await self.deltas.aclose()
+                await store_unwritten_tokens(self.chat_turn)
+            finally:
+                await self.slot.aclose()
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: Request, chat_request: ChatRequest):
+    # Errors before the first token still map to a plain HTTP status; once the
+    # stream has started they are reported as a final "error" event instead.
+    chat_turn = None
+    # The admission slot is held until the stream is finished
+    slot = AsyncExitStack()
+    try:
+        client = client_id(request)
+        await limit_rate(client, chat_request.session_id)
+        await slot.enter_async_context(admitted(client))
+        chat_turn = await start_turn(chat_request)
+        deltas = await open_reply(chat_turn)
+    except Exception as e:
+        if chat_turn is not None:
+            chat_turn.discard_prefetch()
+            await store_unwritten_tokens(chat_turn)
+        await slot.__aexit__(type(e), e, e.__traceback__)
+        raise http_error(e)
+    return TurnStream(chat_turn, deltas, slot)
+
+
+class ChatConnection:
+    # The session bound to one /chat/ws connection. Its history, prompt and
+    # form state are loaded once and kept up to date in memory by each turn;
+    # the messages are written behind by a SessionWriter. A turn that doesn't
+    # get its messages written (the agent failed, a write was refused) leaves
+    # the in-memory state ahead of the database, so it is loaded again.
+    def __init__(self, session_id: Optional[str], max_pending_writes: int):
+        self.session_id = session_id
+        self.max_pending_writes = max_pending_writes
+        self.history: Optional[SessionHistory] = None
+        self.prompt: Optional[Prompt] = None
+        self.form_state: Optional[FormState] = None
+        self.writer: Optional[SessionWriter] = None
+
+    async def load(self) -> None:
+        self.session_id, self.history, self.prompt = await load_session(self.session_id)
+        self.form_state = None
+        if form_tracker is not None:
+            self.form_state = FormState.load(self.history.form_state, self.history)
+        self.writer = SessionWriter(
+            db.sessions,
+            self.session_id,
+            self.history.turn,
+            cache=session_cache,
+            max_pending=self.max_pending_writes,
+        )
+        self.writer.start()
+
+    async def reload(self) -> None:
+        await self.close()
+        await self.load()
+
+    async def close(self) -> None:
+        if self.writer is None:
+            return
+        try:
+            await self.writer.close()
+        except Exception as e:
+            # Already reported to the client on the turn it failed
+            logging.warning(f"Unwritten turns on session {self.session_id}: {e}")
+        self.writer = None
+
+    def begin_turn(self, message: str) -> ChatTurn:
+        chat_turn = begin_turn(
+            self.session_id, self.history, self.prompt, message, self.form_state
+        )
+        chat_turn.writer = self.writer
+        return chat_turn
+
+    def finished(self, chat_turn: ChatTurn) -> bool:
+        if self.writer.error is not None or self.writer.turn == chat_turn.turn:
+            return False
+        self.history.turn = self.writer.turn
+        self.history.tokens_used += chat_turn.usage.total
+        return True
+
+
+async def socket_turn(
+    websocket: WebSocket, connection: ChatConnection, message: str, client: str
+) -> bool:
+    # Same events as /chat/stream. Sends wait while the client is slow to
+    # read, and the next message isn't read before the turn is finished.
+    chat_turn = None
+    try:
+        await limit_rate(client, connection.session_id)
+        async with admitted(client):
+            chat_turn = connection.begin_turn(message)
+            deltas = await open_reply(chat_turn)
+            async with aclosing(turn_events(chat_turn, deltas)) as events:
+                async for event in events:
+                    await websocket.send_json(event)
+    except WebSocketDisconnect:
         raise
     except Exception as e:
-        logging.error(f"Unexpected error in chat endpoint: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="An unexpected error occurred",
+        await websocket.send_json(error_event(e))
+    finally:
+        if chat_turn is not None:
+            chat_turn.discard_prefetch()
+            await store_unwritten_tokens(chat_turn)
+    return chat_turn is None or connection.finished(chat_turn)
+
+
+async def load_connection(websocket: WebSocket, load) -> bool:
+    try:
+        await load()
+    except Exception as e:
+        await websocket.send_json(error_event(e))
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        return False
+    return True
+
+
+@app.websocket("/chat/ws")
+async def chat_socket(websocket: WebSocket, session_id: Optional[str] = None):
+    # One session per connection: the client sends {"message": ...} and gets
+    # the same events as /chat/stream, without sending the session id again
+    settings = Config().websocket
+    await websocket.accept()
+    client = client_id(websocket)
+    connection = ChatConnection(session_id, settings["max_pending_writes"])
+    try:
+        if not await load_connection(websocket, connection.load):
+            return
+        await websocket.send_json(
+            {"event": "session", "session_id": connection.session_id}
         )
+        while True:
+            try:
+                text = await asyncio.wait_for(
+                    websocket.receive_text(), settings["idle_timeout_seconds"]
+                )
+            except asyncio.TimeoutError:
+                await websocket.close()
+                return
+            try:
+                chat_message = ChatSocketMessage.model_validate_json(text)
+            except ValidationError as e:
+                detail = e.errors(include_url=False, include_context=False)
+                await websocket.send_json(
+                    {"event": "error", "status": 422, "detail": detail}
+                )
+                continue
+            finished = await socket_turn(
+                websocket, connection, chat_message.message, client
+            )
+            if not finished and not await load_connection(websocket, connection.reload):
+                return
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await connection.close()
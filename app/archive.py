@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import Binary
+
+from .sessions import SESSION_COMPLETE, SESSION_OPEN
+
+
+def compress_history(history: List[Dict[str, Any]]) -> Binary:
+    return Binary(zlib.compress(json.dumps(history, default=str).encode()))
+
+
+def decompress_history(blob: bytes) -> List[Dict[str, Any]]:
+    return json.loads(zlib.decompress(blob))
+
+
+class SessionArchiver:
+    # Moves completed sessions out of the sessions collection once they have
+    # been quiet for archive_after_seconds, so the hot collection only holds
+    # conversations that can still receive turns. Archived sessions keep their
+    # metadata as fields and the history as one zlib compressed JSON blob.
+    def __init__(
+        self,
+        sessions,
+        archive,
+        archive_after_seconds: float = 3600,
+        batch_size: int = 500,
+    ):
+        self.sessions = sessions
+        self.archive = archive
+        self.archive_after = timedelta(seconds=archive_after_seconds)
+        self.batch_size = batch_size
+        self.archived = 0
+        self.rounds = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.hot: Optional[Dict[str, int]] = None
+
+    def _archive_document(self, session: Dict[str, Any], now: datetime) -> Dict:
+        history = session.get("history", [])
+        blob = compress_history(history)
+        self.raw_bytes += len(json.dumps(history, default=str).encode())
+        self.compressed_bytes += len(blob)
+        document = {key: value for key, value in session.items() if key != "history"}
+        document.update({"history": blob, "messages": len(history), "archived_at": now})
+        return document
+
+    async def archive_batch(self) -> int:
+        now = datetime.now()
+        cursor = self.sessions.find(
+            {
+                "status": SESSION_COMPLETE,
+                "updated_at": {"$lt": now - self.archive_after},
+            }
+        ).limit(self.batch_size)
+        batch = await cursor.to_list(None)
+        if not batch:
+            return 0
+        ids = [session["_id"] for session in batch]
+        # Replaces copies left by a round that stopped before its delete, or
+        # archived before the session was reopened
+        await self.archive.delete_many({"_id": {"$in": ids}})
+        await self.archive.insert_many(
+            [self._archive_document(session, now) for session in batch]
+        )
+        # A session that took another turn since it was read stays hot, its
+        # archived copy is replaced when it completes again
+        result = await self.sessions.delete_many(
+            {
+                "$or": [
+                    {"_id": session["_id"], "turn": session.get("turn")}
+                    for session in batch
+                ]
+            }
+        )
+        self.archived += result.deleted_count
+        return result.deleted_count
+
+    async def archive_expired(self) -> int:
+        archived = 0
+        while True:
+            moved = await self.archive_batch()
+            archived += moved
+            if moved < self.batch_size:
+                break
+        self.rounds += 1
+        await self.count_hot()
+        return archived
+
+    async def count_hot(self) -> Dict[str, int]:
+        self.hot = {
+            "total": await self.sessions.estimated_document_count(),
+            "open": await self.sessions.count_documents({"status": SESSION_OPEN}),
+            "complete": await self.sessions.count_documents(
+                {"status": SESSION_COMPLETE}
+            ),
+        }
+        return self.hot
+
+    async def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        document = await self.archive.find_one({"_id": session_id})
+        if document is not None:
+            document["history"] = decompress_history(document["history"])
+        return document
+
+    async def run(self, interval_seconds: float) -> None:
+        while True:
+            try:
+                archived = await self.archive_expired()
+                logging.info(f"Archived {archived} completed sessions")
+            except Exception as e:
+                logging.error(f"Error while archiving sessions: {e}")
+            await asyncio.sleep(interval_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            # Counted after each archiving round
+            "hot_sessions": self.hot,
+            "archived": self.archived,
+            "rounds": self.rounds,
+            "compression_ratio": (
+                self.raw_bytes / self.compressed_bytes
+                if self.compressed_bytes
+                else None
+            ),
+        }
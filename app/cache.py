@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+import time
+
+from .models import Message
+
+
+class LRUTTLCache:
+    def __init__(
+        self,
+        max_size: int,
+        ttl_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        item = self._entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at <= self._clock():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable) -> Any:
+        item = self._entries.get(key)
+        if item is None or item[0] <= self._clock():
+            return None
+        return item[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (self._clock() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+@dataclass(frozen=True)
+class CachedSession:
+    turn: int
+    messages: Tuple[Message, ...]
+    documents: Tuple[Dict[str, Any], ...]
+    prompt_version: Optional[str] = None
+    form_state: Optional[Dict[str, Any]] = None
+    tokens_used: int = 0
+
+
+class SessionCache(LRUTTLCache):
+    # "versioned" confirms the cached turn against Mongo with a projected read
+    # before serving an entry, which keeps several uvicorn workers consistent.
+    # "local" trusts the entry until it expires; a stale entry is caught by the
+    # turn-guarded append and dropped, so it suits sticky session routing.
+    MODES = ("versioned", "local")
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl_seconds: float = 300,
+        mode: str = "versioned",
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown session cache mode: {mode}")
+        super().__init__(max_size=max_size, ttl_seconds=ttl_seconds, clock=clock)
+        self.mode = mode
+        self.stale = 0
+
+    @property
+    def versioned(self) -> bool:
+        return self.mode == "versioned"
+
+    def get(self, key: Hashable) -> Optional[CachedSession]:
+        return super().get(key)
+
+    def store(
+        self,
+        session_id: str,
+        turn: int,
+        messages,
+        documents,
+        prompt_version: Optional[str] = None,
+        form_state: Optional[Dict[str, Any]] = None,
+        tokens_used: int = 0,
+    ) -> None:
+        self.put(
+            session_id,
+            CachedSession(
+                turn=turn,
+                messages=tuple(messages),
+                documents=tuple(documents),
+                prompt_version=prompt_version,
+                form_state=form_state,
+                tokens_used=tokens_used,
+            ),
+        )
+
+    def extend(
+        self,
+        session_id: str,
+        turn: int,
+        new_turn: int,
+        messages,
+        documents,
+        form_updates: Optional[Dict[str, Any]] = None,
+        tokens: int = 0,
+    ) -> None:
+        cached = self.peek(session_id)
+        if cached is None or cached.turn != turn:
+            self.invalidate(session_id)
+            return
+        form_state = cached.form_state
+        if form_updates:
+            form_state = {**(form_state or {}), **form_updates}
+            form_state = {k: v for k, v in form_state.items() if v is not None}
+        self.store(
+            session_id,
+            new_turn,
+            cached.messages + tuple(messages),
+            cached.documents + tuple(documents),
+            cached.prompt_version,
+            form_state,
+            cached.tokens_used + tokens,
+        )
+
+    def mark_stale(self, session_id: str) -> None:
+        self.stale += 1
+        self.invalidate(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        lookups = self.hits + self.misses
+        stats["mode"] = self.mode
+        stats["stale"] = self.stale
+        stats["hit_rate"] = (self.hits - self.stale) / lookups if lookups else 0.0
+        return stats
@@ -1,11 +1,17 @@
+import hashlib
 from pathlib import Path
 import yaml
-from typing import Dict, Any
+from typing import Any, Dict, Optional, Tuple
 import logging
 
+# libyaml's loader parses config.yaml several times faster than the pure
+# Python one; fall back to it when PyYAML was built without libyaml
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 class Config:
     _instance = None
+    path = Path(__file__).parent / "config.yaml"
 
     def __new__(cls):
         if cls._instance is None:
@@ -14,16 +20,46 @@ class Config:
         return cls._instance
 
     def _initialize(self) -> None:
-        self.config_data = self._load_config()
+        self.config_data, self.mtime_ns, self.version = self._load_config()
 
-    def _load_config(self) -> Dict[str, Any]:
+    def _load_config(self) -> Tuple[Dict[str, Any], int, str]:
         try:
-            config_path = Path(__file__).parent / "config.yaml"
-            with open(config_path, "r") as file:
-                return yaml.safe_load(file)
+            mtime_ns = self.path.stat().st_mtime_ns
+            text = self.path.read_text()
+            config_data = yaml.load(text, Loader=SafeLoader)
         except Exception as e:
             logging.error(f"Error loading configuration: {e}")
             raise RuntimeError("Failed to load configuration")
+        return config_data, mtime_ns, hashlib.sha256(text.encode()).hexdigest()[:16]
+
+    def changed(self) -> Optional["Config"]:
+        # Re-reads config.yaml when it was modified and returns it as a Config
+        # of its own, for the caller to check before it applies it. None when
+        # the content is the same, or the file doesn't parse: that one isn't
+        # read again until it is modified.
+        try:
+            mtime_ns = self.path.stat().st_mtime_ns
+        except OSError as e:
+            logging.error(f"Error checking configuration: {e}")
+            return None
+        if mtime_ns == self.mtime_ns:
+            return None
+        try:
+            loaded = self._load_config()
+        except RuntimeError:
+            self.mtime_ns = mtime_ns
+            return None
+        if loaded[2] == self.version:
+            self.mtime_ns = loaded[1]
+            return None
+        pending = object.__new__(Config)
+        pending.config_data, pending.mtime_ns, pending.version = loaded
+        return pending
+
+    def apply(self, pending: "Config") -> None:
+        self.config_data = pending.config_data
+        self.mtime_ns = pending.mtime_ns
+        self.version = pending.version
 
     @property
     def system_prompt(self) -> str:
@@ -32,3 +68,183 @@ class Config:
     @property
     def model_name(self) -> str:
         return self.config_data.get("model", "gpt-4o-mini")
+
+    def _section(self, name: str, defaults: Dict[str, Any]) -> Dict[str, Any]:
+        return {**defaults, **(self.config_data.get(name) or {})}
+
+    @property
+    def session_cache(self) -> Dict[str, Any]:
+        return self._section(
+            "session_cache",
+            {
+                "enabled": True,
+                "max_size": 10000,
+                "ttl_seconds": 300,
+                "mode": "versioned",
+            },
+        )
+
+    @property
+    def context(self) -> Dict[str, Any]:
+        return self._section("context", {"window_turns": 4, "token_budget": 2000})
+
+    @property
+    def plate_filter(self) -> Dict[str, Any]:
+        return self._section(
+            "plate_filter",
+            {
+                "enabled": True,
+                "capacity": 1000000,
+                "error_rate": 0.01,
+                "sync_interval_seconds": 30,
+            },
+        )
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        return self._section("metrics", {"enabled": True})
+
+    @property
+    def response_cache(self) -> Dict[str, Any]:
+        return self._section(
+            "response_cache",
+            {
+                "enabled": False,
+                "backend": "memory",
+                "max_size": 1000,
+                "ttl_seconds": 3600,
+                "max_messages": 1,
+                "bypass_patterns": [],
+            },
+        )
+
+    @property
+    def pipeline(self) -> Dict[str, Any]:
+        return self._section("pipeline", {"concurrent_io": True, "session_locks": True})
+
+    @property
+    def admission(self) -> Dict[str, Any]:
+        return self._section(
+            "admission",
+            {
+                "enabled": True,
+                "initial_limit": 20,
+                "min_limit": 2,
+                "max_limit": 200,
+                "latency_target_seconds": 10.0,
+                "backoff_ratio": 0.9,
+                "max_queue": 100,
+                "max_queue_per_client": 10,
+                "queue_timeout_seconds": 5.0,
+            },
+        )
+
+    @property
+    def response_parser(self) -> Dict[str, Any]:
+        return self._section("response_parser", {"reprompt": True})
+
+    @property
+    def form_state(self) -> Dict[str, Any]:
+        return self._section(
+            "form_state", {"enabled": True, "deterministic_completion": True}
+        )
+
+    @property
+    def record_writer(self) -> Dict[str, Any]:
+        return self._section(
+            "record_writer",
+            {
+                "enabled": False,
+                "max_batch": 100,
+                "flush_interval_seconds": 0.05,
+                "durability": "journaled",
+                "max_pending": 10000,
+            },
+        )
+
+    @property
+    def router(self) -> Dict[str, Any]:
+        settings = self._section(
+            "router",
+            {
+                "hedging": True,
+                "hedge_after_seconds": 2.0,
+                "min_samples": 20,
+                "ewma_alpha": 0.2,
+                "failure_threshold": 3,
+                "reset_seconds": 30,
+                "models": None,
+            },
+        )
+        if not settings["models"]:
+            settings["models"] = [{"model": self.model_name}]
+        return settings
+
+    @property
+    def idempotency(self) -> Dict[str, Any]:
+        return self._section("idempotency", {"enabled": True, "ttl_seconds": 86400})
+
+    @property
+    def reporting(self) -> Dict[str, Any]:
+        return self._section(
+            "reporting",
+            {
+                "enabled": False,
+                "read_preference": "secondary_preferred",
+                "max_page_size": 500,
+            },
+        )
+
+    @property
+    def session_lifecycle(self) -> Dict[str, Any]:
+        return self._section(
+            "session_lifecycle",
+            {
+                "expire_after_seconds": 604800,
+                "archive_enabled": True,
+                "archive_after_seconds": 3600,
+                "interval_seconds": 300,
+                "batch_size": 500,
+            },
+        )
+
+    @property
+    def startup(self) -> Dict[str, Any]:
+        return self._section("startup", {"warm_up_agent": True})
+
+    @property
+    def hot_reload(self) -> Dict[str, Any]:
+        return self._section(
+            "hot_reload", {"enabled": True, "interval_seconds": 5, "retain_prompts": 8}
+        )
+
+    @property
+    def websocket(self) -> Dict[str, Any]:
+        return self._section(
+            "websocket", {"idle_timeout_seconds": 600, "max_pending_writes": 8}
+        )
+
+    @property
+    def client_address(self) -> Dict[str, Any]:
+        return self._section("client_address", {"trusted_proxies": []})
+
+    @property
+    def rate_limits(self) -> Dict[str, Any]:
+        return self._section(
+            "rate_limits",
+            {
+                "enabled": True,
+                "backend": "memory",
+                "client_turns_per_minute": 30,
+                "client_burst": 20,
+                "session_turns_per_minute": 10,
+                "session_burst": 10,
+                "max_keys": 100000,
+            },
+        )
+
+    @property
+    def token_budget(self) -> Dict[str, Any]:
+        return self._section(
+            "token_budget", {"enabled": True, "session_tokens": 200000}
+        )
@@ -0,0 +1,102 @@
+import json
+from typing import Any, Dict, List, Optional
+from .models import CarInfo, Message
+from .sessions import message_documents
+
+# Fields that describe the model's reply rather than the customer's form
+REPLY_FIELDS = {"reasoning", "next_question", "complete"}
+FORM_FIELDS = [f for f in CarInfo.model_fields if f not in REPLY_FIELDS]
+
+# Rough per-message overhead the chat format adds on top of the content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    # About four characters per token for English text, which is close enough
+    # to decide when to compact without pulling in a tokenizer.
+    return sum(len(m["content"]) // 4 + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def latest_form_state(history: List[Message]) -> Dict[str, Any]:
+    for message in reversed(history):
+        if message.role != "assistant":
+            continue
+        try:
+            data = json.loads(message.content)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, dict):
+            return {f: data[f] for f in FORM_FIELDS if data.get(f) not in (None, "")}
+    return {}
+
+
+def recent_turns(history: List[Message], window_turns: int) -> List[Message]:
+    if window_turns <= 0:
+        return []
+    seen = 0
+    for i in range(len(history) - 1, -1, -1):
+        if history[i].role == "user":
+            seen += 1
+            if seen == window_turns:
+                return history[i:]
+    return history
+
+
+class FormValues(dict):
+    # The form fields known for a session, sent to the model as checked.
+    # hints are answers that may hold a missing field but can't be checked
+    # without the model, e.g. a short reply to "What is your name?".
+    def __init__(self, values: Dict[str, Any], hints: Optional[Dict[str, Any]] = None):
+        super().__init__(values)
+        self.hints = dict(hints or {})
+
+
+def form_state_message(form_state: Dict[str, Any]) -> Dict[str, Any]:
+    missing = [f for f in FORM_FIELDS if f not in form_state]
+    content = (
+        "Form details the customer already gave, checked, don't ask "
+        f"for them again: {json.dumps(form_state, separators=(',', ':'))}. "
+        f"Still missing: {', '.join(missing) or 'nothing'}."
+    )
+    hints = getattr(form_state, "hints", None)
+    if hints:
+        content += (
+            " The customer's last answer may give these, use them only if it "
+            f"really does: {json.dumps(hints, separators=(',', ':'))}."
+        )
+    return {"role": "system", "content": content}
+
+
+def compact_messages(
+    system_prompt: str,
+    history: List[Message],
+    window_turns: int,
+    token_budget: int,
+    form_state: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    # form_state holds the fields tracked for the session, which are then
+    # sent every turn instead of being re-read from the transcript
+    documents = message_documents(history)
+    compacted = [{"role": "system", "content": system_prompt}]
+    if form_state is not None:
+        compacted.append(form_state_message(form_state))
+    messages = compacted + documents
+    if estimate_tokens(messages) <= token_budget:
+        return messages
+
+    recent = recent_turns(history, window_turns)
+    if form_state is not None:
+        compacted[-1]["content"] = "Earlier turns were omitted. " + (
+            compacted[-1]["content"]
+        )
+        return compacted + documents[len(history) - len(recent) :]
+    state = latest_form_state(history)
+    if state:
+        compacted.append(
+            {
+                "role": "system",
+                "content": "Earlier turns were omitted. Details the customer has "
+                f"already provided: {json.dumps(state, separators=(',', ':'))}",
+            }
+        )
+    return compacted + documents[len(history) - len(recent) :]
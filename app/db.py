@@ -1,5 +1,11 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, monitoring
+from pymongo.errors import OperationFailure, PyMongoError
+from collections import deque
+from typing import Any, Dict, Optional
+import logging
 import os
+import threading
 from urllib.parse import quote_plus
 import dotenv
 
@@ -14,8 +20,236 @@ def get_mongo_uri():
     return f"mongodb://{user}:{password}@{host}:27017"
 
 
-client = AsyncIOMotorClient(get_mongo_uri())
-db = client["chatbot"]
+def get_client_options() -> Dict[str, Any]:
+    # Pools are per uvicorn worker, so the server sees up to
+    # workers * MONGODB_MAX_POOL_SIZE connections from one container.
+    options: Dict[str, Any] = {
+        "maxPoolSize": int(os.getenv("MONGODB_MAX_POOL_SIZE", "25")),
+        "minPoolSize": int(os.getenv("MONGODB_MIN_POOL_SIZE", "2")),
+        "waitQueueTimeoutMS": int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+        "serverSelectionTimeoutMS": int(
+            os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000")
+        ),
+    }
+    # zlib works out of the box, zstd and snappy need their python packages
+    compressors = os.getenv("MONGODB_COMPRESSORS", "")
+    if compressors:
+        options["compressors"] = compressors
+    return options
 
-sessions = db.sessions
-records = db.records
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    # Pool events arrive on the driver's threads, hence the lock
+    def __init__(self, recent_waits: int = 1000):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.created = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.checkout_failures: Dict[str, int] = {}
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._recent_waits: deque = deque(maxlen=recent_waits)
+
+    def _record_wait(self, duration: Optional[float]) -> None:
+        if duration is None:
+            return
+        self.wait_seconds_total += duration
+        self.wait_seconds_max = max(self.wait_seconds_max, duration)
+        self._recent_waits.append(duration)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures[event.reason] = (
+                self.checkout_failures.get(event.reason, 0) + 1
+            )
+            self._record_wait(event.duration)
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self._record_wait(event.duration)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._recent_waits)
+            return {
+                "open": self.open,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "created": self.created,
+                "closed": self.closed,
+                "checkouts": self.checkouts,
+                "checkout_failures": dict(self.checkout_failures),
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+                "wait_seconds_p95": waits[int(len(waits) * 0.95) - 1] if waits else 0.0,
+            }
+
+
+pool_stats = PoolStats()
+
+# Bound by connect() from the application lifespan. Collections that are
+# already bound, e.g. patched by tests, are left alone.
+client = None
+db = None
+sessions = None
+records = None
+llm_responses = None
+chat_responses = None
+sessions_archive = None
+prompts = None
+rate_limits = None
+
+
+def connect():
+    global client, db, sessions, records, llm_responses, chat_responses
+    global sessions_archive, prompts, rate_limits
+    if client is None:
+        client = AsyncIOMotorClient(
+            get_mongo_uri(), event_listeners=[pool_stats], **get_client_options()
+        )
+    if db is None:
+        db = client["chatbot"]
+    if sessions is None:
+        sessions = db.sessions
+    if records is None:
+        records = db.records
+    if llm_responses is None:
+        llm_responses = db.llm_responses
+    if chat_responses is None:
+        chat_responses = db.chat_responses
+    if sessions_archive is None:
+        sessions_archive = db.sessions_archive
+    if prompts is None:
+        prompts = db.prompts
+    if rate_limits is None:
+        rate_limits = db.rate_limits
+
+
+async def warm_up() -> bool:
+    # Establishes the first connections before traffic needs them
+    try:
+        await client.admin.command("ping")
+    except PyMongoError as e:
+        logging.error(f"Database warm-up failed: {e}")
+        return False
+    return True
+
+
+def close():
+    global client, db, sessions, records, llm_responses, chat_responses
+    global sessions_archive, prompts, rate_limits
+    if client is not None:
+        client.close()
+    client = db = sessions = records = llm_responses = chat_responses = None
+    sessions_archive = prompts = rate_limits = None
+
+
+async def ensure_record_indexes(collection):
+    # Sparse so records written before plates were normalized don't collide on
+    # the missing field; the raw plate index keeps those records searchable
+    # until python -m app.sessions --backfill-plates has set it.
+    await collection.create_index(
+        [("licence_plate_normalized", ASCENDING)],
+        name="licence_plate_normalized_unique",
+        unique=True,
+        sparse=True,
+    )
+    await collection.create_index([("licence_plate", ASCENDING)], name="licence_plate")
+
+
+async def ensure_report_indexes(collection):
+    # Serve the reporting API: newest first over a date range, optionally
+    # narrowed to one car type or brand, with _id breaking ties for keyset
+    # pagination
+    await collection.create_index(
+        [("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at_id"
+    )
+    for field in ("car_type", "manufacturer_or_brand"):
+        await collection.create_index(
+            [
+                (f"form_data.{field}", ASCENDING),
+                ("created_at", DESCENDING),
+                ("_id", DESCENDING),
+            ],
+            name=f"{field}_created_at_id",
+        )
+
+
+# Index option conflict, raised when an index exists with other options
+INDEX_OPTIONS_CONFLICT = 85
+
+
+async def ensure_session_indexes(collection, expire_after_seconds: int):
+    # Only open sessions expire; completed ones are left for the archiver.
+    # Sessions written before the status field existed match neither until
+    # python -m app.sessions --backfill-status has set it.
+    try:
+        await collection.create_index(
+            [("updated_at", ASCENDING)],
+            name="open_session_ttl",
+            expireAfterSeconds=expire_after_seconds,
+            partialFilterExpression={"status": "open"},
+        )
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        # The TTL was changed in the config, update it in place
+        await collection.database.command(
+            "collMod",
+            collection.name,
+            index={
+                "name": "open_session_ttl",
+                "expireAfterSeconds": expire_after_seconds,
+            },
+        )
+    await collection.create_index(
+        [("status", ASCENDING), ("updated_at", ASCENDING)], name="status_updated_at"
+    )
+
+
+async def ensure_indexes(session_ttl_seconds: Optional[int] = None):
+    try:
+        await ensure_record_indexes(records)
+        await ensure_report_indexes(records)
+        if session_ttl_seconds is not None:
+            await ensure_session_indexes(sessions, session_ttl_seconds)
+    except PyMongoError as e:
+        logging.error(f"Database error while creating indexes: {e}")
@@ -0,0 +1,337 @@
+import json
+import re
+from datetime import date, datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple, get_args
+
+from .context import FORM_FIELDS, FormValues, latest_form_state
+from .models import CarInfo, Message
+from .sessions import normalize_plate
+
+# Where a value in the form state came from
+SOURCE_AGENT = "agent"
+SOURCE_CUSTOMER = "customer"
+
+CAR_TYPES = get_args(CarInfo.model_fields["car_type"].annotation)
+DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%d %B %Y", "%B %d, %Y")
+DATE_PATTERN = re.compile(r"\b(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[./]\d{1,2}[./]\d{4})\b")
+YEAR_PATTERN = re.compile(r"\b(1[89]\d\d|20\d\d)\b")
+PLATE_PATTERN = re.compile(r"[A-Z0-9](?:[A-Z0-9 -]{0,10}[A-Z0-9])?")
+WORDS_PATTERN = re.compile(r"[^\W\d_][\w'.-]*(?: [^\W\d_][\w'.-]*){0,3}")
+# Lead-ins stripped from a bare answer, e.g. "My name is Ann" or "It's a Kia"
+LEAD_IN = re.compile(
+    r"^(?:(?:my|the) (?:name|plate|licence plate|license plate) is|i am|i'm|"
+    r"it's|it is|this is|that's|that is)\s+(?:an?\s+)?",
+    re.IGNORECASE,
+)
+# Fields any short answer fits, so "No idea" or "Why do you ask?" would pass
+# for a name; read from an answer, they only go to the model as hints
+FREE_TEXT_FIELDS = ("manufacturer_or_brand", "name")
+# What the agent's next question asks for
+QUESTION_KEYWORDS = {
+    "licence_plate_number": ("plate",),
+    "year_of_construction": ("year", "built", "made in"),
+    "birthdate": ("birth", "born"),
+    "car_type": ("type of car", "car type", "kind of car", "type of vehicle"),
+    "manufacturer_or_brand": ("brand", "manufacturer", "make of"),
+    "name": ("name",),
+}
+
+
+def valid_plate(value: str) -> Optional[str]:
+    plate = " ".join(str(value).split()).upper()
+    if not PLATE_PATTERN.fullmatch(plate) or len(normalize_plate(plate)) < 2:
+        return None
+    return plate
+
+
+def valid_year(value: str) -> Optional[str]:
+    try:
+        year = int(str(value).strip())
+    except ValueError:
+        return None
+    # The first cars were built in 1886; next year's models are sold already
+    if not 1886 <= year <= date.today().year + 1:
+        return None
+    return str(year)
+
+
+def valid_birthdate(value: str) -> Optional[str]:
+    text = " ".join(str(value).split())
+    for format in DATE_FORMATS:
+        try:
+            born = datetime.strptime(text, format).date()
+        except ValueError:
+            continue
+        age = (date.today() - born).days // 365.25
+        return born.isoformat() if 16 <= age <= 120 else None
+    return None
+
+
+def valid_car_type(value: str) -> Optional[str]:
+    text = " ".join(str(value).split()).casefold()
+    return next((t for t in CAR_TYPES if t.casefold() == text), None)
+
+
+def valid_text(value: str) -> Optional[str]:
+    text = " ".join(str(value).split())
+    return text or None
+
+
+VALIDATORS: Dict[str, Callable[[str], Optional[str]]] = {
+    "licence_plate_number": valid_plate,
+    "year_of_construction": valid_year,
+    "birthdate": valid_birthdate,
+    "car_type": valid_car_type,
+    "manufacturer_or_brand": valid_text,
+    "name": valid_text,
+}
+
+
+def customer_text(history: List[Message]) -> str:
+    return "\n".join(m.content for m in history if m.role == "user").casefold()
+
+
+def mentions(text: str, word: str) -> bool:
+    return re.search(rf"(?<!\w){re.escape(word.casefold())}(?!\w)", text) is not None
+
+
+def number_in(text: str, number: int) -> bool:
+    return re.search(rf"(?<!\d)0?{number}(?!\d)", text) is not None
+
+
+def supported(field: str, value: str, text: str) -> bool:
+    # Whether the customer's messages (text, see customer_text) contain the
+    # value the agent reported. CarInfo makes the model fill in every field,
+    # so a value nobody said is a guess or a placeholder.
+    if field == "licence_plate_number":
+        return normalize_plate(value) in normalize_plate(text).upper()
+    if field == "birthdate":
+        born = date.fromisoformat(value)
+        return (
+            mentions(text, str(born.year))
+            and number_in(text, born.day)
+            and (
+                number_in(text, born.month)
+                or any(mentions(text, born.strftime(f)) for f in ("%B", "%b"))
+            )
+        )
+    return all(mentions(text, word) for word in value.split())
+
+
+def supported_fields(
+    data: Dict[str, Any], history: List[Message]
+) -> Tuple[Dict[str, Any], List[str]]:
+    # Splits the agent's fields into those the customer's messages support
+    # and valid ones they don't; invalid values are left for merge to reject
+    text = customer_text(history)
+    kept, unsupported = {}, []
+    for field in FORM_FIELDS:
+        if data.get(field) in (None, ""):
+            continue
+        value = VALIDATORS[field](data[field])
+        if value is not None and not supported(field, value, text):
+            unsupported.append(field)
+            continue
+        kept[field] = data[field]
+    return kept, unsupported
+
+
+def bare_answer(message: str) -> str:
+    return LEAD_IN.sub("", message.strip()).strip(" .!")
+
+
+def extract_field(field: str, message: str, only_field: bool) -> Optional[str]:
+    # Reads a value from the customer's answer to a question about `field`
+    # when there is exactly one way to read it. Names and brands are only
+    # taken from a short answer to a question about nothing else.
+    if field == "birthdate":
+        dates = DATE_PATTERN.findall(message)
+        return valid_birthdate(dates[0]) if len(dates) == 1 else None
+    if field == "year_of_construction":
+        years = YEAR_PATTERN.findall(DATE_PATTERN.sub("", message))
+        return valid_year(years[0]) if len(years) == 1 else None
+    if field == "car_type":
+        text = message.casefold()
+        found = [t for t in CAR_TYPES if re.search(rf"\b{t.casefold()}\b", text)]
+        return found[0] if len(found) == 1 else None
+    answer = bare_answer(message)
+    if field == "licence_plate_number":
+        # Every part has a digit or is written in capitals, so "maybe 2" or
+        # "not sure" aren't taken for plates
+        parts = re.split(r"[ -]+", answer)
+        if any(c.isdigit() for c in answer) and all(
+            p.isupper() or any(c.isdigit() for c in p) for p in parts
+        ):
+            return valid_plate(answer)
+        return None
+    if only_field and WORDS_PATTERN.fullmatch(answer):
+        return valid_text(answer)
+    return None
+
+
+def asked_fields(history: List[Message]) -> List[str]:
+    # The fields the agent's last question was about
+    for message in reversed(history):
+        if message.role != "assistant":
+            continue
+        try:
+            question = json.loads(message.content).get("next_question") or ""
+        except (json.JSONDecodeError, AttributeError):
+            return []
+        question = question.casefold()
+        return [
+            field
+            for field, keywords in QUESTION_KEYWORDS.items()
+            if any(keyword in question for keyword in keywords)
+            # "What year were you born?" is about the birthdate
+            and not (
+                field == "year_of_construction"
+                and any(k in question for k in QUESTION_KEYWORDS["birthdate"])
+            )
+        ]
+    return []
+
+
+class FormState:
+    # The form fields known for a session, each with its value, where it came
+    # from and the turn that set it. Kept on the session document; changes
+    # are collected in `pending` and written field by field with the turn.
+    def __init__(self, fields: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.fields: Dict[str, Dict[str, Any]] = dict(fields or {})
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        # Free-text values read from this turn's answer, see FormValues
+        self.hints: Dict[str, str] = {}
+
+    @classmethod
+    def load(
+        cls, document: Optional[Dict[str, Any]], history: List[Message]
+    ) -> "FormState":
+        if document is not None:
+            return cls(document)
+        # Sessions from before the form state was kept: start from the last
+        # reply, written with the next turn
+        state = cls()
+        kept, _ = supported_fields(latest_form_state(history), history)
+        state.merge(kept, SOURCE_AGENT, turn=None)
+        return state
+
+    def values(self) -> FormValues:
+        return FormValues(
+            {field: entry["value"] for field, entry in self.fields.items()},
+            self.hints,
+        )
+
+    def missing(self) -> List[str]:
+        return [field for field in FORM_FIELDS if field not in self.fields]
+
+    def merge(
+        self, data: Dict[str, Any], source: str, turn: Optional[int]
+    ) -> Tuple[List[str], List[str]]:
+        # Takes the fields of `data` that pass their validator. Returns the
+        # fields that changed and those that were rejected.
+        changed, rejected = [], []
+        for field in FORM_FIELDS:
+            if data.get(field) in (None, ""):
+                continue
+            value = VALIDATORS[field](data[field])
+            if value is None:
+                rejected.append(field)
+                continue
+            current = self.fields.get(field)
+            if current is not None and current["value"] == value:
+                continue
+            entry = {"value": value, "source": source, "turn": turn}
+            self.fields[field] = entry
+            self.pending[field] = entry
+            changed.append(field)
+        return changed, rejected
+
+    def discard(self, field: str) -> None:
+        # Forgets a value that turned out to be unusable, e.g. a plate that
+        # already has a record, so the agent asks for it again
+        if self.fields.pop(field, None) is not None:
+            self.pending[field] = None
+
+    def take_updates(self) -> Dict[str, Dict[str, Any]]:
+        updates, self.pending = self.pending, {}
+        return updates
+
+
+COMPLETE_REASONING = "Every field is known and passed validation."
+
+
+class FormTracker:
+    # Keeps the form state of each turn up to date: values the customer gave
+    # in a form that can be read without the model, then the fields of the
+    # agent's reply that the customer's messages contain. With
+    # deterministic_completion, a turn whose answer completes the form is
+    # finished without calling the model.
+    def __init__(self, deterministic_completion: bool = True):
+        self.deterministic_completion = deterministic_completion
+        self.customer_fields = 0
+        self.hinted_fields = 0
+        self.agent_fields = 0
+        self.rejected: Dict[str, int] = {}
+        self.unsupported: Dict[str, int] = {}
+        self.turns_without_model = 0
+
+    def read_answer(
+        self, state: FormState, history: List[Message], turn: int
+    ) -> Optional[str]:
+        # history ends with the customer's new message. Returns the reply that
+        # completes the form, when the model isn't needed for this turn: only
+        # if no field it would complete is free text, which the model checks.
+        missing = state.missing()
+        asked = [f for f in asked_fields(history[:-1]) if f in missing]
+        message = history[-1].content
+        found, hints = {}, {}
+        for field in asked:
+            value = extract_field(field, message, only_field=len(asked) == 1)
+            if value is None:
+                continue
+            if field in FREE_TEXT_FIELDS:
+                hints[field] = value
+            else:
+                found[field] = value
+        state.merge(found, SOURCE_CUSTOMER, turn)
+        state.hints = hints
+        self.customer_fields += len(found)
+        self.hinted_fields += len(hints)
+        if not (found and self.deterministic_completion) or state.missing():
+            return None
+        self.turns_without_model += 1
+        return json.dumps(
+            {
+                "reasoning": COMPLETE_REASONING,
+                "next_question": "",
+                **state.values(),
+                "complete": True,
+            }
+        )
+
+    def record_reply(
+        self,
+        state: FormState,
+        data: Dict[str, Any],
+        turn: int,
+        history: List[Message],
+    ) -> None:
+        # Only values the customer actually gave are kept, so a guess never
+        # reaches the model as checked or completes the form without it
+        kept, unsupported = supported_fields(data, history)
+        changed, rejected = state.merge(kept, SOURCE_AGENT, turn)
+        self.agent_fields += len(changed)
+        for field in rejected:
+            self.rejected[field] = self.rejected.get(field, 0) + 1
+        for field in unsupported:
+            self.unsupported[field] = self.unsupported.get(field, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "customer_fields": self.customer_fields,
+            "hinted_fields": self.hinted_fields,
+            "agent_fields": self.agent_fields,
+            "rejected": dict(self.rejected),
+            "unsupported": dict(self.unsupported),
+            "turns_without_model": self.turns_without_model,
+        }
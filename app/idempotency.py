@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import json
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from .service_exceptions import IdempotencyKeyReused
+
+
+class IdempotencyStore:
+    # Responses to requests that carried an idempotency key, so a retry gets
+    # the stored answer instead of another model call. Keys are scoped to the
+    # session they were sent for, or to the client for a request that starts
+    # a session, and a key is only replayed for the body it was first sent
+    # with. MongoDB expires them through a TTL index.
+    def __init__(self, collection, ttl_seconds: float = 86400):
+        self.collection = collection
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.replayed = 0
+        self.reused = 0
+
+    @staticmethod
+    def scope(session_id: Optional[str], key: str, client: str) -> str:
+        # Anyone holding the session id may continue the session anyway; a
+        # key without one must not hand another caller's new session over
+        if session_id:
+            return f"{session_id}:{key}"
+        return f"new:{client}:{key}"
+
+    @staticmethod
+    def fingerprint(body: Dict[str, Any]) -> str:
+        encoded = json.dumps(body, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    async def ensure_indexes(self) -> None:
+        try:
+            await self.collection.create_index(
+                [("expires_at", ASCENDING)],
+                name="expires_at_ttl",
+                expireAfterSeconds=0,
+            )
+        except PyMongoError as e:
+            logging.error(f"Database error while creating idempotency index: {e}")
+
+    async def get(
+        self, session_id: Optional[str], key: str, client: str, fingerprint: str
+    ) -> Optional[Dict]:
+        doc = await self.collection.find_one(
+            {
+                "_id": self.scope(session_id, key, client),
+                "expires_at": {"$gt": datetime.now(timezone.utc)},
+            }
+        )
+        if doc is None:
+            return None
+        # Stored before bodies were fingerprinted when it has none
+        if doc.get("fingerprint", fingerprint) != fingerprint:
+            self.reused += 1
+            raise IdempotencyKeyReused(
+                f"Idempotency key {key} was used for another request"
+            )
+        self.replayed += 1
+        return doc["response"]
+
+    async def put(
+        self,
+        session_id: Optional[str],
+        key: str,
+        client: str,
+        fingerprint: str,
+        response: Dict,
+    ) -> None:
+        try:
+            await self.collection.update_one(
+                {"_id": self.scope(session_id, key, client)},
+                {
+                    "$set": {
+                        "response": response,
+                        "fingerprint": fingerprint,
+                        "expires_at": datetime.now(timezone.utc) + self.ttl,
+                    }
+                },
+                upsert=True,
+            )
+        except PyMongoError as e:
+            # The turn itself succeeded, a retry will just run it again
+            logging.error(f"Database error while storing idempotent response: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"replayed": self.replayed, "reused": self.reused}
+
+
+class SessionLocks:
+    # Runs one turn per session at a time within this worker, so requests for
+    # the same session queue up instead of failing the turn check. A request
+    # identical to one still in flight waits for that one's outcome instead of
+    # running again.
+    def __init__(self):
+        self._locks: Dict[str, List] = {}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+        self.waited = 0
+
+    async def run(
+        self, session_id: str, fingerprint: Hashable, turn: Callable[[], Awaitable]
+    ):
+        key = (session_id, fingerprint)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if inflight.cancelled() and not asyncio.current_task().cancelling():
+                    # The request we waited on was abandoned, run the turn here
+                    return await self.run(session_id, fingerprint, turn)
+                raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            async with self._acquire(session_id):
+                result = await turn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Marks the exception as seen when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+    @asynccontextmanager
+    async def _acquire(self, session_id: str):
+        # Reference counted so locks of idle sessions don't pile up
+        entry = self._locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        if entry[0].locked():
+            self.waited += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[session_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._locks),
+            "in_flight": len(self._inflight),
+            "coalesced": self.coalesced,
+            "waited": self.waited,
+        }
@@ -1,42 +1,220 @@
-from litellm import acompletion
 import dotenv
 import os
 import logging
 from .config.config import Config
+import json
+from .context import FORM_FIELDS, compact_messages, latest_form_state
+from .llm_router import LLMRouter, validates
+from .response_parser import fields_model
+from .limits import TokenUsage
 from .models import Message, CarInfo
 import asyncio
+from typing import AsyncIterator
 from .service_exceptions import AgentNotAvailable
 
-
 dotenv.load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+FOLLOW_UP_PROMPT = (
+    "You are filling in a car insurance form. Your previous reply left out "
+    "some fields. Reply with a JSON object that contains only these fields: "
+    "{fields}. Details the customer has already provided: {known}"
+)
+
+
+async def acompletion(*args, **kwargs):
+    # litellm takes a couple of seconds to import; pay for it on first use
+    # (or in warm_up) rather than when the app module is loaded
+    return await load_litellm().acompletion(*args, **kwargs)
+
+
+def load_litellm():
+    import litellm
+
+    return litellm
+
 
 class InsuranceAgent:
-    def __init__(self):
+    def __init__(self, completion=None):
         self.config = Config()
         self.model = self.config.model_name
         self.system_prompt = self.config.system_prompt
+        self.context = self.config.context
+        self.completion = completion or acompletion
+        self.router_settings = self.config.router
+        self.router = LLMRouter.from_config(self.router_settings)
+        self.response_cache = None
+
+    def build_router(self, config: Config) -> LLMRouter:
+        # The router for a configuration that is about to be applied, so bad
+        # routing settings fail before anything is swapped. A new router (with
+        # fresh latency and health stats) is only built when they changed.
+        if config.router == self.router_settings:
+            return self.router
+        return LLMRouter.from_config(config.router)
+
+    def reload(self, router: LLMRouter | None = None) -> None:
+        # Picks up a changed config.yaml. Calls already running finish on the
+        # router they started with.
+        self.model = self.config.model_name
+        self.system_prompt = self.config.system_prompt
+        self.context = self.config.context
+        self.router = router or self.build_router(self.config)
+        self.router_settings = self.config.router
+
+    async def warm_up(self) -> None:
+        # Imports litellm in a thread so the event loop keeps serving meanwhile
+        if self.completion is acompletion:
+            await asyncio.to_thread(load_litellm)
 
-    async def respond(self, history: list[Message]) -> str | None:
+    async def respond(
+        self,
+        history: list[Message],
+        system_prompt: str | None = None,
+        form_state: dict | None = None,
+        usage: TokenUsage | None = None,
+    ) -> str | None:
         try:
-            response = await self.generate_answer(history=history)
+            response = await self.generate_answer(
+                history, system_prompt, form_state, usage
+            )
             return response
         except Exception as e:
             logging.error(
-                "The following error happened while generating the response: ", e
+                f"The following error happened while generating the response: {e}"
+            )
+            raise AgentNotAvailable("The agent is not available")
+
+    async def respond_stream(
+        self,
+        history: list[Message],
+        system_prompt: str | None = None,
+        form_state: dict | None = None,
+        usage: TokenUsage | None = None,
+    ) -> AsyncIterator[str]:
+        messages = self.build_messages(history, system_prompt, form_state)
+        try:
+            stream = await self.router.open_stream(
+                self.completion,
+                messages,
+                response_format=CarInfo,
+                stream=True,
+                # Sent as a last chunk without choices
+                stream_options={"include_usage": True},
+            )
+        except Exception as e:
+            logging.error(
+                f"The following error happened while opening the response stream: {e}"
+            )
+            raise AgentNotAvailable("The agent is not available")
+        return self._stream_deltas(stream, messages, usage)
+
+    async def _stream_deltas(
+        self, stream, messages: list[dict], usage: TokenUsage | None = None
+    ) -> AsyncIterator[str]:
+        reported = None
+        text = []
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    reported = chunk.usage
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    text.append(content)
+                    yield content
+        except Exception as e:
+            logging.error(
+                f"The following error happened while streaming the response: {e}"
             )
             raise AgentNotAvailable("The agent is not available")
+        finally:
+            # Also counted when the stream fails or the client goes away
+            if usage is not None and (reported is not None or text):
+                usage.add(reported, messages, "".join(text))
+
+    def build_messages(
+        self,
+        history: list[Message],
+        system_prompt: str | None = None,
+        form_state: dict | None = None,
+    ) -> list[dict]:
+        # Sessions pass the prompt they started with, see PromptRegistry, and
+        # the form fields known so far, see FormState
+        return compact_messages(
+            system_prompt or self.system_prompt,
+            history,
+            window_turns=self.context["window_turns"],
+            token_budget=self.context["token_budget"],
+            form_state=form_state,
+        )
+
+    async def generate_answer(
+        self,
+        history: list[Message],
+        system_prompt: str | None = None,
+        form_state: dict | None = None,
+        usage: TokenUsage | None = None,
+    ):
+        system_prompt = system_prompt or self.system_prompt
+        # Replies are cached for openings, which can't depend on known fields
+        if self.response_cache is not None and not form_state:
+            return await self.response_cache.get_or_compute(
+                self.model,
+                system_prompt,
+                history,
+                lambda: self._complete(history, system_prompt, form_state, usage),
+            )
+        return await self._complete(history, system_prompt, form_state, usage)
+
+    async def _complete(
+        self,
+        history: list[Message],
+        system_prompt: str,
+        form_state: dict | None,
+        usage: TokenUsage | None = None,
+    ):
+        # usage collects the tokens of every model call, see TokenBudget
+        return await self.router.complete(
+            self.completion,
+            self.build_messages(history, system_prompt, form_state),
+            response_format=CarInfo,
+            usage=usage,
+        )
 
-    async def generate_answer(self, history: list[Message]):
-        messages = [{"role": "system", "content": self.system_prompt}] + [
-            h.model_dump() for h in history
+    async def complete_fields(
+        self,
+        history: list[Message],
+        partial: dict,
+        missing: list[str],
+        usage: TokenUsage | None = None,
+    ) -> str | None:
+        # A short follow-up for the fields a reply left out: what is known of
+        # the form and the customer's last message, not the whole history
+        known = {**latest_form_state(history)}
+        known.update({f: partial[f] for f in FORM_FIELDS if partial.get(f)})
+        model = fields_model(missing)
+        messages = [
+            {
+                "role": "system",
+                "content": FOLLOW_UP_PROMPT.format(
+                    fields=", ".join(missing),
+                    known=json.dumps(known, separators=(",", ":")),
+                ),
+            }
         ]
-        api_response = await acompletion(
-            self.model, messages=messages, response_format=CarInfo
+        last = next((m for m in reversed(history) if m.role == "user"), None)
+        if last is not None:
+            messages.append({"role": "user", "content": last.content})
+        return await self.router.complete(
+            self.completion,
+            messages,
+            validate=validates(model),
+            response_format=model,
+            usage=usage,
         )
-        return api_response.choices[0].message.content  # type: ignore
 
 
 if __name__ == "__main__":
@@ -0,0 +1,227 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Protocol, Tuple
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from . import metrics
+from .context import estimate_tokens
+
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens")
+
+
+class RateLimited(Exception):
+    def __init__(self, scope: str, retry_after: int):
+        super().__init__(f"Rate limit for {scope} exceeded, retry after {retry_after}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class BudgetExhausted(Exception):
+    def __init__(self, session_id: str, used: int, budget: int):
+        super().__init__(f"Session {session_id} used {used} of {budget} tokens")
+        self.used = used
+        self.budget = budget
+
+
+@dataclass
+class TokenUsage:
+    # Tokens used by the model calls of one turn, as reported by litellm.
+    # Calls without usage data (some providers leave it out of streams) are
+    # estimated from the text, like compact_messages does.
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    calls: int = 0
+    estimated: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(
+        self, reported: Any, messages: List[Dict[str, Any]], text: Optional[str]
+    ) -> None:
+        if isinstance(reported, dict):
+            counts = [reported.get(f) for f in USAGE_FIELDS]
+        else:
+            counts = [getattr(reported, f, None) for f in USAGE_FIELDS]
+        if not all(isinstance(c, int) for c in counts):
+            counts = [estimate_tokens(messages), len(text or "") // 4]
+            self.estimated += 1
+        prompt_tokens, completion_tokens = counts
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.calls += 1
+        metrics.record_tokens(prompt_tokens, completion_tokens)
+
+
+class TokenBudget:
+    # Caps the tokens one session may use. The count is kept on the session
+    # document (tokens_used) and checked before each model call, so the call
+    # that crosses the budget still finishes and the next one is refused.
+    def __init__(self, session_tokens: int):
+        self.session_tokens = session_tokens
+        self.exhausted = 0
+
+    def check(self, session_id: str, used: int) -> None:
+        if used >= self.session_tokens:
+            self.exhausted += 1
+            metrics.record_budget_exhausted()
+            raise BudgetExhausted(session_id, used, self.session_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"session_tokens": self.session_tokens, "exhausted": self.exhausted}
+
+
+def refill(
+    tokens: float, updated: float, rate: float, burst: float, now: float
+) -> float:
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+def take(tokens: float, rate: float) -> Tuple[float, float]:
+    # Returns the tokens left and, when none could be taken, how long until
+    # one is available
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class RateLimitBackend(Protocol):
+    async def take(self, key: str, rate: float, burst: float, now: float) -> float: ...
+
+
+class MemoryBackend:
+    # Buckets for this worker only. The least recently used are dropped past
+    # max_keys; a dropped bucket would have refilled by then in most cases.
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        bucket = self.buckets.get(key)
+        tokens = burst if bucket is None else refill(*bucket, rate, burst, now)
+        tokens, wait = take(tokens, rate)
+        self.buckets[key] = (tokens, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return wait
+
+
+class MongoBackend:
+    # Buckets shared by every worker. Each bucket is one document updated
+    # with compare-and-set on its version; a bucket still contended after
+    # max_attempts lets the turn through. Full buckets expire through the TTL
+    # index, since a missing bucket counts as full.
+    def __init__(self, collection, max_attempts: int = 5):
+        self.collection = collection
+        self.max_attempts = max_attempts
+        self.contended = 0
+
+    async def ensure_indexes(self) -> None:
+        await self.collection.create_index(
+            [("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0
+        )
+
+    async def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=burst / rate)
+        for _ in range(self.max_attempts):
+            bucket = await self.collection.find_one({"_id": key})
+            if bucket is None:
+                tokens, wait = take(burst, rate)
+                try:
+                    await self.collection.insert_one(
+                        {
+                            "_id": key,
+                            "tokens": tokens,
+                            "updated": now,
+                            "version": 0,
+                            "expires_at": expires_at,
+                        }
+                    )
+                except DuplicateKeyError:
+                    continue
+                return wait
+            tokens = refill(bucket["tokens"], bucket["updated"], rate, burst, now)
+            tokens, wait = take(tokens, rate)
+            if wait:
+                return wait
+            result = await self.collection.update_one(
+                {"_id": key, "version": bucket["version"]},
+                {
+                    "$set": {
+                        "tokens": tokens,
+                        "updated": now,
+                        "expires_at": expires_at,
+                    },
+                    "$inc": {"version": 1},
+                },
+            )
+            if result.matched_count:
+                return 0.0
+        self.contended += 1
+        return 0.0
+
+
+class RateLimiter:
+    # Token buckets per client address and per session: each turn takes a
+    # token from both, and they refill at *_turns_per_minute up to *_burst.
+    # Turns over either limit are refused with the time until the bucket has
+    # a token again. Backend errors let the turn through.
+    def __init__(
+        self,
+        backend: RateLimitBackend,
+        client_turns_per_minute: float = 30,
+        client_burst: int = 20,
+        session_turns_per_minute: float = 10,
+        session_burst: int = 10,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.backend = backend
+        self.limits = {
+            "client": (client_turns_per_minute / 60, client_burst),
+            "session": (session_turns_per_minute / 60, session_burst),
+        }
+        self.clock = clock
+        self.allowed = 0
+        self.limited = {scope: 0 for scope in self.limits}
+        self.errors = 0
+
+    async def check(self, client: str, session_id: Optional[str]) -> None:
+        keys = [("client", client)]
+        # A new session has no id yet, so only its client is limited
+        if session_id:
+            keys.append(("session", session_id))
+        for scope, key in keys:
+            rate, burst = self.limits[scope]
+            try:
+                wait = await self.backend.take(
+                    f"{scope}:{key}", rate, burst, self.clock()
+                )
+            except PyMongoError as e:
+                logging.error(f"Database error while checking the rate limit: {e}")
+                self.errors += 1
+                continue
+            if wait:
+                self.limited[scope] += 1
+                metrics.record_rate_limited(scope)
+                raise RateLimited(scope, max(1, math.ceil(wait)))
+        self.allowed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "allowed": self.allowed,
+            "limited": dict(self.limited),
+            "errors": self.errors,
+        }
+        if isinstance(self.backend, MemoryBackend):
+            stats["buckets"] = len(self.backend.buckets)
+        else:
+            stats["contended"] = self.backend.contended
+        return stats
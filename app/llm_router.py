@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from .response_parser import usable_reply
+
+if TYPE_CHECKING:
+    from .limits import TokenUsage
+
+
+class RouterExhausted(Exception):
+    pass
+
+
+def validates(model) -> Callable[[Optional[str]], bool]:
+    def validate(content: Optional[str]) -> bool:
+        if not content:
+            return False
+        try:
+            model.model_validate_json(content)
+        except ValidationError:
+            return False
+        return True
+
+    return validate
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures and lets a single
+    # trial request through once reset_seconds have passed
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        reset_seconds: float = 30,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def available(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.trial_running)
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = self.clock()
+
+
+@dataclass
+class ModelRoute:
+    model: str
+    timeout_seconds: float = 30
+    # Extra litellm arguments for this model, e.g. api_base or api_key
+    params: Dict[str, Any] = field(default_factory=dict)
+    index: int = 0
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+    ewma: Optional[float] = None
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=100))
+    calls: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    invalid: int = 0
+    hedges: int = 0
+    wins: int = 0
+
+    def p95(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[max(0, int(len(ordered) * 0.95) - 1)]
+
+
+class LLMRouter:
+    # Sends each request to the healthy model with the lowest latency EWMA;
+    # models without samples go first so they get measured, and the configured
+    # order breaks ties. If the model hasn't answered within its p95 (or
+    # hedge_after_seconds until it has min_samples), the next model is asked
+    # as well and the first usable reply wins, one the response parser can
+    # repair counting as usable. When every model asked so far has failed,
+    # timed out or sent an unusable reply, the next one is asked straight
+    # away.
+    def __init__(
+        self,
+        routes: List[ModelRoute],
+        hedging: bool = True,
+        hedge_after_seconds: float = 2.0,
+        min_samples: int = 20,
+        ewma_alpha: float = 0.2,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if not routes:
+            raise ValueError("At least one model route is required")
+        for index, route in enumerate(routes):
+            route.index = index
+        self.routes = routes
+        self.hedging = hedging
+        self.hedge_after = hedge_after_seconds
+        self.min_samples = min_samples
+        self.ewma_alpha = ewma_alpha
+        self.clock = clock
+
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any]) -> "LLMRouter":
+        routes = [
+            ModelRoute(
+                model=entry["model"],
+                timeout_seconds=entry.get("timeout_seconds", 30),
+                params=entry.get("params", {}),
+                breaker=CircuitBreaker(
+                    failure_threshold=settings["failure_threshold"],
+                    reset_seconds=settings["reset_seconds"],
+                ),
+            )
+            for entry in settings["models"]
+        ]
+        return cls(
+            routes,
+            hedging=settings["hedging"],
+            hedge_after_seconds=settings["hedge_after_seconds"],
+            min_samples=settings["min_samples"],
+            ewma_alpha=settings["ewma_alpha"],
+        )
+
+    def ranked(self) -> List[ModelRoute]:
+        return sorted(
+            self.routes,
+            key=lambda r: (r.ewma if r.ewma is not None else 0.0, r.index),
+        )
+
+    def hedge_delay(self, route: ModelRoute) -> float:
+        if len(route.latencies) >= self.min_samples:
+            return route.p95()
+        return self.hedge_after
+
+    def _record_latency(self, route: ModelRoute, latency: float) -> None:
+        route.latencies.append(latency)
+        if route.ewma is None:
+            route.ewma = latency
+        else:
+            route.ewma += self.ewma_alpha * (latency - route.ewma)
+
+    async def _attempt(
+        self,
+        route: ModelRoute,
+        completion,
+        messages,
+        validate,
+        kwargs,
+        usage: Optional["TokenUsage"],
+    ) -> Tuple[Optional[str], bool]:
+        route.calls += 1
+        start = self.clock()
+        try:
+            response = await asyncio.wait_for(
+                completion(route.model, messages=messages, **route.params, **kwargs),
+                route.timeout_seconds,
+            )
+        except asyncio.TimeoutError:
+            route.timeouts += 1
+            route.breaker.record_failure()
+            logging.warning(f"Model {route.model} timed out")
+            raise
+        except asyncio.CancelledError:
+            # Lost a hedge race, which says nothing about the model's health
+            route.breaker.trial_running = False
+            raise
+        except Exception as e:
+            route.failures += 1
+            route.breaker.record_failure()
+            logging.warning(f"Model {route.model} failed: {e}")
+            raise
+        self._record_latency(route, self.clock() - start)
+        content = response.choices[0].message.content
+        if usage is not None:
+            # Every answered call counts, including hedges that lose the race
+            usage.add(getattr(response, "usage", None), messages, content)
+        if not validate(content):
+            route.invalid += 1
+            # The model answered, so its breaker stays closed
+            route.breaker.record_success()
+            logging.warning(f"Model {route.model} returned an invalid response")
+            return content, False
+        route.breaker.record_success()
+        return content, True
+
+    async def complete(
+        self,
+        completion,
+        messages: List[Dict[str, Any]],
+        validate: Callable[[Optional[str]], bool] = usable_reply,
+        usage: Optional["TokenUsage"] = None,
+        **kwargs,
+    ) -> Optional[str]:
+        candidates = [r for r in self.ranked() if r.breaker.available()]
+        running: Dict[asyncio.Task, ModelRoute] = {}
+        fallback: Optional[str] = None
+
+        def launch() -> Optional[ModelRoute]:
+            while candidates:
+                route = candidates.pop(0)
+                if route.breaker.allow():
+                    task = asyncio.create_task(
+                        self._attempt(
+                            route, completion, messages, validate, kwargs, usage
+                        )
+                    )
+                    running[task] = route
+                    return route
+            return None
+
+        latest = launch()
+        if latest is None:
+            raise RouterExhausted("Every model's circuit breaker is open")
+        try:
+            while running:
+                timeout = None
+                if self.hedging and candidates:
+                    timeout = self.hedge_delay(latest)
+                done, _ = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedge = launch()
+                    if hedge is not None:
+                        hedge.hedges += 1
+                        latest = hedge
+                    continue
+                for task in done:
+                    route = running.pop(task)
+                    if task.exception() is None:
+                        content, valid = task.result()
+                        if valid:
+                            route.wins += 1
+                            return content
+                        fallback = fallback or content
+                if not running:
+                    latest = launch() or latest
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+        if fallback is not None:
+            # Nothing validated; let the caller report the reply it can't use
+            return fallback
+        raise RouterExhausted("No model returned a response")
+
+    async def open_stream(self, completion, messages: List[Dict[str, Any]], **kwargs):
+        # Streams can't be hedged, so only fail over while opening one
+        for route in self.ranked():
+            if not route.breaker.allow():
+                continue
+            route.calls += 1
+            try:
+                stream = await asyncio.wait_for(
+                    completion(
+                        route.model, messages=messages, **route.params, **kwargs
+                    ),
+                    route.timeout_seconds,
+                )
+            except Exception as e:
+                route.failures += 1
+                route.breaker.record_failure()
+                logging.warning(f"Model {route.model} failed to open a stream: {e}")
+                continue
+            route.breaker.record_success()
+            return stream
+        raise RouterExhausted("No model could open a response stream")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            route.model: {
+                "state": route.breaker.state,
+                "ewma_seconds": route.ewma,
+                "p95_seconds": route.p95(),
+                "calls": route.calls,
+                "wins": route.wins,
+                "hedges": route.hedges,
+                "failures": route.failures,
+                "timeouts": route.timeouts,
+                "invalid": route.invalid,
+            }
+            for route in self.routes
+        }
@@ -0,0 +1,124 @@
+import os
+import time
+from contextlib import nullcontext
+from typing import Any, Dict
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+STAGE_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+stage_seconds = Histogram(
+    "chat_stage_seconds",
+    "Time spent in each stage of a chat turn",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+chat_errors = Counter(
+    "chat_errors_total", "Chat requests that failed, by cause", ["kind"]
+)
+llm_tokens = Counter(
+    "chat_llm_tokens_total", "Tokens used by model calls, by kind", ["kind"]
+)
+rate_limited = Counter(
+    "chat_rate_limited_total", "Turns refused by a rate limit, by scope", ["scope"]
+)
+budget_exhausted = Counter(
+    "chat_token_budget_exhausted_total",
+    "Model calls refused because the session used up its token budget",
+)
+
+enabled = True
+_stages: Dict[str, Any] = {}
+_disabled = nullcontext()
+
+
+class _StageTimer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+def configure(settings: Dict[str, Any]) -> None:
+    global enabled
+    enabled = settings["enabled"]
+
+
+def stage(name: str):
+    if not enabled:
+        return _disabled
+    histogram = _stages.get(name)
+    if histogram is None:
+        histogram = _stages[name] = stage_seconds.labels(name)
+    return _StageTimer(histogram)
+
+
+def record_error(kind: str) -> None:
+    if enabled:
+        chat_errors.labels(kind).inc()
+
+
+def record_tokens(prompt_tokens: int, completion_tokens: int) -> None:
+    if enabled:
+        llm_tokens.labels("prompt").inc(prompt_tokens)
+        llm_tokens.labels("completion").inc(completion_tokens)
+
+
+def record_rate_limited(scope: str) -> None:
+    if enabled:
+        rate_limited.labels(scope).inc()
+
+
+def record_budget_exhausted() -> None:
+    if enabled:
+        budget_exhausted.inc()
+
+
+def multiprocess_mode() -> bool:
+    # uvicorn workers each keep their own metrics; with this set they are
+    # written to shared files and summed on every scrape
+    return bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def render() -> bytes:
+    if multiprocess_mode():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead() -> None:
+    if multiprocess_mode():
+        multiprocess.mark_process_dead(os.getpid())
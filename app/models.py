@@ -5,15 +5,24 @@ from datetime import datetime
 
 class Record(BaseModel):
     licence_plate: str
+    licence_plate_normalized: str
     form_data: Dict[str, Union[str, bool]]
-    prompt_used: str
-    created_at: datetime = Field(default=datetime.now())
-    updated_at: datetime = Field(default=datetime.now())
+    # Id of the system prompt in the prompts collection, see app/prompts.py
+    prompt_version: str
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
 
 
 class ChatRequest(BaseModel):
     session_id: str | None
     message: str
+    # Same as the Idempotency-Key header, for clients that can't set headers
+    idempotency_key: str | None = None
+
+
+class ChatSocketMessage(BaseModel):
+    # A turn over /chat/ws, whose session is bound to the connection
+    message: str
 
 
 class ChatResponse(BaseModel):
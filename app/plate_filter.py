@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import logging
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from bson import ObjectId
+
+from .sessions import normalize_plate
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError("capacity must be positive and error_rate in (0, 1)")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item: str) -> None:
+        added = False
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.bits)
+
+    def estimated_error_rate(self) -> float:
+        return (
+            1 - math.exp(-self.num_hashes * self.count / self.num_bits)
+        ) ** self.num_hashes
+
+
+class PlateFilter:
+    # Answers "definitely not stored" for licence plates without a MongoDB
+    # round trip. Plates saved by other workers reach this process only on the
+    # next sync, so a negative answer can be briefly wrong; the unique index
+    # on the normalized plate still rejects the duplicate insert in that case.
+    def __init__(
+        self,
+        capacity: int = 1_000_000,
+        error_rate: float = 0.01,
+        sync_overlap_seconds: float = 60,
+    ):
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.sync_overlap = timedelta(seconds=sync_overlap_seconds)
+        self.ready = False
+        self.last_sync: Optional[datetime] = None
+        self.definite_misses = 0
+        self.possible_hits = 0
+        self.false_positives = 0
+        self.not_ready = 0
+
+    def reset(self) -> None:
+        self.bloom = BloomFilter(self.bloom.capacity, self.bloom.error_rate)
+        self.ready = False
+        self.last_sync = None
+
+    def add(self, licence_plate: str) -> None:
+        normalized = normalize_plate(licence_plate)
+        if normalized:
+            self.bloom.add(normalized)
+
+    def might_contain(self, licence_plate: str) -> bool:
+        if not self.ready:
+            self.not_ready += 1
+            return True
+        if normalize_plate(licence_plate) in self.bloom:
+            self.possible_hits += 1
+            return True
+        self.definite_misses += 1
+        return False
+
+    def record_lookup(self, found: bool) -> None:
+        if self.ready and not found:
+            self.false_positives += 1
+
+    async def sync(self, records) -> int:
+        query = {}
+        started = datetime.now(timezone.utc)
+        if self.last_sync is not None:
+            since = self.last_sync - self.sync_overlap
+            query = {"_id": {"$gte": ObjectId.from_datetime(since)}}
+        loaded = 0
+        cursor = records.find(
+            query, {"_id": 0, "licence_plate": 1, "licence_plate_normalized": 1}
+        )
+        async for doc in cursor:
+            self.add(
+                doc.get("licence_plate_normalized") or doc.get("licence_plate", "")
+            )
+            loaded += 1
+        self.last_sync = started
+        self.ready = True
+        return loaded
+
+    async def run(self, records, interval_seconds: float) -> None:
+        while True:
+            try:
+                loaded = await self.sync(records)
+                logging.info(f"Plate filter synced {loaded} records")
+            except Exception as e:
+                logging.error(f"Error while syncing the plate filter: {e}")
+            await asyncio.sleep(interval_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "plates": self.bloom.count,
+            "capacity": self.bloom.capacity,
+            "size_bytes": self.bloom.size_bytes,
+            "hash_functions": self.bloom.num_hashes,
+            "configured_error_rate": self.bloom.error_rate,
+            "estimated_error_rate": self.bloom.estimated_error_rate(),
+            "definite_misses": self.definite_misses,
+            "possible_hits": self.possible_hits,
+            "false_positives": self.false_positives,
+            "not_ready": self.not_ready,
+        }
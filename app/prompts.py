@@ -0,0 +1,177 @@
+# System prompts by version. A version is the hash of the prompt text, so
+# every worker derives the same id for the same config.yaml without
+# coordinating. Records and sessions keep the version, and the text is stored
+# once in the prompts collection:
+#
+#   python -m app.prompts --migrate
+#
+# moves records written before versions existed from the full prompt text in
+# prompt_used to a prompt_version.
+import argparse
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
+
+from . import db
+
+
+def prompt_version(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+@dataclass(frozen=True)
+class Prompt:
+    version: str
+    text: str
+
+
+async def save_prompt(prompts, prompt: Prompt) -> None:
+    await prompts.update_one(
+        {"_id": prompt.version},
+        {"$setOnInsert": {"text": prompt.text, "created_at": datetime.now()}},
+        upsert=True,
+    )
+
+
+class PromptRegistry:
+    # New sessions get the current prompt. Sessions keep the version they
+    # started with, so a prompt changed mid-conversation only affects new
+    # ones; the last `retain` versions are kept in memory for them and older
+    # ones are read back from the prompts collection.
+    def __init__(self, text: str, prompts=None, retain: int = 8):
+        self.prompts = prompts
+        self.retain = retain
+        self._versions: "OrderedDict[str, Prompt]" = OrderedDict()
+        self.current = self._remember(Prompt(prompt_version(text), text))
+        self.published = 0
+        self.loaded = 0
+        self.missing = 0
+
+    def _remember(self, prompt: Prompt) -> Prompt:
+        self._versions[prompt.version] = prompt
+        self._versions.move_to_end(prompt.version)
+        while len(self._versions) > self.retain:
+            self._versions.popitem(last=False)
+        return prompt
+
+    async def save(self, prompt: Prompt) -> None:
+        if self.prompts is None:
+            return
+        try:
+            await save_prompt(self.prompts, prompt)
+        except PyMongoError as e:
+            logging.error(f"Database error while saving prompt {prompt.version}: {e}")
+
+    async def publish(self, text: str) -> Prompt:
+        version = prompt_version(text)
+        if version == self.current.version:
+            return self.current
+        # Saved before it is used, so records never point at an unknown prompt
+        prompt = Prompt(version, text)
+        await self.save(prompt)
+        self.current = self._remember(prompt)
+        self.published += 1
+        logging.info(f"Now using system prompt {version}")
+        return prompt
+
+    async def get(self, version: Optional[str]) -> Prompt:
+        # Sessions from before prompts were versioned have no version
+        if version is None:
+            return self.current
+        prompt = self._versions.get(version)
+        if prompt is not None:
+            return prompt
+        document = None
+        if self.prompts is not None:
+            try:
+                document = await self.prompts.find_one({"_id": version})
+            except PyMongoError as e:
+                logging.error(f"Database error while loading prompt {version}: {e}")
+        if document is None:
+            self.missing += 1
+            logging.warning(f"Unknown prompt {version}, using the current one")
+            return self.current
+        self.loaded += 1
+        prompt = Prompt(version, document["text"])
+        # Kept behind the current prompt so it is the first to be dropped
+        self._versions[version] = prompt
+        self._versions.move_to_end(version, last=False)
+        return prompt
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "current": self.current.version,
+            "retained": list(self._versions),
+            "published": self.published,
+            "loaded": self.loaded,
+            "missing": self.missing,
+        }
+
+
+async def migrate_records(records, prompts, batch_size: int = 1000) -> int:
+    # Replaces prompt_used with prompt_version, one batch at a time. A batch
+    # usually holds a handful of prompts, so it is one update per prompt.
+    migrated = 0
+    while True:
+        batch = (
+            await records.find({"prompt_used": {"$exists": True}}, {"prompt_used": 1})
+            .limit(batch_size)
+            .to_list(None)
+        )
+        if not batch:
+            return migrated
+        by_prompt: Dict[str, list] = {}
+        for record in batch:
+            by_prompt.setdefault(record["prompt_used"], []).append(record["_id"])
+        for text, ids in by_prompt.items():
+            prompt = Prompt(prompt_version(text), text)
+            await save_prompt(prompts, prompt)
+            await records.update_many(
+                {"_id": {"$in": ids}},
+                {
+                    "$set": {"prompt_version": prompt.version},
+                    "$unset": {"prompt_used": ""},
+                },
+            )
+        migrated += len(batch)
+        logging.info(f"Migrated {migrated} records")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="System prompt versions")
+    parser.add_argument("--uri", default=db.get_mongo_uri())
+    parser.add_argument("--database", default="chatbot")
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="replace prompt_used in records with prompt_version",
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    return parser.parse_args(argv)
+
+
+async def main(args) -> None:
+    client = AsyncIOMotorClient(args.uri)
+    database = client[args.database]
+    try:
+        if args.migrate:
+            migrated = await migrate_records(
+                database.records, database.prompts, args.batch_size
+            )
+            print(f"{migrated} records migrated")
+        async for prompt in database.prompts.find().sort("created_at", 1):
+            print(prompt["_id"], prompt["created_at"].isoformat())
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parse_args()))
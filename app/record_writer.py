@@ -0,0 +1,200 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.write_concern import WriteConcern
+
+from .cache import SessionCache
+from .models import Message
+from .sessions import SESSION_OPEN, build_record, duplicate_reply
+
+if TYPE_CHECKING:
+    from .plate_filter import PlateFilter
+
+DUPLICATE_KEY = 11000
+
+WRITE_CONCERNS = {
+    # Acknowledged once the insert is in the on-disk journal
+    "journaled": WriteConcern(w=1, j=True),
+    # Not acknowledged at all, so duplicates can't be reported back
+    "fire_and_forget": WriteConcern(w=0),
+}
+
+
+@dataclass
+class PendingRecord:
+    session_id: str
+    licence_plate: str
+    document: Dict[str, Any]
+
+
+class RecordWriter:
+    # Write-behind queue for completed forms. The customer is answered as soon
+    # as the record is queued; records are inserted in batches by a background
+    # task and on shutdown. A plate that turns out to be taken when the batch
+    # is written is reported on the session: its record_status becomes
+    # "duplicate" and the duplicate notice is appended to its history.
+    def __init__(
+        self,
+        records,
+        sessions,
+        max_batch: int = 100,
+        flush_interval_seconds: float = 0.05,
+        durability: str = "journaled",
+        max_pending: int = 10_000,
+        plate_filter: Optional["PlateFilter"] = None,
+        session_cache: Optional[SessionCache] = None,
+    ):
+        if durability not in WRITE_CONCERNS:
+            raise ValueError(f"durability must be one of {sorted(WRITE_CONCERNS)}")
+        self.records = records.database.get_collection(
+            records.name, write_concern=WRITE_CONCERNS[durability]
+        )
+        self.sessions = sessions
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval_seconds
+        self.durability = durability
+        self.max_pending = max_pending
+        self.plate_filter = plate_filter
+        self.session_cache = session_cache
+        self._pending: List[PendingRecord] = []
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.queued = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(
+        self, session_id: str, licence_plate: str, data: dict, prompt_version: str
+    ) -> None:
+        if len(self._pending) >= self.max_pending:
+            # MongoDB is falling behind, make this request wait for it
+            await self.flush()
+        self._pending.append(
+            PendingRecord(
+                session_id,
+                licence_plate,
+                build_record(licence_plate, data, prompt_version),
+            )
+        )
+        self.queued += 1
+        if self.plate_filter is not None:
+            self.plate_filter.add(licence_plate)
+        if len(self._pending) >= self.max_batch:
+            self._batch_ready.set()
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Unexpected error while flushing records: {e}")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+                await self._write(batch)
+
+    async def _write(self, batch: List[PendingRecord]) -> None:
+        self.batches += 1
+        duplicates: List[PendingRecord] = []
+        try:
+            await self.records.insert_many([p.document for p in batch], ordered=False)
+            saved = batch
+        except BulkWriteError as e:
+            failed = {}
+            for error in e.details.get("writeErrors", []):
+                failed[error["index"]] = error
+                if error.get("code") == DUPLICATE_KEY:
+                    duplicates.append(batch[error["index"]])
+                else:
+                    logging.error(f"Could not insert record: {error.get('errmsg')}")
+            self.failed += len(failed) - len(duplicates)
+            saved = [p for i, p in enumerate(batch) if i not in failed]
+        except PyMongoError as e:
+            # Put the batch back, the next flush retries it
+            logging.error(f"Database error while inserting {len(batch)} records: {e}")
+            self._pending[:0] = batch
+            raise
+
+        self.inserted += len(saved)
+        self.duplicates += len(duplicates)
+        if self.durability == "fire_and_forget":
+            return
+        try:
+            await self._report(saved, duplicates)
+        except PyMongoError as e:
+            logging.error(f"Database error while reporting record outcomes: {e}")
+
+    async def _report(
+        self, saved: List[PendingRecord], duplicates: List[PendingRecord]
+    ) -> None:
+        now = datetime.now()
+        if saved:
+            await self.sessions.update_many(
+                {"_id": {"$in": [p.session_id for p in saved]}},
+                {"$set": {"record_status": "saved", "updated_at": now}},
+            )
+        for pending in duplicates:
+            logging.info(
+                f"Record for licence plate {pending.licence_plate} already exists"
+            )
+            notice = Message(
+                role="assistant", content=duplicate_reply(pending.licence_plate)
+            )
+            await self.sessions.update_one(
+                {"_id": pending.session_id},
+                {
+                    "$push": {"history": notice.model_dump()},
+                    "$set": {
+                        "record_status": "duplicate",
+                        "status": SESSION_OPEN,
+                        "updated_at": now,
+                    },
+                    # Asked for again, see FormState.discard
+                    "$unset": {"form_state.licence_plate_number": ""},
+                    "$inc": {"turn": 1},
+                },
+            )
+            if self.session_cache is not None:
+                self.session_cache.invalidate(pending.session_id)
+
+    async def close(self) -> None:
+        # Stops the background task and writes everything still queued
+        self._closing = True
+        self._batch_ready.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except PyMongoError:
+            logging.error(f"{len(self._pending)} queued records were lost on shutdown")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "durability": self.durability,
+            "pending": len(self._pending),
+            "queued": self.queued,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
@@ -0,0 +1,242 @@
+# Replays stored conversations through InsuranceAgent to evaluate a prompt or
+# model change offline. For every completed session, the customer's messages
+# up to the turn that completed the form are sent again (with the original
+# assistant replies in between), and the form the agent extracts now is
+# compared with the record that was saved:
+#
+#   python -m app.replay --prompt new_prompt.txt --output replay.jsonl
+#
+# Sessions are read with a cursor and results are written as they finish, so
+# memory stays flat however many sessions are replayed.
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from . import db
+from .archive import decompress_history
+from .context import FORM_FIELDS
+from .insurance_agent import InsuranceAgent
+from .models import Message
+from .prompts import prompt_version
+from .response_parser import load_object
+from .sessions import SESSION_COMPLETE, normalize_plate
+
+
+class RateLimiter:
+    # Spaces calls at least 1/rate seconds apart across all workers
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def stream_sessions(
+    database, sources: List[str], limit: Optional[int]
+) -> AsyncIterator[Dict[str, Any]]:
+    # Completed sessions from the hot collection and the archive, one at a time
+    remaining = limit
+    for source in sources:
+        if remaining is not None and remaining <= 0:
+            return
+        collection = database[source]
+        cursor = collection.find({"status": SESSION_COMPLETE}, batch_size=100)
+        if remaining is not None:
+            cursor = cursor.limit(remaining)
+        async for session in cursor:
+            if isinstance(session.get("history"), bytes):
+                session["history"] = decompress_history(session["history"])
+            if remaining is not None:
+                remaining -= 1
+            yield session
+
+
+def completing_turn(
+    history: List[Dict[str, Any]],
+) -> Optional[Tuple[List[Message], Dict[str, Any]]]:
+    # The messages the agent saw when it completed the form, and its reply
+    for i in range(len(history) - 1, -1, -1):
+        if history[i].get("role") != "assistant":
+            continue
+        data, _ = load_object(history[i].get("content", ""))
+        if data and data.get("complete") is True:
+            return [Message.model_validate(m) for m in history[:i]], data
+    return None
+
+
+def comparable(field: str, value: Any) -> Any:
+    if not isinstance(value, str):
+        return value
+    if field == "licence_plate_number":
+        return normalize_plate(value)
+    return " ".join(value.split()).casefold()
+
+
+def diff_fields(
+    expected: Dict[str, Any], actual: Dict[str, Any]
+) -> Dict[str, Dict[str, Any]]:
+    return {
+        field: {"expected": expected.get(field), "actual": actual.get(field)}
+        for field in FORM_FIELDS
+        if comparable(field, expected.get(field))
+        != comparable(field, actual.get(field))
+    }
+
+
+async def replay_session(agent: InsuranceAgent, records, session) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"session_id": session["_id"]}
+    turn = completing_turn(session.get("history", []))
+    if turn is None:
+        return {**result, "status": "skipped", "reason": "no completing turn"}
+    history, original = turn
+    plate = original.get("licence_plate_number") or ""
+    # The plate finds the record through its unique index; the session id
+    # makes sure it is this session's and not a later one for the same car
+    record = await records.find_one(
+        {
+            "licence_plate_normalized": normalize_plate(plate),
+            "form_data.session_id": session["_id"],
+        }
+    )
+    if record is None:
+        return {**result, "status": "skipped", "reason": "no saved record"}
+    expected = record["form_data"]
+    # Records written before prompts were versioned have the full text
+    saved_version = record.get("prompt_version") or prompt_version(
+        record.get("prompt_used", "")
+    )
+    result["prompt_changed"] = saved_version != prompt_version(agent.system_prompt)
+
+    start = time.perf_counter()
+    try:
+        reply = await agent.respond(history)
+    except Exception as e:
+        return {**result, "status": "error", "error": str(e)}
+    result["latency_seconds"] = time.perf_counter() - start
+    actual, _ = load_object(reply or "")
+    if actual is None:
+        return {**result, "status": "error", "error": "reply is not a JSON object"}
+    differences = diff_fields(expected, actual)
+    return {
+        **result,
+        "status": "match" if not differences and actual.get("complete") else "diff",
+        "complete": actual.get("complete") is True,
+        "differences": differences,
+    }
+
+
+async def replay(
+    agent: InsuranceAgent,
+    database,
+    output: Path,
+    concurrency: int = 8,
+    rate: Optional[float] = None,
+    sources: Tuple[str, ...] = ("sessions", "sessions_archive"),
+    limit: Optional[int] = None,
+) -> Dict[str, Any]:
+    # A bounded queue between the cursor and the workers keeps at most a few
+    # sessions per worker in memory
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    limiter = RateLimiter(rate)
+    summary: Dict[str, Any] = {"sessions": 0, "field_differences": {}}
+
+    with open(output, "w") as out:
+
+        async def worker():
+            while True:
+                session = await queue.get()
+                if session is None:
+                    return
+                await limiter.wait()
+                try:
+                    result = await replay_session(agent, database["records"], session)
+                except Exception as e:
+                    # One unreadable session or failed lookup shouldn't end
+                    # the run
+                    logging.warning(f"Replaying session {session.get('_id')}: {e}")
+                    result = {
+                        "session_id": session.get("_id"),
+                        "status": "error",
+                        "error": str(e),
+                    }
+                out.write(json.dumps(result, default=str) + "\n")
+                out.flush()
+                summary["sessions"] += 1
+                summary[result["status"]] = summary.get(result["status"], 0) + 1
+                for field in result.get("differences", {}):
+                    counts = summary["field_differences"]
+                    counts[field] = counts.get(field, 0) + 1
+
+        # If a worker dies anyway (say the output can't be written), the task
+        # group cancels the cursor loop instead of leaving it blocked on a
+        # full queue
+        async with asyncio.TaskGroup() as group:
+            for _ in range(concurrency):
+                group.create_task(worker())
+            async for session in stream_sessions(database, list(sources), limit):
+                await queue.put(session)
+            for _ in range(concurrency):
+                await queue.put(None)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay stored sessions through the agent and diff the forms"
+    )
+    parser.add_argument("--uri", default=db.get_mongo_uri())
+    parser.add_argument("--database", default="chatbot")
+    parser.add_argument("--prompt", help="file with the system prompt to evaluate")
+    parser.add_argument("--output", default="replay.jsonl")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, help="max model calls per second")
+    parser.add_argument("--limit", type=int, help="replay at most this many")
+    parser.add_argument(
+        "--source",
+        choices=["sessions", "sessions_archive"],
+        action="append",
+        help="collections to read, both by default",
+    )
+    return parser.parse_args(argv)
+
+
+async def main(args) -> int:
+    agent = InsuranceAgent()
+    if args.prompt:
+        agent.system_prompt = Path(args.prompt).read_text()
+    client = AsyncIOMotorClient(args.uri)
+    try:
+        summary = await replay(
+            agent,
+            client[args.database],
+            Path(args.output),
+            concurrency=args.concurrency,
+            rate=args.rate,
+            sources=tuple(args.source or ("sessions", "sessions_archive")),
+            limit=args.limit,
+        )
+    finally:
+        client.close()
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,112 @@
+import base64
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import DESCENDING, ReadPreference
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primary_preferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondary_preferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+# Grouping keys for /reports/counts
+GROUPS = {
+    "car_type": "$form_data.car_type",
+    "brand": "$form_data.manufacturer_or_brand",
+    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+}
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+@dataclass
+class RecordFilter:
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    car_type: Optional[str] = None
+    brand: Optional[str] = None
+
+    def query(self) -> Dict[str, Any]:
+        query: Dict[str, Any] = {}
+        created_at = {}
+        if self.start is not None:
+            created_at["$gte"] = self.start
+        if self.end is not None:
+            created_at["$lt"] = self.end
+        if created_at:
+            query["created_at"] = created_at
+        if self.car_type is not None:
+            query["form_data.car_type"] = self.car_type
+        if self.brand is not None:
+            query["form_data.manufacturer_or_brand"] = self.brand
+        return query
+
+
+def encode_cursor(record: Dict[str, Any]) -> str:
+    position = [record["created_at"].isoformat(), str(record["_id"])]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    try:
+        created_at, record_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(created_at), ObjectId(record_id)
+    except Exception as e:
+        raise InvalidCursor(f"Invalid cursor: {e}")
+
+
+class RecordReports:
+    # Read side for ops reporting over the records collection. Pages are
+    # keyset paginated on (created_at, _id), newest first, so a deep page
+    # costs the same as the first; counts are grouped on the server. Reads
+    # can go to secondaries to keep reporting load off the primary.
+    def __init__(self, records, read_preference: str = "secondary_preferred"):
+        if read_preference not in READ_PREFERENCES:
+            raise ValueError(
+                f"read_preference must be one of {sorted(READ_PREFERENCES)}"
+            )
+        self.records = records.database.get_collection(
+            records.name, read_preference=READ_PREFERENCES[read_preference]
+        )
+
+    async def page(
+        self, filters: RecordFilter, limit: int = 100, cursor: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        query = filters.query()
+        if cursor is not None:
+            created_at, record_id = decode_cursor(cursor)
+            after = {
+                "$or": [
+                    {"created_at": {"$lt": created_at}},
+                    {"created_at": created_at, "_id": {"$lt": record_id}},
+                ]
+            }
+            query = {"$and": [query, after]} if query else after
+        documents = (
+            await self.records.find(query, {"prompt_used": 0})
+            .sort([("created_at", DESCENDING), ("_id", DESCENDING)])
+            .limit(limit + 1)
+            .to_list(None)
+        )
+        next_cursor = None
+        if len(documents) > limit:
+            documents = documents[:limit]
+            next_cursor = encode_cursor(documents[-1])
+        return documents, next_cursor
+
+    async def counts(self, filters: RecordFilter, by: str) -> List[Dict[str, Any]]:
+        pipeline = [
+            {"$match": filters.query()},
+            {"$group": {"_id": GROUPS[by], "count": {"$sum": 1}}},
+            {"$sort": {"count": -1, "_id": 1}},
+        ]
+        rows = await self.records.aggregate(pipeline).to_list(None)
+        return [{by: row["_id"], "count": row["count"]} for row in rows]
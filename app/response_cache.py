@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Protocol
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from .cache import LRUTTLCache
+from .models import Message
+
+
+class ResponseCacheBackend(Protocol):
+    async def get(self, key: str) -> Optional[Dict[str, Any]]: ...
+
+    async def set(self, key: str, entry: Dict[str, Any]) -> None: ...
+
+
+class MemoryBackend:
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.cache = LRUTTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.cache.get(key)
+
+    async def set(self, key: str, entry: Dict[str, Any]) -> None:
+        self.cache.put(key, entry)
+
+
+class MongoBackend:
+    # Shares cached responses between workers. MongoDB drops expired
+    # documents through the TTL index, the expiry check on read covers the
+    # minute or so before its background task gets to them.
+    def __init__(self, collection, ttl_seconds: float):
+        self.collection = collection
+        self.ttl = timedelta(seconds=ttl_seconds)
+
+    async def ensure_indexes(self) -> None:
+        await self.collection.create_index(
+            [("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0
+        )
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        doc = await self.collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+        )
+        if doc is None:
+            return None
+        return {"response": doc["response"], "latency": doc["latency"]}
+
+    async def set(self, key: str, entry: Dict[str, Any]) -> None:
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {**entry, "expires_at": datetime.now(timezone.utc) + self.ttl}},
+            upsert=True,
+        )
+
+
+def normalize_content(content: str) -> str:
+    return " ".join(content.lower().split()).rstrip(".!?")
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        backend: ResponseCacheBackend,
+        bypass_patterns: List[str],
+        max_messages: int = 1,
+    ):
+        self.backend = backend
+        self.bypass_patterns = [re.compile(p) for p in bypass_patterns]
+        self.max_messages = max_messages
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.errors = 0
+        self.saved_latency_seconds = 0.0
+
+    def key(self, model: str, system_prompt: str, history: List[Message]) -> str:
+        payload = json.dumps(
+            [model, system_prompt]
+            + [[h.role, normalize_content(h.content)] for h in history],
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def cacheable(self, history: List[Message]) -> bool:
+        if len(history) > self.max_messages:
+            return False
+        return not any(
+            pattern.search(h.content)
+            for h in history
+            if h.role == "user"
+            for pattern in self.bypass_patterns
+        )
+
+    async def get_or_compute(
+        self,
+        model: str,
+        system_prompt: str,
+        history: List[Message],
+        compute: Callable[[], Awaitable[str]],
+    ) -> str:
+        if not self.cacheable(history):
+            self.bypassed += 1
+            return await compute()
+
+        key = self.key(model, system_prompt, history)
+        try:
+            entry = await self.backend.get(key)
+        except PyMongoError as e:
+            logging.error(f"Database error while reading the response cache: {e}")
+            self.errors += 1
+            entry = None
+        if entry is not None:
+            self.hits += 1
+            self.saved_latency_seconds += entry["latency"]
+            return entry["response"]
+
+        self.misses += 1
+        start = time.perf_counter()
+        response = await compute()
+        if response:
+            try:
+                await self.backend.set(
+                    key,
+                    {"response": response, "latency": time.perf_counter() - start},
+                )
+            except PyMongoError as e:
+                logging.error(f"Database error while writing the response cache: {e}")
+                self.errors += 1
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "errors": self.errors,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_latency_seconds": self.saved_latency_seconds,
+        }
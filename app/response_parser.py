@@ -0,0 +1,198 @@
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import pydantic_core
+from pydantic import ValidationError, create_model
+
+from .context import FORM_FIELDS
+from .limits import TokenUsage
+from .models import CarInfo, Message
+from .service_exceptions import InvalidAgentResponse, MalformedAgentResponse
+
+# Every field optional, so a reply can be type checked before it's complete
+PartialCarInfo = create_model(
+    "PartialCarInfo",
+    **{
+        name: (Optional[info.annotation], None)
+        for name, info in CarInfo.model_fields.items()
+    },
+)
+
+
+def fields_model(fields: List[str]):
+    # The schema for a follow-up that only asks for these fields
+    return create_model(
+        "CarInfoFields",
+        **{name: (CarInfo.model_fields[name].annotation, ...) for name in fields},
+    )
+
+
+def strip_fences(raw: str) -> str:
+    text = raw.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text
+
+
+def load_object(raw: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+    # Returns the reply as a dict and whether it had to be repaired: code
+    # fences or prose around the object are dropped, and a reply cut off
+    # mid-object keeps the fields that were complete.
+    try:
+        data = pydantic_core.from_json(raw)
+        if isinstance(data, dict):
+            return data, False
+    except ValueError:
+        pass
+    text = strip_fences(raw)
+    start = text.find("{")
+    if start == -1:
+        return None, True
+    end = text.rfind("}")
+    if end > start:
+        try:
+            data = pydantic_core.from_json(text[start : end + 1])
+            if isinstance(data, dict):
+                return data, True
+        except ValueError:
+            pass
+    try:
+        data = pydantic_core.from_json(text[start:], allow_partial=True)
+    except ValueError:
+        return None, True
+    return (data, True) if isinstance(data, dict) else (None, True)
+
+
+def check_reply(
+    data: Dict[str, Any], required: List[str]
+) -> Tuple[Dict[str, Any], List[str]]:
+    # Drops values of the wrong type and lists the required fields that are
+    # missing or were dropped
+    try:
+        PartialCarInfo.model_validate(data)
+    except ValidationError as e:
+        invalid = {error["loc"][0] for error in e.errors() if error["loc"]}
+        data = {k: v for k, v in data.items() if k not in invalid}
+    return data, [f for f in required if data.get(f) in (None, "")]
+
+
+def usable_reply(raw: Optional[str]) -> bool:
+    # Whether parse can work with the reply: an object with at least one form
+    # field once repaired. Fields it still lacks are asked for by the short
+    # follow-up rather than a whole new call.
+    data, _ = load_object(raw or "")
+    if data is None:
+        return False
+    data, _ = check_reply(data, [])
+    return any(name in CarInfo.model_fields for name in data)
+
+
+Reprompt = Callable[
+    [List[Message], Dict[str, Any], List[str], Optional[TokenUsage]],
+    Awaitable[Optional[str]],
+]
+
+
+@dataclass
+class ParsedReply:
+    data: Dict[str, Any]
+    # The reply to keep in the history, re-serialized when it was repaired
+    content: str
+    repaired: bool = False
+    reprompted: List[str] = field(default_factory=list)
+
+
+class ResponseParser:
+    # Turns the agent's raw reply into a checked dict. Replies that are fenced
+    # or truncated are repaired locally; if a field the turn needs is still
+    # missing or invalid (the whole form once the reply says it's complete),
+    # the agent is asked for just those fields once, with a short prompt
+    # instead of the whole conversation. before_reprompt runs ahead of that
+    # call and may refuse it by raising.
+    def __init__(self, reprompt: Optional[Reprompt] = None):
+        self.reprompt = reprompt
+        self.parsed = 0
+        self.repaired = 0
+        self.reprompted = 0
+        self.reprompt_fixed = 0
+        self.malformed = 0
+        self.invalid = 0
+
+    async def parse(
+        self,
+        raw: str,
+        history: List[Message],
+        usage: Optional[TokenUsage] = None,
+        before_reprompt: Optional[Callable[[], None]] = None,
+    ) -> ParsedReply:
+        self.parsed += 1
+        data, repaired = load_object(raw)
+        if data is None:
+            self.malformed += 1
+            raise MalformedAgentResponse("The agent's reply is not a JSON object")
+        if repaired:
+            self.repaired += 1
+        parsed = ParsedReply(data, raw, repaired)
+        required = FORM_FIELDS if data.get("complete") is True else []
+        return await self.require(parsed, required, history, usage, before_reprompt)
+
+    async def require(
+        self,
+        parsed: ParsedReply,
+        required: List[str],
+        history: List[Message],
+        usage: Optional[TokenUsage] = None,
+        before_reprompt: Optional[Callable[[], None]] = None,
+    ) -> ParsedReply:
+        data, missing = check_reply(parsed.data, required)
+        reprompted = list(parsed.reprompted)
+        if missing and self.reprompt is not None:
+            if before_reprompt is not None:
+                before_reprompt()
+            self.reprompted += 1
+            reprompted += missing
+            data, missing = await self._reprompt(history, data, missing, usage)
+            if not missing:
+                self.reprompt_fixed += 1
+        if missing:
+            self.invalid += 1
+            raise InvalidAgentResponse(f"The agent's reply is missing {missing}")
+        changed = parsed.repaired or reprompted or data != parsed.data
+        content = json.dumps(data) if changed else parsed.content
+        return ParsedReply(data, content, parsed.repaired, reprompted)
+
+    async def _reprompt(
+        self,
+        history: List[Message],
+        data: Dict[str, Any],
+        missing: List[str],
+        usage: Optional[TokenUsage],
+    ) -> Tuple[Dict[str, Any], List[str]]:
+        try:
+            raw = await self.reprompt(history, data, missing, usage)
+        except Exception as e:
+            logging.warning(f"Follow-up for missing fields failed: {e}")
+            return data, missing
+        fields, _ = load_object(raw or "")
+        if not fields:
+            return data, missing
+        return check_reply({**data, **{f: fields.get(f) for f in missing}}, missing)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "parsed": self.parsed,
+            "repaired": self.repaired,
+            "reprompted": self.reprompted,
+            "reprompt_fixed": self.reprompt_fixed,
+            "malformed": self.malformed,
+            "invalid": self.invalid,
+            "repair_rate": (
+                (self.repaired + self.reprompt_fixed) / self.parsed
+                if self.parsed
+                else None
+            ),
+        }
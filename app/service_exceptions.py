@@ -4,3 +4,19 @@ class AgentNotAvailable(Exception):
 
 class NoResponseFromOpenAI(Exception):
     pass
+
+
+class SessionConflict(Exception):
+    pass
+
+
+class MalformedAgentResponse(Exception):
+    pass
+
+
+class InvalidAgentResponse(Exception):
+    pass
+
+
+class IdempotencyKeyReused(Exception):
+    pass
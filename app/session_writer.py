@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import PyMongoError
+
+from .cache import SessionCache
+from .models import Message
+from .sessions import SESSION_OPEN, add_session_tokens, append_session_messages
+
+
+@dataclass
+class PendingAppend:
+    messages: List[Message]
+    status: str
+    form_updates: Dict[str, Any]
+    tokens: int
+
+
+class SessionWriter:
+    # Write-behind appends for a session held by one WebSocket connection. A
+    # turn is answered as soon as its messages are queued; a background task
+    # writes them in order, and appends queued while a write is in flight go
+    # out together as one update. Once a write fails (e.g. the session was
+    # changed by another request) nothing more is written, and the error is
+    # raised from the next append or from flush.
+    def __init__(
+        self,
+        sessions,
+        session_id: str,
+        turn: int,
+        cache: Optional[SessionCache] = None,
+        max_pending: int = 8,
+    ):
+        self.sessions = sessions
+        self.session_id = session_id
+        self.cache = cache
+        # The session's turn once everything queued is written
+        self.turn = turn
+        self._written_turn = turn
+        # Holding appends back makes a connection whose writes fall behind
+        # wait for them before answering its next turn
+        self._queue: asyncio.Queue[PendingAppend] = asyncio.Queue(max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self.error: Optional[Exception] = None
+        self.appends = 0
+        self.writes = 0
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def append(
+        self,
+        messages: List[Message],
+        status: str = SESSION_OPEN,
+        form_updates: Optional[Dict[str, Any]] = None,
+        tokens: int = 0,
+    ) -> int:
+        if self.error is not None:
+            raise self.error
+        await self._queue.put(
+            PendingAppend(list(messages), status, form_updates or {}, tokens)
+        )
+        self.appends += 1
+        self.turn += 1
+        return self.turn
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                if self.error is None:
+                    await self._write(batch)
+                else:
+                    await self._keep_tokens(batch)
+            except Exception as e:
+                logging.error(f"Could not write session {self.session_id}: {e}")
+                self.error = e
+                await self._keep_tokens(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _keep_tokens(self, batch: List[PendingAppend]) -> None:
+        # The messages are dropped, but the tokens were spent
+        tokens = sum(pending.tokens for pending in batch)
+        if not tokens:
+            return
+        try:
+            await add_session_tokens(self.sessions, self.session_id, tokens, self.cache)
+        except PyMongoError:
+            # Logged by add_session_tokens; the write error is the one raised
+            pass
+
+    async def _write(self, batch: List[PendingAppend]) -> None:
+        messages: List[Message] = []
+        form_updates: Dict[str, Any] = {}
+        for pending in batch:
+            messages.extend(pending.messages)
+            # A field set and then discarded ends up unset
+            form_updates.update(pending.form_updates)
+        self._written_turn = await append_session_messages(
+            self.sessions,
+            session_id=self.session_id,
+            messages=messages,
+            turn=self._written_turn,
+            cache=self.cache,
+            status=batch[-1].status,
+            form_updates=form_updates,
+            turns=len(batch),
+            tokens=sum(pending.tokens for pending in batch),
+        )
+        self.writes += 1
+
+    async def flush(self) -> None:
+        await self._queue.join()
+        if self.error is not None:
+            raise self.error
+
+    async def close(self) -> None:
+        # Writes everything still queued, then stops the background task
+        try:
+            await self.flush()
+        finally:
+            if self._task is not None:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                self._task = None
@@ -1,21 +1,167 @@
+# Session history and record storage. Records saved before plates were
+# normalized have no licence_plate_normalized, so neither the duplicate check
+# nor the unique index sees them until
+#
+#   python -m app.sessions --backfill-plates
+#
+# has set it. Likewise sessions written before the status field existed
+# neither expire nor get archived until
+#
+#   python -m app.sessions --backfill-status
+#
+# has set it from their last reply.
+import argparse
+import asyncio
+import json
+import re
 import uuid
 from datetime import datetime
 from .models import Message, Record
-from typing import List, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
 import logging
-from pymongo.errors import PyMongoError
+from pydantic import TypeAdapter
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from . import db
+from .cache import SessionCache
+from .service_exceptions import SessionConflict
 
+if TYPE_CHECKING:
+    from .plate_filter import PlateFilter
 
-async def get_or_create_session(sessions, session_id: Union[str, None] = None):
+
+MESSAGE_LIST = TypeAdapter(List[Message])
+
+# Open sessions expire after a period without activity, complete ones (the
+# form was saved) are moved to the archive instead
+SESSION_OPEN = "open"
+SESSION_COMPLETE = "complete"
+
+
+class SessionHistory(list):
+    # Append-only list of Messages that keeps the dict form of each one. Stored
+    # history is validated once on load and its documents are reused as they
+    # are for the model payload and the cache; appended messages are dumped
+    # the first time their documents are needed. prompt_version is the system
+    # prompt the session started with, form_state the stored form fields (see
+    # app/form_state.py), None for sessions from before it was kept, and
+    # tokens_used the model tokens spent on it so far (see TokenBudget).
+    def __init__(
+        self,
+        messages=(),
+        turn: int = 0,
+        documents=(),
+        prompt_version: Optional[str] = None,
+        form_state: Optional[Dict[str, Any]] = None,
+        tokens_used: int = 0,
+    ):
+        super().__init__(messages)
+        self.turn = turn
+        self._documents: List[Dict[str, Any]] = list(documents)
+        self.prompt_version = prompt_version
+        self.form_state = form_state
+        self.tokens_used = tokens_used
+
+    @classmethod
+    def load(
+        cls,
+        documents: List[Dict[str, Any]],
+        turn: int = 0,
+        prompt_version: Optional[str] = None,
+        form_state: Optional[Dict[str, Any]] = None,
+        tokens_used: int = 0,
+    ) -> "SessionHistory":
+        return cls(
+            MESSAGE_LIST.validate_python(documents),
+            turn,
+            documents,
+            prompt_version,
+            form_state,
+            tokens_used,
+        )
+
+    def documents(self) -> List[Dict[str, Any]]:
+        if len(self._documents) < len(self):
+            self._documents.extend(m.model_dump() for m in self[len(self._documents) :])
+        return self._documents
+
+
+def message_documents(history: List[Message]) -> List[Dict[str, Any]]:
+    if isinstance(history, SessionHistory):
+        return history.documents()
+    return [m.model_dump() for m in history]
+
+
+def _turn_filter(session_id: str, turn: int) -> dict:
+    # Sessions written before the turn counter existed have no "turn" field.
+    if turn == 0:
+        return {"_id": session_id, "turn": {"$in": [0, None]}}
+    return {"_id": session_id, "turn": turn}
+
+
+async def _get_cached_history(
+    sessions, session_id: str, cache: SessionCache
+) -> Optional[SessionHistory]:
+    cached = cache.get(session_id)
+    if cached is None:
+        return None
+    if cache.versioned:
+        try:
+            current = await sessions.find_one({"_id": session_id}, {"turn": 1})
+        except PyMongoError as e:
+            logging.error(f"Database error during find_one version check: {e}")
+            raise
+        if current is None or current.get("turn", 0) != cached.turn:
+            cache.mark_stale(session_id)
+            return None
+    return SessionHistory(
+        cached.messages,
+        cached.turn,
+        cached.documents,
+        cached.prompt_version,
+        cached.form_state,
+        cached.tokens_used,
+    )
+
+
+async def get_or_create_session(
+    sessions,
+    session_id: Union[str, None] = None,
+    cache: Optional[SessionCache] = None,
+    prompt_version: Optional[str] = None,
+):
+    # prompt_version is recorded on a new session; an existing one keeps the
+    # version it was created with
     try:
         if session_id:
+            if cache is not None:
+                history = await _get_cached_history(sessions, session_id, cache)
+                if history is not None:
+                    return session_id, history
             try:
                 session = await sessions.find_one({"_id": session_id})
             except PyMongoError as e:
                 logging.error(f"Database error during find_one: {e}")
                 raise
             if session:
-                return session_id, session["history"]
+                history = SessionHistory.load(
+                    session["history"],
+                    turn=session.get("turn", 0),
+                    prompt_version=session.get("prompt_version"),
+                    form_state=session.get("form_state"),
+                    tokens_used=session.get("tokens_used", 0),
+                )
+                if cache is not None:
+                    cache.store(
+                        session_id,
+                        history.turn,
+                        history,
+                        history.documents(),
+                        history.prompt_version,
+                        history.form_state,
+                        history.tokens_used,
+                    )
+                return session_id, history
             else:
                 logging.info(
                     f"Requested non-existent session with id {session_id}. Creating a new one instead."
@@ -23,40 +169,250 @@ async def get_or_create_session(sessions, session_id: Union[str, None] = None):
 
         new_id = str(uuid.uuid4())
         try:
+            now = datetime.now()
             await sessions.insert_one(
-                {"_id": new_id, "history": [], "created_at": datetime.now()}
+                {
+                    "_id": new_id,
+                    "history": [],
+                    "turn": 0,
+                    "status": SESSION_OPEN,
+                    "prompt_version": prompt_version,
+                    "form_state": {},
+                    "tokens_used": 0,
+                    "created_at": now,
+                    "updated_at": now,
+                }
             )
         except PyMongoError as e:
             logging.error(f"Database error during insert_one: {e}")
             raise
-        return new_id, []
+        if cache is not None:
+            cache.store(new_id, 0, [], [], prompt_version, {})
+        return new_id, SessionHistory(prompt_version=prompt_version, form_state={})
     except Exception as e:
         logging.error(f"Unexpected error in get_or_create_session: {e}")
         raise
 
 
-async def update_session(sessions, session_id: str, history: List[Message]):
+async def append_session_messages(
+    sessions,
+    session_id: str,
+    messages: List[Message],
+    turn: int,
+    cache: Optional[SessionCache] = None,
+    status: str = SESSION_OPEN,
+    form_updates: Optional[Dict[str, Any]] = None,
+    turns: int = 1,
+    tokens: int = 0,
+) -> int:
+    # form_updates are the form state fields that changed this turn, None
+    # for a field that was discarded, and tokens the model tokens the turn
+    # used. turns > 1 writes the messages of that many turns in one update,
+    # see SessionWriter.
+    documents = message_documents(messages)
+    form_updates = form_updates or {}
+    fields = {f"form_state.{k}": v for k, v in form_updates.items() if v is not None}
+    update = {
+        "$push": {"history": {"$each": documents}},
+        "$set": {"updated_at": datetime.now(), "status": status, **fields},
+        "$inc": {"turn": turns, "tokens_used": tokens},
+    }
+    removed = {f"form_state.{k}": "" for k, v in form_updates.items() if v is None}
+    if removed:
+        update["$unset"] = removed
     try:
-        await sessions.update_one(
-            {"_id": session_id},
+        result = await sessions.update_one(_turn_filter(session_id, turn), update)
+    except PyMongoError as e:
+        logging.error(
+            f"Database error during update_one in append_session_messages: {e}"
+        )
+        if cache is not None:
+            cache.invalidate(session_id)
+        raise
+    except Exception as e:
+        logging.error(f"Unexpected error in append_session_messages: {e}")
+        if cache is not None:
+            cache.invalidate(session_id)
+        raise
+    if result.matched_count == 0:
+        logging.warning(
+            f"Session {session_id} is no longer at turn {turn}, refusing to append."
+        )
+        if cache is not None:
+            cache.mark_stale(session_id)
+        raise SessionConflict(f"Session {session_id} was modified concurrently")
+    if cache is not None:
+        cache.extend(
+            session_id, turn, turn + turns, messages, documents, form_updates, tokens
+        )
+    return turn + turns
+
+
+async def reopen_session(
+    sessions,
+    session_id: str,
+    turn: int,
+    history_length: int,
+    cache: Optional[SessionCache] = None,
+) -> int:
+    # Takes back a turn that was written as completing the form when its
+    # record couldn't be saved: the history is cut back to history_length
+    # messages and the session is open again
+    if cache is not None:
+        cache.invalidate(session_id)
+    try:
+        result = await sessions.update_one(
+            _turn_filter(session_id, turn),
             {
-                "$set": {
-                    "history": [h.model_dump() for h in history],
-                    "updated_at": datetime.now(),
-                }
+                "$push": {"history": {"$each": [], "$slice": history_length}},
+                "$set": {"updated_at": datetime.now(), "status": SESSION_OPEN},
+                "$inc": {"turn": 1},
             },
         )
     except PyMongoError as e:
-        logging.error(f"Database error during update_one: {e}")
+        logging.error(f"Database error during update_one in reopen_session: {e}")
         raise
-    except Exception as e:
-        logging.error(f"Unexpected error in update_session: {e}")
+    if result.matched_count == 0:
+        raise SessionConflict(f"Session {session_id} was modified concurrently")
+    return turn + 1
+
+
+async def add_session_tokens(
+    sessions, session_id: str, tokens: int, cache: Optional[SessionCache] = None
+) -> None:
+    # Counts the tokens of a turn whose messages weren't written, e.g. the
+    # agent's reply was unusable or the append was refused. Not guarded by
+    # the turn, since it changes nothing another turn relies on.
+    if cache is not None:
+        cache.invalidate(session_id)
+    try:
+        await sessions.update_one(
+            {"_id": session_id}, {"$inc": {"tokens_used": tokens}}
+        )
+    except PyMongoError as e:
+        logging.error(f"Database error during update_one in add_session_tokens: {e}")
         raise
 
 
-async def detect_duplicate(records, licence_plate: str) -> bool:
+def normalize_plate(licence_plate: str) -> str:
+    return re.sub(r"[^0-9A-Za-z]", "", licence_plate).upper()
+
+
+async def _backfill_plate(records, record: dict) -> str:
+    normalized = normalize_plate(record.get("licence_plate") or "")
+    if not normalized:
+        return "skipped"
     try:
-        existing = await records.find_one({"licence_plate": licence_plate})
+        await records.update_one(
+            {"_id": record["_id"]}, {"$set": {"licence_plate_normalized": normalized}}
+        )
+    except DuplicateKeyError:
+        # Another record already has this plate; left for an operator to
+        # merge, it is still found by its raw plate
+        logging.warning(
+            f"Record {record['_id']} duplicates plate {normalized}, not backfilled"
+        )
+        return "duplicates"
+    return "backfilled"
+
+
+async def backfill_normalized_plates(records, batch_size: int = 1000) -> dict:
+    # Sets licence_plate_normalized on records written before it existed,
+    # one batch at a time in _id order, so records that can't be backfilled
+    # aren't read again
+    counts = {"backfilled": 0, "duplicates": 0, "skipped": 0}
+    last_id = None
+    while True:
+        query: Dict[str, Any] = {"licence_plate_normalized": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = (
+            await records.find(query, {"licence_plate": 1})
+            .sort("_id", 1)
+            .limit(batch_size)
+            .to_list(None)
+        )
+        if not batch:
+            return counts
+        for outcome in await asyncio.gather(
+            *(_backfill_plate(records, record) for record in batch)
+        ):
+            counts[outcome] += 1
+        last_id = batch[-1]["_id"]
+        logging.info(f"Backfilled {counts['backfilled']} records")
+
+
+def _last_reply_status(history: List[dict]) -> str:
+    # A completed session ends with the model's reply that set complete; a
+    # duplicate notice or a question after it leaves the session open
+    for message in reversed(history):
+        if message.get("role") != "assistant":
+            continue
+        try:
+            data = json.loads(message.get("content") or "")
+        except json.JSONDecodeError:
+            return SESSION_OPEN
+        if isinstance(data, dict) and data.get("complete") is True:
+            return SESSION_COMPLETE
+        return SESSION_OPEN
+    return SESSION_OPEN
+
+
+async def backfill_session_status(sessions, batch_size: int = 1000) -> dict:
+    # Sets status on sessions written before it existed, which otherwise match
+    # neither the TTL index nor the archiver. Batches are read in _id order
+    # like backfill_normalized_plates; the update only applies while status is
+    # still missing, so a turn written meanwhile keeps its own.
+    counts = {SESSION_OPEN: 0, SESSION_COMPLETE: 0}
+    last_id = None
+    while True:
+        query: Dict[str, Any] = {"status": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = (
+            await sessions.find(query, {"history": 1})
+            .sort("_id", 1)
+            .limit(batch_size)
+            .to_list(None)
+        )
+        if not batch:
+            return counts
+        statuses = [_last_reply_status(s.get("history") or []) for s in batch]
+        await asyncio.gather(
+            *(
+                sessions.update_one(
+                    {"_id": session["_id"], "status": {"$exists": False}},
+                    {"$set": {"status": status}},
+                )
+                for session, status in zip(batch, statuses)
+            )
+        )
+        for status in statuses:
+            counts[status] += 1
+        last_id = batch[-1]["_id"]
+        logging.info(f"Backfilled status on {sum(counts.values())} sessions")
+
+
+async def detect_duplicate(
+    records, licence_plate: str, plate_filter: Optional["PlateFilter"] = None
+) -> bool:
+    normalized = normalize_plate(licence_plate)
+    if not normalized:
+        return False
+    if plate_filter is not None and not plate_filter.might_contain(normalized):
+        return False
+    try:
+        existing = await records.find_one(
+            {
+                "$or": [
+                    {"licence_plate_normalized": normalized},
+                    {"licence_plate": licence_plate},
+                ]
+            },
+            {"_id": 1},
+        )
+        if plate_filter is not None:
+            plate_filter.record_lookup(existing is not None)
         return existing is not None
     except PyMongoError as e:
         logging.error(f"Database error during find_one in detect_duplicate: {e}")
@@ -66,13 +422,85 @@ async def detect_duplicate(records, licence_plate: str) -> bool:
         raise
 
 
-async def save_record(records, licence_plate: str, data: dict, prompt: str):
+def duplicate_reply(licence_plate: str) -> str:
+    return f"There is already a record for licence plate {licence_plate}. Please check if you entered the correct details."
+
+
+def build_record(licence_plate: str, data: dict, prompt_version: str) -> dict:
+    return Record(
+        licence_plate=licence_plate,
+        licence_plate_normalized=normalize_plate(licence_plate),
+        form_data=data,
+        prompt_version=prompt_version,
+    ).model_dump()
+
+
+async def save_record(
+    records,
+    licence_plate: str,
+    data: dict,
+    prompt_version: str,
+    plate_filter: Optional["PlateFilter"] = None,
+) -> bool:
+    # The unique index on the normalized plate makes the insert itself the
+    # duplicate check, so two sessions racing on one plate can't both succeed.
     try:
-        rec = Record(licence_plate=licence_plate, form_data=data, prompt_used=prompt)
-        await records.insert_one(rec.model_dump())
+        await records.insert_one(build_record(licence_plate, data, prompt_version))
+        if plate_filter is not None:
+            plate_filter.add(licence_plate)
+        return True
+    except DuplicateKeyError:
+        logging.info(f"Record for licence plate {licence_plate} already exists")
+        if plate_filter is not None:
+            plate_filter.add(licence_plate)
+        return False
     except PyMongoError as e:
         logging.error(f"Database error during insert_one in save_record: {e}")
         raise
     except Exception as e:
         logging.error(f"Unexpected error in save_record: {e}")
         raise
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Session and record storage")
+    parser.add_argument("--uri", default=db.get_mongo_uri())
+    parser.add_argument("--database", default="chatbot")
+    parser.add_argument(
+        "--backfill-plates",
+        action="store_true",
+        help="set licence_plate_normalized on records written before it existed",
+    )
+    parser.add_argument(
+        "--backfill-status",
+        action="store_true",
+        help="set status on sessions written before it existed",
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    return parser.parse_args(argv)
+
+
+async def main(args) -> None:
+    client = AsyncIOMotorClient(args.uri)
+    database = client[args.database]
+    try:
+        if args.backfill_plates:
+            counts = await backfill_normalized_plates(database.records, args.batch_size)
+            print(
+                f"{counts['backfilled']} records backfilled, "
+                f"{counts['duplicates']} duplicate plates, "
+                f"{counts['skipped']} without a plate"
+            )
+        if args.backfill_status:
+            counts = await backfill_session_status(database.sessions, args.batch_size)
+            print(
+                f"{counts[SESSION_OPEN]} sessions open, "
+                f"{counts[SESSION_COMPLETE]} complete"
+            )
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parse_args()))
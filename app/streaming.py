@@ -0,0 +1,39 @@
+import json
+from typing import Any, Dict
+from pydantic_core import from_json
+
+
+# Pulls next_question out of a CarInfo JSON object while it is still streaming,
+# so the question can reach the client before the rest of the object arrives.
+class NextQuestionExtractor:
+    def __init__(self, field: str = "next_question"):
+        self.field = field
+        self.text = ""
+        self.emitted = ""
+        self.field_complete = False
+
+    def feed(self, chunk: str) -> str:
+        self.text += chunk
+        if self.field_complete:
+            return ""
+        try:
+            partial = from_json(self.text, allow_partial="trailing-strings")
+        except ValueError:
+            return ""
+        if not isinstance(partial, dict):
+            return ""
+        value = partial.get(self.field)
+        if not isinstance(value, str):
+            return ""
+        # Any key after the field means its string has been closed
+        keys = list(partial)
+        self.field_complete = keys.index(self.field) < len(keys) - 1
+        if len(value) <= len(self.emitted) or not value.startswith(self.emitted):
+            return ""
+        new_text = value[len(self.emitted) :]
+        self.emitted = value
+        return new_text
+
+
+def ndjson(event: Dict[str, Any]) -> bytes:
+    return (json.dumps(event) + "\n").encode()
@@ -0,0 +1,130 @@
+# Compares /chat turns with the sequential and the concurrent pipeline. The
+# model and every MongoDB call get injected latencies, so no database or API
+# key is needed:
+#
+#   python -m benchmarks.bench_chat_pipeline --turns 500 --db-ms 5 --llm-ms 200
+import argparse
+import asyncio
+import json
+import random
+from types import SimpleNamespace
+
+import mongomock_motor
+
+from app import app as chat_app
+from app import db
+from app.models import ChatRequest
+from benchmarks.common import print_table, summarize, timed, write_results
+
+
+def delay(rng: random.Random, mean_ms: float) -> float:
+    # Exponential jitter gives the long tail real round trips have
+    return rng.expovariate(1000 / mean_ms) if mean_ms > 0 else 0.0
+
+
+class SlowCollection:
+    # Delays every awaited collection call; cursors and sync helpers pass through
+    def __init__(self, collection, mean_ms: float, rng: random.Random):
+        self._collection = collection
+        self._mean_ms = mean_ms
+        self._rng = rng
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in {"find_one", "insert_one", "update_one"}:
+            return attr
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(delay(self._rng, self._mean_ms))
+            return await attr(*args, **kwargs)
+
+        return call
+
+
+def slow_completion(llm_ms: float, rng: random.Random):
+    async def completion(model, messages, **kwargs):
+        await asyncio.sleep(delay(rng, llm_ms))
+        # Every turn completes the form for the plate the customer already gave
+        plate = json.loads(messages[-2]["content"])["licence_plate_number"]
+        content = json.dumps(
+            {
+                "name": "Ann",
+                "licence_plate_number": plate,
+                "car_type": "Sedan",
+                "manufacturer_or_brand": "Toyota",
+                "year_of_construction": "2020",
+                "birthdate": "1990-01-01",
+                "complete": True,
+            }
+        )
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+        )
+
+    return completion
+
+
+async def seed_session(sessions, session_id: str, plate: str) -> None:
+    known = json.dumps({"licence_plate_number": plate, "next_question": "Name?"})
+    await sessions.insert_one(
+        {
+            "_id": session_id,
+            "turn": 1,
+            "history": [
+                {"role": "user", "content": f"My plate is {plate}"},
+                {"role": "assistant", "content": known},
+            ],
+        }
+    )
+
+
+async def run(concurrent: bool, args) -> dict:
+    # Both pipelines draw the same model latencies, so only the database
+    # overlap differs between them
+    db_rng = random.Random(args.seed)
+    database = mongomock_motor.AsyncMongoMockClient()["chatbot_bench"]
+    db.sessions = SlowCollection(database.sessions, args.db_ms, db_rng)
+    db.records = SlowCollection(database.records, args.db_ms, db_rng)
+    chat_app.concurrent_io = concurrent
+    chat_app.session_cache = None
+    chat_app.plate_filter = None
+    chat_app.insurance_agent.completion = slow_completion(
+        args.llm_ms, random.Random(args.seed)
+    )
+    chat_app.insurance_agent.response_cache = None
+
+    samples = []
+    for i in range(args.turns):
+        session_id = f"bench-{i}"
+        await seed_session(database.sessions, session_id, f"B{i:06d}")
+        with timed(samples):
+            await chat_app.chat_turn_once(
+                ChatRequest(session_id=session_id, message="Ann"), None, "bench", ""
+            )
+    return {
+        "pipeline": "concurrent" if concurrent else "sequential",
+        **summarize(samples),
+    }
+
+
+async def main(args) -> None:
+    results = [await run(False, args), await run(True, args)]
+    print_table(results, ["pipeline", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms"])
+    if args.output:
+        write_results(args.output, results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Chat turn latency, sequential vs concurrent database work"
+    )
+    parser.add_argument("--turns", type=int, default=300)
+    parser.add_argument("--db-ms", type=float, default=5, help="mean MongoDB latency")
+    parser.add_argument("--llm-ms", type=float, default=50, help="mean model latency")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
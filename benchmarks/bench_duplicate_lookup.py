@@ -0,0 +1,104 @@
+# Measures detect_duplicate latency against growing record collections, with
+# and without the licence plate indexes. Needs a real MongoDB:
+#
+#   python -m benchmarks.bench_duplicate_lookup --sizes 10000,100000,1000000,10000000
+import argparse
+import asyncio
+import random
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app import db
+from app.sessions import detect_duplicate, normalize_plate
+from benchmarks.common import print_table, summarize, timed, write_results
+
+
+def plate(i: int, prefix: str = "B") -> str:
+    return f"{prefix}{i // 10000:04d}-{i % 10000:04d}"
+
+
+def synthetic_record(i: int) -> dict:
+    licence_plate = plate(i)
+    now = datetime.now()
+    return {
+        "licence_plate": licence_plate,
+        "licence_plate_normalized": normalize_plate(licence_plate),
+        "form_data": {"name": f"Customer {i}", "car_type": "Sedan"},
+        "prompt_version": "benchmark",
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+async def grow(records, current: int, target: int, batch: int) -> None:
+    for start in range(current, target, batch):
+        stop = min(start + batch, target)
+        await records.insert_many(
+            [synthetic_record(i) for i in range(start, stop)], ordered=False
+        )
+
+
+async def measure(records, size: int, lookups: int) -> dict:
+    samples = []
+    for _ in range(lookups):
+        # Half of the lookups hit an existing plate, half miss
+        if random.random() < 0.5:
+            candidate = plate(random.randrange(size))
+        else:
+            candidate = plate(random.randrange(size), prefix="N")
+        with timed(samples):
+            await detect_duplicate(records, candidate)
+    return summarize(samples)
+
+
+async def main(args) -> None:
+    client = AsyncIOMotorClient(args.uri)
+    records = client[args.database]["records"]
+    await records.drop()
+    results = []
+    current = 0
+    try:
+        for size in sorted(args.sizes):
+            await grow(records, current, size, args.batch)
+            current = size
+
+            await records.drop_indexes()
+            unindexed = await measure(records, size, args.unindexed_lookups)
+            await db.ensure_record_indexes(records)
+            indexed = await measure(records, size, args.lookups)
+            for mode, summary in (("unindexed", unindexed), ("indexed", indexed)):
+                results.append({"records": size, "mode": mode, **summary})
+            print(f"{size} records done", flush=True)
+    finally:
+        if not args.keep:
+            await client.drop_database(args.database)
+        client.close()
+
+    print_table(results, ["records", "mode", "count", "p50_ms", "p95_ms", "p99_ms"])
+    if args.output:
+        write_results(args.output, results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Duplicate plate lookup latency by collection size"
+    )
+    parser.add_argument("--uri", default=db.get_mongo_uri())
+    parser.add_argument("--database", default="chatbot_bench")
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[10_000, 100_000, 1_000_000, 10_000_000],
+    )
+    parser.add_argument("--lookups", type=int, default=1000)
+    # Collection scans get slow quickly, keep the unindexed sample small
+    parser.add_argument("--unindexed-lookups", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=10_000)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--keep", action="store_true", help="keep the database")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
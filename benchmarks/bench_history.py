@@ -0,0 +1,79 @@
+# Per-request CPU spent turning stored session history into the model payload
+# and the session update, before and after SessionHistory kept the documents:
+#
+#   python -m benchmarks.bench_history --sizes 10,50,100,500
+import argparse
+import timeit
+
+from app.context import compact_messages
+from app.models import Message
+from app.sessions import SessionHistory
+from benchmarks.common import print_table, write_results
+
+SYSTEM_PROMPT = "You are an insurance assistant."
+
+
+def stored_history(size: int) -> list:
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"Message {i} " + "x" * 80,
+        }
+        for i in range(size)
+    ]
+
+
+def per_message(stored: list) -> None:
+    # Validate every entry, then dump every message for the token estimate,
+    # the model payload and the session update
+    history = [Message.model_validate(h) for h in stored]
+    history.append(Message(role="user", content="Hello"))
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + [
+        h.model_dump() for h in history
+    ]
+    sum(len(m["content"]) for m in messages)
+    [h.model_dump() for h in history]
+    [h.model_dump() for h in history]
+
+
+def session_history(stored: list) -> None:
+    history = SessionHistory.load(stored)
+    history.append(Message(role="user", content="Hello"))
+    compact_messages(SYSTEM_PROMPT, history, window_turns=4, token_budget=10**9)
+    history.documents()[len(stored) :]
+
+
+def main(args) -> None:
+    rows = []
+    for size in args.sizes:
+        stored = stored_history(size)
+        row = {"messages": size}
+        for name, fn in [
+            ("per_message", per_message),
+            ("session_history", session_history),
+        ]:
+            seconds = min(
+                timeit.repeat(lambda: fn(stored), number=args.number, repeat=5)
+            )
+            row[f"{name}_us"] = seconds / args.number * 1e6
+        row["speedup"] = row["per_message_us"] / row["session_history_us"]
+        rows.append(row)
+    print_table(rows, ["messages", "per_message_us", "session_history_us", "speedup"])
+    if args.output:
+        write_results(args.output, rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Session history serialization cost")
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[10, 50, 100, 250, 500],
+    )
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,158 @@
+# Measures the reporting queries against growing synthetic record sets, with
+# and without the report indexes: a filtered first page, a page deep into the
+# results (keyset cursor against skip/limit) and the grouped counts. Needs a
+# real MongoDB:
+#
+#   python -m benchmarks.bench_reports --sizes 100000,1000000
+import argparse
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DESCENDING
+
+from app import db
+from app.reports import RecordFilter, RecordReports
+from benchmarks.common import print_table, summarize, timed, write_results
+
+CAR_TYPES = ["Sedan", "Coupe", "Station Wagon", "Hatchback", "Minivan"]
+BRANDS = ["Toyota", "Honda", "Ford", "Kia", "BMW", "Volvo", "Fiat", "Skoda"]
+EPOCH = datetime(2024, 1, 1)
+
+
+def synthetic_record(i: int, rng: random.Random) -> dict:
+    # About a year of records, a few seconds apart
+    created_at = EPOCH + timedelta(seconds=i * 3 + rng.randrange(3))
+    plate = f"R{i:08d}"
+    return {
+        "licence_plate": plate,
+        "licence_plate_normalized": plate,
+        "form_data": {
+            "name": f"Customer {i}",
+            "car_type": rng.choice(CAR_TYPES),
+            "manufacturer_or_brand": rng.choice(BRANDS),
+            "year_of_construction": str(rng.randrange(1990, 2025)),
+        },
+        "prompt_version": "benchmark",
+        "created_at": created_at,
+        "updated_at": created_at,
+    }
+
+
+async def grow(records, current: int, target: int, batch: int, rng) -> None:
+    for start in range(current, target, batch):
+        stop = min(start + batch, target)
+        await records.insert_many(
+            [synthetic_record(i, rng) for i in range(start, stop)], ordered=False
+        )
+
+
+def random_filter(size: int, rng: random.Random) -> RecordFilter:
+    # A week of one car type, somewhere in the data set
+    start = EPOCH + timedelta(seconds=rng.randrange(size * 3))
+    return RecordFilter(
+        start=start, end=start + timedelta(days=7), car_type=rng.choice(CAR_TYPES)
+    )
+
+
+async def skip_page(records, filters: RecordFilter, skip: int, limit: int):
+    return (
+        await records.find(filters.query())
+        .sort([("created_at", DESCENDING), ("_id", DESCENDING)])
+        .skip(skip)
+        .limit(limit)
+        .to_list(None)
+    )
+
+
+async def measure(records, size: int, queries: int, args, rng) -> dict:
+    reports = RecordReports(records, read_preference=args.read_preference)
+    samples = {name: [] for name in ("first_page", "keyset_deep", "skip_deep")}
+    samples.update({f"counts_{by}": [] for by in ("car_type", "brand", "day")})
+    for _ in range(queries):
+        filters = random_filter(size, rng)
+        with timed(samples["first_page"]):
+            await reports.page(filters, args.page_size)
+
+        # Walk to the same depth with cursors, timing only the last page
+        cursor = None
+        for _ in range(args.depth):
+            _, cursor = await reports.page(filters, args.page_size, cursor)
+            if cursor is None:
+                break
+        if cursor is not None:
+            with timed(samples["keyset_deep"]):
+                await reports.page(filters, args.page_size, cursor)
+        with timed(samples["skip_deep"]):
+            await skip_page(
+                records, filters, args.depth * args.page_size, args.page_size
+            )
+
+        month = RecordFilter(
+            start=filters.start, end=filters.start + timedelta(days=30)
+        )
+        for by in ("car_type", "brand", "day"):
+            with timed(samples[f"counts_{by}"]):
+                await reports.counts(month, by)
+    return {name: summarize(s) for name, s in samples.items()}
+
+
+async def main(args) -> None:
+    rng = random.Random(args.seed)
+    client = AsyncIOMotorClient(args.uri)
+    records = client[args.database]["records"]
+    await records.drop()
+    results = []
+    current = 0
+    try:
+        for size in sorted(args.sizes):
+            await grow(records, current, size, args.batch, rng)
+            current = size
+
+            await records.drop_indexes()
+            unindexed = await measure(records, size, args.unindexed_queries, args, rng)
+            await db.ensure_report_indexes(records)
+            indexed = await measure(records, size, args.queries, args, rng)
+            for mode, stages in (("unindexed", unindexed), ("indexed", indexed)):
+                for query, summary in stages.items():
+                    results.append(
+                        {"records": size, "mode": mode, "query": query, **summary}
+                    )
+            print(f"{size} records done", flush=True)
+    finally:
+        if not args.keep:
+            await client.drop_database(args.database)
+        client.close()
+
+    print_table(
+        results, ["records", "mode", "query", "count", "p50_ms", "p95_ms", "p99_ms"]
+    )
+    if args.output:
+        write_results(args.output, results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reporting query latency")
+    parser.add_argument("--uri", default=db.get_mongo_uri())
+    parser.add_argument("--database", default="chatbot_bench")
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[100_000, 1_000_000],
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    # Collection scans get slow quickly, keep the unindexed sample small
+    parser.add_argument("--unindexed-queries", type=int, default=5)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=10, help="pages to walk")
+    parser.add_argument("--read-preference", default="primary")
+    parser.add_argument("--batch", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--keep", action="store_true", help="keep the database")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,162 @@
+# Measures what each uvicorn worker pays before it can serve: importing
+# app.app, and the agent warm-up that imports litellm afterwards. Every run is
+# a fresh interpreter; --workers starts that many at once, like
+# `uvicorn --workers N` does, so they compete for CPU the same way:
+#
+#   python -m benchmarks.bench_startup --runs 10 --workers 4
+#   python -m benchmarks.bench_startup --save-baseline
+#   python -m benchmarks.bench_startup --check
+#
+# It also lists the imports with the largest cumulative time (from
+# python -X importtime) and --check fails if a module that should only load
+# on first use, such as litellm, is imported with the app.
+import argparse
+import json
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.common import percentile, print_table, write_results
+
+BASELINE = Path(__file__).parent / "baselines" / "bench_startup.json"
+DEFERRED_MODULES = ["litellm", "openai"]
+
+# Runs in the child interpreter; prints one JSON line
+CHILD = """
+import asyncio, json, sys, time
+
+def rss_kib():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+start = time.perf_counter()
+import app.app
+imported = time.perf_counter()
+result = {
+    "import_ms": (imported - start) * 1000,
+    "import_rss_kib": rss_kib(),
+    "loaded": [m for m in %(deferred)r if m in sys.modules],
+}
+if %(warm_up)r:
+    asyncio.run(app.app.insurance_agent.warm_up())
+    result["warm_up_ms"] = (time.perf_counter() - imported) * 1000
+    result["warm_up_rss_kib"] = rss_kib()
+print(json.dumps(result))
+"""
+
+
+def start_worker(warm_up: bool) -> dict:
+    code = CHILD % {"deferred": DEFERRED_MODULES, "warm_up": warm_up}
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result["importtime"] = process.stderr
+    return result
+
+
+def slowest_imports(importtime: str, top: int) -> list:
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    rows = []
+    for line in importtime.splitlines():
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        rows.append(
+            {
+                "module": parts[2].strip(),
+                "cumulative_ms": int(parts[1]) / 1000,
+                "self_ms": int(parts[0]) / 1000,
+            }
+        )
+    return sorted(rows, key=lambda r: r["cumulative_ms"], reverse=True)[:top]
+
+
+def run(args) -> dict:
+    samples = []
+    with ThreadPoolExecutor(args.workers) as pool:
+        for _ in range(args.runs):
+            samples += pool.map(start_worker, [args.warm_up] * args.workers)
+
+    summary = {
+        "scenario": {"workers": args.workers, "warm_up": args.warm_up},
+        "samples": len(samples),
+        "loaded": sorted({m for s in samples for m in s["loaded"]}),
+    }
+    for key in ("import_ms", "import_rss_kib", "warm_up_ms", "warm_up_rss_kib"):
+        values = [s[key] for s in samples if key in s]
+        if values:
+            summary[key] = {
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "max": max(values),
+            }
+    summary["slowest_imports"] = slowest_imports(samples[-1]["importtime"], args.top)
+    return summary
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list:
+    problems = [f"{m} is imported with the app" for m in result["loaded"]]
+    for key in ("import_ms", "import_rss_kib"):
+        limit = baseline[key]["p50"] * (1 + tolerance)
+        if result[key]["p50"] > limit:
+            problems.append(f"{key} p50 {result[key]['p50']:.0f} > {limit:.0f}")
+    return problems
+
+
+def main(args) -> int:
+    baseline = None
+    if args.check:
+        baseline = json.loads(Path(args.baseline).read_text())
+        args.workers = baseline["scenario"]["workers"]
+        args.warm_up = baseline["scenario"]["warm_up"]
+    result = run(args)
+
+    rows = [
+        {"metric": key, **result[key]}
+        for key in ("import_ms", "import_rss_kib", "warm_up_ms", "warm_up_rss_kib")
+        if key in result
+    ]
+    print_table(rows, ["metric", "p50", "p95", "max"])
+    print()
+    print_table(result["slowest_imports"], ["module", "cumulative_ms", "self_ms"])
+    if args.output:
+        write_results(args.output, result)
+    if args.save_baseline:
+        write_results(args.baseline, result)
+        print(f"baseline written to {args.baseline}")
+    if baseline is None:
+        return 0
+    problems = regressions(result, baseline, args.tolerance)
+    for problem in problems:
+        print(f"REGRESSION: {problem}")
+    return 1 if problems else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Worker import time and memory")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4, help="started at once")
+    parser.add_argument(
+        "--no-warm-up",
+        dest="warm_up",
+        action="store_false",
+        help="only measure the import",
+    )
+    parser.add_argument("--top", type=int, default=15, help="slowest imports shown")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--baseline", default=str(BASELINE))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
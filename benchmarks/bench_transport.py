@@ -0,0 +1,132 @@
+# Compares multi-turn conversations where every turn loads and writes its
+# session (/chat/stream) with turns over one /chat/ws connection, which loads
+# the session once and writes behind. MongoDB calls and the model get
+# injected latencies, so no database or API key is needed:
+#
+#   python -m benchmarks.bench_transport --conversations 100 --turns 6 --db-ms 5
+import argparse
+import asyncio
+import json
+import random
+from contextlib import aclosing
+from types import SimpleNamespace
+
+import mongomock_motor
+
+from app import app as chat_app
+from app import db
+from app.models import ChatRequest
+from benchmarks.bench_chat_pipeline import SlowCollection, delay
+from benchmarks.common import print_table, summarize, timed, write_results
+
+REPLY = json.dumps(
+    {
+        "reasoning": "Need the car type",
+        "next_question": "Which type of car do you drive?",
+        "car_type": "Sedan",
+        "licence_plate_number": "",
+        "manufacturer_or_brand": "",
+        "year_of_construction": "",
+        "complete": False,
+        "birthdate": "",
+        "name": "",
+    }
+)
+
+
+def streaming_completion(llm_ms: float, rng: random.Random):
+    async def completion(model, messages, **kwargs):
+        await asyncio.sleep(delay(rng, llm_ms))
+
+        async def chunks():
+            for i in range(0, len(REPLY), 16):
+                yield SimpleNamespace(
+                    choices=[
+                        SimpleNamespace(
+                            delta=SimpleNamespace(content=REPLY[i : i + 16])
+                        )
+                    ]
+                )
+
+        return chunks()
+
+    return completion
+
+
+async def consume(chat_turn) -> None:
+    deltas = await chat_app.open_reply(chat_turn)
+    async with aclosing(chat_app.turn_events(chat_turn, deltas)) as events:
+        async for _ in events:
+            pass
+
+
+async def per_request(args, samples) -> None:
+    for _ in range(args.conversations):
+        session_id = None
+        for _ in range(args.turns):
+            with timed(samples):
+                chat_turn = await chat_app.start_turn(
+                    ChatRequest(session_id=session_id, message="a sedan")
+                )
+                await consume(chat_turn)
+            session_id = chat_turn.session_id
+
+
+async def per_connection(args, samples) -> None:
+    for _ in range(args.conversations):
+        connection = chat_app.ChatConnection(None, args.max_pending_writes)
+        for turn in range(args.turns):
+            with timed(samples):
+                # The first turn pays for loading the session
+                if turn == 0:
+                    await connection.load()
+                chat_turn = connection.begin_turn("a sedan")
+                await consume(chat_turn)
+                connection.finished(chat_turn)
+        await connection.close()
+
+
+async def run(transport: str, args) -> dict:
+    db_rng = random.Random(args.seed)
+    database = mongomock_motor.AsyncMongoMockClient()["chatbot_bench"]
+    db.sessions = SlowCollection(database.sessions, args.db_ms, db_rng)
+    db.records = SlowCollection(database.records, args.db_ms, db_rng)
+    chat_app.session_cache = None
+    chat_app.insurance_agent.completion = streaming_completion(
+        args.llm_ms, random.Random(args.seed)
+    )
+    chat_app.insurance_agent.response_cache = None
+
+    samples = []
+    if transport == "http":
+        await per_request(args, samples)
+    else:
+        await per_connection(args, samples)
+    return {"transport": transport, **summarize(samples)}
+
+
+async def main(args) -> None:
+    results = [await run("http", args), await run("websocket", args)]
+    print_table(
+        results, ["transport", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms"]
+    )
+    if args.output:
+        write_results(args.output, results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Chat turn latency, one request per turn vs one connection"
+    )
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--db-ms", type=float, default=5, help="mean MongoDB latency")
+    parser.add_argument("--llm-ms", type=float, default=50, help="mean model latency")
+    parser.add_argument("--max-pending-writes", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,279 @@
+# Drives the FastAPI app over ASGI with many concurrent multi-turn
+# conversations. The model is replaced by a scripted stand-in with
+# configurable latency and MongoDB by mongomock, unless --uri is given:
+#
+#   python -m benchmarks.load_test --conversations 200 --concurrency 50
+#   python -m benchmarks.load_test --save-baseline
+#   python -m benchmarks.load_test --check
+#
+# --check reruns the scenario stored in the baseline and exits with status 1
+# when throughput, a stage's p95 or allocations regress beyond --tolerance.
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+import mongomock_motor
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app import app as chat_app
+from app import db, metrics
+from benchmarks.common import print_table, summarize, write_results
+
+BASELINE = Path(__file__).parent / "baselines" / "load_test.json"
+SCENARIO = ["conversations", "concurrency", "turns", "llm_ms", "seed"]
+# p95s below this many milliseconds are too noisy to compare relatively
+NOISE_FLOOR_MS = 1.0
+
+
+class StageRecorder:
+    # Stands in for metrics.stage and keeps every sample, so percentiles are
+    # exact rather than read off histogram buckets
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[name].append(time.perf_counter() - start)
+
+
+def scripted_completion(turns: int, llm_ms: float, rng: random.Random):
+    # Asks one question per turn and completes the form on the last one, with
+    # a licence plate taken from the conversation's opening message
+    async def completion(model, messages, **kwargs):
+        if llm_ms > 0:
+            await asyncio.sleep(rng.expovariate(1000 / llm_ms))
+        user_messages = [m["content"] for m in messages if m["role"] == "user"]
+        plate = user_messages[0].split()[-1]
+        reply = {
+            "reasoning": "Scripted",
+            "next_question": f"Question {len(user_messages)}",
+            "car_type": "Sedan",
+            "licence_plate_number": "",
+            "manufacturer_or_brand": "",
+            "year_of_construction": "",
+            "complete": False,
+            "birthdate": "",
+            "name": "Load Test",
+        }
+        if len(user_messages) >= turns:
+            reply.update(
+                licence_plate_number=plate,
+                manufacturer_or_brand="Toyota",
+                year_of_construction="2020",
+                birthdate="1990-01-01",
+                complete=True,
+            )
+        content = json.dumps(reply)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+        )
+
+    return completion
+
+
+async def converse(client: httpx.AsyncClient, index: int, turns: int, samples):
+    session_id = None
+    for turn in range(turns):
+        message = f"My plate is LT{index:07d}" if turn == 0 else f"Answer {turn}"
+        start = time.perf_counter()
+        response = await client.post(
+            "/chat", json={"session_id": session_id, "message": message}
+        )
+        samples.append(time.perf_counter() - start)
+        response.raise_for_status()
+        session_id = response.json()["session_id"]
+    if not response.json()["complete"]:
+        raise RuntimeError(f"Conversation {index} did not complete")
+
+
+def bind_database(uri: str | None):
+    if uri:
+        client = AsyncIOMotorClient(uri)
+    else:
+        client = mongomock_motor.AsyncMongoMockClient()
+    db.client = client
+    db.db = client["chatbot_load_test"]
+    return db.db
+
+
+async def run(args) -> dict:
+    database = bind_database(args.uri)
+    await database.sessions.drop()
+    await database.records.drop()
+    chat_app.insurance_agent.completion = scripted_completion(
+        args.turns, args.llm_ms, random.Random(args.seed)
+    )
+    # Every conversation comes from the same test client address, which the
+    # admission queue would cap; the pipeline is what is measured here
+    chat_app.admission = None
+    recorder = StageRecorder()
+    metrics.stage = recorder.stage
+
+    transport = httpx.ASGITransport(app=chat_app.app)
+    async with chat_app.lifespan(chat_app.app):
+        # Built by the lifespan; the client bucket would cap it the same way
+        chat_app.rate_limiter = None
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://testserver"
+        ) as client:
+            semaphore = asyncio.Semaphore(args.concurrency)
+            http_samples = []
+
+            async def limited(index: int):
+                async with semaphore:
+                    await converse(client, index, args.turns, http_samples)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(limited(i) for i in range(args.conversations)))
+            elapsed = time.perf_counter() - started
+            stages = {"http": summarize(http_samples)}
+            stages.update(
+                {name: summarize(s) for name, s in sorted(recorder.samples.items())}
+            )
+
+            allocations = await measure_allocations(client, args)
+    return {
+        "scenario": {name: getattr(args, name) for name in SCENARIO},
+        "requests": len(http_samples),
+        "seconds": elapsed,
+        "requests_per_second": len(http_samples) / elapsed,
+        "stages": stages,
+        "allocations": allocations,
+    }
+
+
+async def measure_allocations(client: httpx.AsyncClient, args) -> dict:
+    # One conversation at a time, so the peak belongs to a single request
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for i in range(args.allocation_conversations):
+            session_id = None
+            for turn in range(args.turns):
+                message = f"My plate is LA{i:07d}" if turn == 0 else "Answer"
+                before, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                response = await client.post(
+                    "/chat", json={"session_id": session_id, "message": message}
+                )
+                current, peak = tracemalloc.get_traced_memory()
+                peaks.append(peak - before)
+                retained.append(current - before)
+                session_id = response.json()["session_id"]
+    finally:
+        tracemalloc.stop()
+    return {
+        "requests": len(peaks),
+        "peak_kib_per_request": sum(peaks) / len(peaks) / 1024 if peaks else 0.0,
+        "retained_kib_per_request": (
+            sum(retained) / len(retained) / 1024 if retained else 0.0
+        ),
+    }
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    problems = []
+    floor = baseline["requests_per_second"] * (1 - tolerance)
+    if result["requests_per_second"] < floor:
+        problems.append(
+            f"throughput {result['requests_per_second']:.1f} req/s is below "
+            f"{floor:.1f} req/s"
+        )
+    for name, summary in baseline["stages"].items():
+        current = result["stages"].get(name)
+        if current is None:
+            problems.append(f"stage {name} is missing")
+            continue
+        limit = max(summary["p95_ms"] * (1 + tolerance), NOISE_FLOOR_MS)
+        if current["p95_ms"] > limit:
+            problems.append(
+                f"stage {name} p95 {current['p95_ms']:.2f} ms exceeds {limit:.2f} ms"
+            )
+    peak_limit = baseline["allocations"]["peak_kib_per_request"] * (1 + tolerance)
+    if result["allocations"]["peak_kib_per_request"] > peak_limit:
+        problems.append(
+            f"peak allocations {result['allocations']['peak_kib_per_request']:.1f} "
+            f"KiB per request exceed {peak_limit:.1f} KiB"
+        )
+    return problems
+
+
+def report(result: dict) -> None:
+    print(
+        f"{result['requests']} requests in {result['seconds']:.2f}s, "
+        f"{result['requests_per_second']:.1f} req/s"
+    )
+    rows = [{"stage": name, **s} for name, s in result["stages"].items()]
+    print_table(rows, ["stage", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms"])
+    allocations = result["allocations"]
+    print(
+        f"allocations: {allocations['peak_kib_per_request']:.1f} KiB peak, "
+        f"{allocations['retained_kib_per_request']:.1f} KiB retained per request"
+    )
+
+
+async def main(args) -> int:
+    baseline = None
+    if args.check:
+        baseline = json.loads(Path(args.baseline).read_text())
+        for name, value in baseline["scenario"].items():
+            setattr(args, name, value)
+
+    result = await run(args)
+    report(result)
+    if args.output:
+        write_results(args.output, result)
+    if args.save_baseline:
+        write_results(args.baseline, result)
+        print(f"baseline written to {args.baseline}")
+    if baseline is None:
+        return 0
+
+    problems = regressions(result, baseline, args.tolerance)
+    for problem in problems:
+        print(f"REGRESSION: {problem}")
+    return 1 if problems else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for /chat")
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--llm-ms", type=float, default=20, help="mean model latency")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--allocation-conversations",
+        type=int,
+        default=20,
+        help="conversations replayed one at a time under tracemalloc",
+    )
+    parser.add_argument("--uri", help="use this MongoDB instead of mongomock")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--baseline", default=str(BASELINE))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative slowdown before --check fails",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -1,9 +1,30 @@
+import mongomock_motor
 import pytest
+from unittest.mock import patch
 from fastapi.testclient import TestClient
 from app.app import app
 from httpx import AsyncClient, ASGITransport
 
 
+@pytest.fixture(autouse=True)
+def no_litellm():
+    # No test talks to a real model, so the app's startup warm-up shouldn't
+    # spend seconds importing litellm
+    with patch("app.insurance_agent.load_litellm"):
+        yield
+
+
+@pytest.fixture
+def mock_db():
+    # A fresh in-memory database behind the app's sessions and records
+    db = mongomock_motor.AsyncMongoMockClient()["chatbot"]
+    with (
+        patch("app.db.sessions", db.sessions),
+        patch("app.db.records", db.records),
+    ):
+        yield db
+
+
 @pytest.fixture
 def client():
     with TestClient(app) as test_client:
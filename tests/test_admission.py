@@ -0,0 +1,182 @@
+import asyncio
+import ipaddress
+import json
+import pytest
+from unittest.mock import AsyncMock, patch
+from starlette.requests import ClientDisconnect, HTTPConnection, Request
+from app import app as app_module
+from app.admission import AdmissionController, Overloaded
+from app.models import ChatRequest
+from app.service_exceptions import AgentNotAvailable
+
+
+async def test_admits_up_to_the_limit_then_queues():
+    admission = AdmissionController(initial_limit=2, queue_timeout_seconds=1)
+    await admission.acquire("a")
+    await admission.acquire("a")
+    waiter = asyncio.create_task(admission.acquire("a"))
+    await asyncio.sleep(0)
+
+    assert admission.stats()["queued"] == 1
+    admission.release(0.1)
+    await waiter
+    assert admission.stats()["in_flight"] == 2
+    assert admission.stats()["queued"] == 0
+
+
+async def test_full_queue_is_rejected_with_retry_after():
+    admission = AdmissionController(initial_limit=1, max_queue=1)
+    await admission.acquire("a")
+    waiter = asyncio.create_task(admission.acquire("b"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(Overloaded) as error:
+        await admission.acquire("c")
+    assert error.value.retry_after >= 1
+    assert admission.stats()["rejected"] == 1
+    waiter.cancel()
+
+
+async def test_queue_wait_times_out():
+    admission = AdmissionController(initial_limit=1, queue_timeout_seconds=0.01)
+    await admission.acquire("a")
+
+    with pytest.raises(Overloaded):
+        await admission.acquire("b")
+    stats = admission.stats()
+    assert stats["timed_out"] == 1
+    assert stats["queued"] == 0
+
+
+async def test_queue_is_served_round_robin_across_clients():
+    admission = AdmissionController(initial_limit=1, queue_timeout_seconds=1)
+    await admission.acquire("busy")
+    order = []
+
+    async def wait(client):
+        await admission.acquire(client)
+        order.append(client)
+
+    waiters = [asyncio.create_task(wait(c)) for c in ["busy", "busy", "quiet"]]
+    await asyncio.sleep(0)
+    for _ in waiters:
+        admission.release(0.1)
+        await asyncio.sleep(0)
+    await asyncio.gather(*waiters)
+
+    assert order == ["busy", "quiet", "busy"]
+
+
+async def test_one_client_cant_fill_the_queue():
+    admission = AdmissionController(initial_limit=1, max_queue_per_client=1)
+    await admission.acquire("a")
+    waiter = asyncio.create_task(admission.acquire("a"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(Overloaded):
+        await admission.acquire("a")
+    other = asyncio.create_task(admission.acquire("b"))
+    await asyncio.sleep(0)
+    assert admission.stats()["queued"] == 2
+    waiter.cancel()
+    other.cancel()
+
+
+def test_limit_grows_when_fast_and_backs_off_when_slow():
+    admission = AdmissionController(
+        initial_limit=4, latency_target_seconds=1, backoff_ratio=0.5
+    )
+    for _ in range(4):
+        admission.in_flight = 4
+        admission.release(0.1)
+    assert admission.limit == pytest.approx(4.9, abs=0.05)
+
+    admission.in_flight = 1
+    admission.release(5)
+    assert admission.limit == pytest.approx(2.45, abs=0.05)
+    assert admission.stats()["backoffs"] == 1
+
+
+async def test_unavailable_agent_backs_off():
+    admission = AdmissionController(initial_limit=10, backoff_ratio=0.5)
+
+    with pytest.raises(AgentNotAvailable):
+        async with admission.slot("a"):
+            raise AgentNotAvailable("down")
+
+    assert admission.stats()["limit"] == 5
+    assert admission.stats()["in_flight"] == 0
+
+
+def test_chat_answers_429_when_saturated(mock_db, client):
+    saturated = AdmissionController(initial_limit=1, max_queue=0)
+    saturated.in_flight = 1
+    with (
+        patch("app.app.admission", saturated),
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+    ):
+        mock_respond.return_value = json.dumps(
+            {"next_question": "What is your name?", "complete": False}
+        )
+        response = client.post("/chat", json={"session_id": None, "message": "Hi"})
+        stream = client.post("/chat/stream", json={"session_id": None, "message": "Hi"})
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert stream.status_code == 429
+    mock_respond.assert_not_awaited()
+    assert saturated.stats()["rejected"] == 2
+
+
+@pytest.mark.parametrize("scope_type", ["http", "websocket"])
+def test_client_id_is_the_forwarded_address_behind_a_trusted_proxy(scope_type):
+    def key(peer, forwarded):
+        return app_module.client_id(
+            HTTPConnection(
+                {
+                    "type": scope_type,
+                    "client": (peer, 50000),
+                    "headers": [(b"x-forwarded-for", forwarded.encode())],
+                }
+            )
+        )
+
+    with patch("app.app.trusted_proxies", [ipaddress.ip_network("10.0.0.0/8")]):
+        assert key("10.0.0.1", "203.0.113.5") == "203.0.113.5"
+        # A client can't pick its own key by prepending to the header
+        assert key("10.0.0.1", "198.51.100.1, 203.0.113.5, 10.0.0.2") == "203.0.113.5"
+        assert key("203.0.113.9", "198.51.100.1") == "203.0.113.9"
+
+
+async def test_stream_slot_released_when_body_never_starts(mock_db):
+    # An ASGI 2.4 server raises OSError from send when the client is gone
+    admission = AdmissionController(initial_limit=2)
+    request = Request(
+        {"type": "http", "method": "POST", "headers": [], "client": ("10.0.0.1", 1)}
+    )
+
+    async def gone(message):
+        raise OSError("client disconnected")
+
+    async def deltas():
+        yield "What is your name?"
+
+    with (
+        patch("app.app.admission", admission),
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond_stream",
+            new_callable=AsyncMock,
+            return_value=deltas(),
+        ),
+    ):
+        response = await app_module.chat_stream(
+            request, ChatRequest(session_id=None, message="Hi")
+        )
+        assert admission.stats()["in_flight"] == 1
+        scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+        with pytest.raises(ClientDisconnect):
+            await response(scope, AsyncMock(), gone)
+
+    assert admission.stats()["in_flight"] == 0
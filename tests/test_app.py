@@ -1,9 +1,21 @@
 import pytest
+import asyncio
 import json
 from unittest.mock import patch, AsyncMock
 from pymongo.errors import PyMongoError
 from app.models import ChatRequest
-from app.service_exceptions import AgentNotAvailable
+from app.service_exceptions import AgentNotAvailable, SessionConflict
+from app.sessions import SESSION_OPEN, SessionHistory
+
+COMPLETE_FORM = {
+    "car_type": "Sedan",
+    "licence_plate_number": "ABC123",
+    "manufacturer_or_brand": "Toyota",
+    "year_of_construction": "2020",
+    "birthdate": "1990-01-01",
+    "name": "John Doe",
+    "complete": True,
+}
 
 
 @pytest.fixture(autouse=True)
@@ -64,11 +76,229 @@ def test_chat_missing_next_question(client, mock_db_session):
     mock_sessions, _ = mock_db_session
     mock_sessions.find_one.return_value = None
 
-    with patch(
-        "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
-    ) as mock_respond:
+    with (
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        # The follow-up for the missing field doesn't help either
+        patch(
+            "app.app.response_parser.reprompt", new_callable=AsyncMock
+        ) as mock_reprompt,
+    ):
         mock_respond.return_value = json.dumps({"complete": False})
+        mock_reprompt.return_value = "{}"
         request = ChatRequest(session_id="", message="Test")
         response = client.post("/chat", json=request.model_dump())
         assert response.status_code == 500
         assert "Invalid agent response format" in response.json()["detail"]
+        assert mock_reprompt.await_args.args[2] == ["next_question"]
+
+
+def test_chat_missing_next_question_is_reprompted(client, mock_db_session):
+    mock_sessions, _ = mock_db_session
+    mock_sessions.find_one.return_value = None
+
+    with (
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch(
+            "app.app.response_parser.reprompt", new_callable=AsyncMock
+        ) as mock_reprompt,
+    ):
+        mock_respond.return_value = '```json\n{"complete": false, "name": "Ann"'
+        mock_reprompt.return_value = json.dumps({"next_question": "Your plate?"})
+        response = client.post("/chat", json={"session_id": "", "message": "Ann"})
+
+    assert response.status_code == 200
+    assert response.json()["agent_response"] == "Your plate?"
+    history, partial, missing, usage = mock_reprompt.await_args.args
+    assert partial["name"] == "Ann"
+    assert missing == ["next_question"]
+
+
+def test_chat_session_conflict(client, mock_db_session):
+    mock_sessions, _ = mock_db_session
+    mock_sessions.find_one.return_value = None
+
+    with (
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.append_session_messages", new_callable=AsyncMock) as mock_append,
+    ):
+        mock_respond.return_value = json.dumps(
+            {"next_question": "What is your name?", "complete": False}
+        )
+        mock_append.side_effect = SessionConflict("stale turn")
+        request = ChatRequest(session_id="", message="Test")
+        response = client.post("/chat", json=request.model_dump())
+        assert response.status_code == 409
+        assert mock_append.await_args.kwargs["turn"] == 0
+        assert [m.role for m in mock_append.await_args.kwargs["messages"]] == [
+            "user",
+            "assistant",
+        ]
+
+
+def test_chat_complete_duplicate_on_insert(client, mock_db_session):
+    mock_sessions, mock_records = mock_db_session
+    mock_sessions.find_one.return_value = None
+    mock_records.find_one.return_value = None
+
+    with (
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.save_record", new_callable=AsyncMock) as mock_save,
+    ):
+        mock_respond.return_value = json.dumps(COMPLETE_FORM)
+        # Another session stored the plate between the lookup and the insert
+        mock_save.return_value = False
+        request = ChatRequest(session_id="", message="Test")
+        response = client.post("/chat", json=request.model_dump())
+        assert response.status_code == 200
+        assert response.json()["complete"] is False
+        assert "already a record for licence plate ABC123" in (
+            response.json()["agent_response"]
+        )
+
+
+def known_plate_session(plate):
+    history = [
+        {"role": "user", "content": f"My plate is {plate}"},
+        {"role": "assistant", "content": json.dumps({"licence_plate_number": plate})},
+    ]
+    return AsyncMock(return_value=("session-1", SessionHistory.load(history)))
+
+
+@pytest.mark.parametrize(
+    "reply_plate, looked_up", [("abc 123", "ABC123"), ("XYZ9", "XYZ9")]
+)
+def test_chat_prefetches_known_plate(client, reply_plate, looked_up):
+    with (
+        patch("app.app.get_or_create_session", known_plate_session("ABC123")),
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.detect_duplicate", new_callable=AsyncMock) as mock_detect,
+        patch("app.app.append_session_messages", new_callable=AsyncMock),
+    ):
+        mock_respond.return_value = json.dumps(
+            {"licence_plate_number": reply_plate, "next_question": "Your name?"}
+        )
+        mock_detect.return_value = False
+        request = ChatRequest(session_id="session-1", message="Hi")
+        response = client.post("/chat", json=request.model_dump())
+        assert response.status_code == 200
+        # The lookup started before the model call is reused for the same plate
+        # and a changed plate is looked up afresh
+        mock_detect.assert_awaited_once()
+        assert mock_detect.await_args.args[1] == looked_up
+
+
+def test_chat_failed_prefetch_is_discarded(client):
+    with (
+        patch("app.app.get_or_create_session", known_plate_session("ABC123")),
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.detect_duplicate", new_callable=AsyncMock) as mock_detect,
+    ):
+        mock_respond.side_effect = AgentNotAvailable("down")
+        mock_detect.side_effect = PyMongoError("Database error")
+        request = ChatRequest(session_id="session-1", message="Hi")
+        response = client.post("/chat", json=request.model_dump())
+        assert response.status_code == 503
+        assert response.json()["detail"] == "AI Agent is temporarily unavailable"
+
+
+def test_chat_complete_writes_record_and_session_together(client, mock_db_session):
+    mock_sessions, mock_records = mock_db_session
+    mock_sessions.find_one.return_value = None
+    mock_records.find_one.return_value = None
+
+    with (
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.save_record", new_callable=AsyncMock) as mock_save,
+        patch("app.app.append_session_messages", new_callable=AsyncMock) as mock_append,
+    ):
+        mock_respond.return_value = json.dumps(COMPLETE_FORM)
+        mock_save.return_value = False
+        mock_append.return_value = 1
+        request = ChatRequest(session_id="", message="Test")
+        response = client.post("/chat", json=request.model_dump())
+        assert response.status_code == 200
+        assert response.json()["complete"] is False
+        # The duplicate notice follows the turn that was written with the save
+        first, notice = mock_append.await_args_list
+        assert first.kwargs["turn"] == 0
+        assert notice.kwargs["turn"] == 1
+        assert "already a record" in notice.kwargs["messages"][0].content
+
+
+def test_chat_complete_save_error_waits_for_session_write(client, mock_db_session):
+    mock_sessions, mock_records = mock_db_session
+    mock_sessions.find_one.return_value = None
+    mock_records.find_one.return_value = None
+
+    with (
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.save_record", new_callable=AsyncMock) as mock_save,
+        patch("app.app.append_session_messages", new_callable=AsyncMock) as mock_append,
+    ):
+        mock_respond.return_value = json.dumps(COMPLETE_FORM)
+        mock_save.side_effect = PyMongoError("Database error")
+        request = ChatRequest(session_id="", message="Test")
+        response = client.post("/chat", json=request.model_dump())
+        assert response.status_code == 503
+        mock_append.assert_awaited_once()
+
+
+def test_chat_complete_save_error_reopens_session(mock_db, client):
+    with (
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.save_record", new_callable=AsyncMock) as mock_save,
+    ):
+        mock_respond.return_value = json.dumps(COMPLETE_FORM)
+        mock_save.side_effect = PyMongoError("Database error")
+        request = ChatRequest(session_id="", message="Test")
+        response = client.post("/chat", json=request.model_dump())
+        assert response.status_code == 503
+
+        # The turn written alongside the failed insert is taken back, so the
+        # session can still be completed instead of being archived without
+        # its record
+        session = asyncio.run(mock_db.sessions.find_one({}))
+        assert session["status"] == SESSION_OPEN
+        assert session["history"] == []
+        assert asyncio.run(mock_db.records.count_documents({})) == 0
+
+
+def test_chat_sequential_pipeline(client, mock_db_session):
+    mock_sessions, mock_records = mock_db_session
+    mock_sessions.find_one.return_value = None
+    mock_records.find_one.return_value = None
+
+    with (
+        patch("app.app.concurrent_io", False),
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.save_record", new_callable=AsyncMock) as mock_save,
+        patch("app.app.append_session_messages", new_callable=AsyncMock) as mock_append,
+    ):
+        mock_respond.return_value = json.dumps(COMPLETE_FORM)
+        mock_save.return_value = False
+        request = ChatRequest(session_id="", message="Test")
+        response = client.post("/chat", json=request.model_dump())
+        assert response.status_code == 200
+        assert response.json()["complete"] is False
+        mock_append.assert_awaited_once()
+        assert len(mock_append.await_args.kwargs["messages"]) == 3
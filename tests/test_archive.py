@@ -0,0 +1,138 @@
+import mongomock_motor
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+from pymongo.errors import OperationFailure
+from app import db
+from app.archive import SessionArchiver
+from app.models import Message
+from app.sessions import append_session_messages, get_or_create_session
+
+
+@pytest.fixture
+def database():
+    return mongomock_motor.AsyncMongoMockClient()["chatbot"]
+
+
+def session(session_id, status, age_seconds, turn=1):
+    return {
+        "_id": session_id,
+        "history": [
+            {"role": "user", "content": "My plate is ABC123"},
+            {"role": "assistant", "content": "Thank you, the form is complete."},
+        ],
+        "turn": turn,
+        "status": status,
+        "created_at": datetime.now() - timedelta(seconds=age_seconds + 60),
+        "updated_at": datetime.now() - timedelta(seconds=age_seconds),
+    }
+
+
+async def test_completed_sessions_are_archived(database):
+    await database.sessions.insert_many(
+        [
+            session("done", "complete", age_seconds=7200),
+            session("recent", "complete", age_seconds=10),
+            session("open", "open", age_seconds=7200),
+            {"_id": "legacy", "history": [], "created_at": datetime.now()},
+        ]
+    )
+    archiver = SessionArchiver(
+        database.sessions, database.sessions_archive, archive_after_seconds=3600
+    )
+
+    assert await archiver.archive_expired() == 1
+
+    remaining = await database.sessions.distinct("_id")
+    assert sorted(remaining) == ["legacy", "open", "recent"]
+    archived = await database.sessions_archive.find_one({"_id": "done"})
+    assert isinstance(archived["history"], bytes)
+    assert archived["messages"] == 2
+    assert archived["turn"] == 1
+
+    loaded = await archiver.load("done")
+    assert loaded["history"][0] == {"role": "user", "content": "My plate is ABC123"}
+    assert await archiver.load("missing") is None
+
+    stats = archiver.stats()
+    assert stats["archived"] == 1
+    assert stats["hot_sessions"] == {"total": 3, "open": 1, "complete": 1}
+    assert stats["compression_ratio"] > 0
+
+
+async def test_archives_in_batches(database):
+    await database.sessions.insert_many(
+        [session(f"s{i}", "complete", age_seconds=7200) for i in range(5)]
+    )
+    archiver = SessionArchiver(
+        database.sessions,
+        database.sessions_archive,
+        archive_after_seconds=3600,
+        batch_size=2,
+    )
+
+    assert await archiver.archive_expired() == 5
+    assert await database.sessions.count_documents({}) == 0
+    assert await database.sessions_archive.count_documents({}) == 5
+
+
+async def test_session_with_a_newer_turn_stays_hot(database):
+    sessions = database.sessions
+    await sessions.insert_one(session("s1", "complete", age_seconds=7200))
+    archiver = SessionArchiver(
+        sessions, database.sessions_archive, archive_after_seconds=3600
+    )
+    delete_many = sessions.delete_many
+
+    async def new_turn_then_delete(query):
+        # The customer writes again between the read and the delete
+        await sessions.update_one({"_id": "s1"}, {"$inc": {"turn": 1}})
+        return await delete_many(query)
+
+    sessions.delete_many = new_turn_then_delete
+
+    assert await archiver.archive_batch() == 0
+    assert await sessions.count_documents({"_id": "s1"}) == 1
+
+
+async def test_status_follows_the_turns(database):
+    session_id, history = await get_or_create_session(database.sessions)
+    stored = await database.sessions.find_one({"_id": session_id})
+    assert stored["status"] == "open"
+    assert stored["updated_at"] == stored["created_at"]
+
+    await append_session_messages(
+        database.sessions,
+        session_id,
+        [Message(role="user", content="Hello")],
+        turn=history.turn,
+        status="complete",
+    )
+    stored = await database.sessions.find_one({"_id": session_id})
+    assert stored["status"] == "complete"
+
+
+async def test_ensure_session_indexes(database):
+    await db.ensure_session_indexes(database.sessions, expire_after_seconds=60)
+    await db.ensure_session_indexes(database.sessions, expire_after_seconds=60)
+
+    indexes = await database.sessions.index_information()
+    assert indexes["open_session_ttl"]["expireAfterSeconds"] == 60
+    assert "status_updated_at" in indexes
+
+
+async def test_changed_ttl_is_updated_in_place():
+    sessions = MagicMock()
+    sessions.name = "sessions"
+    sessions.create_index = AsyncMock(
+        side_effect=[OperationFailure("conflict", code=85), None]
+    )
+    sessions.database.command = AsyncMock()
+
+    await db.ensure_session_indexes(sessions, expire_after_seconds=120)
+
+    sessions.database.command.assert_awaited_once_with(
+        "collMod",
+        "sessions",
+        index={"name": "open_session_ttl", "expireAfterSeconds": 120},
+    )
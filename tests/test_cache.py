@@ -0,0 +1,131 @@
+import pytest
+import mongomock_motor
+from app.cache import LRUTTLCache, SessionCache
+from app.models import Message
+from app.sessions import get_or_create_session, append_session_messages
+from app.service_exceptions import SessionConflict
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUTTLCache(max_size=2, ttl_seconds=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = LRUTTLCache(max_size=10, ttl_seconds=5, clock=clock)
+    cache.put("a", 1)
+    clock.now = 4.9
+    assert cache.get("a") == 1
+    clock.now = 5.0
+    assert cache.get("a") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["expirations"] == 1
+    assert stats["size"] == 0
+
+
+def test_session_cache_rejects_unknown_mode():
+    with pytest.raises(ValueError):
+        SessionCache(mode="sticky")
+
+
+def test_session_cache_extend_requires_matching_turn():
+    cache = SessionCache()
+    hello = Message(role="user", content="Hello")
+    hi = Message(role="assistant", content="Hi")
+    cache.store("s", 1, [hello], [hello.model_dump()])
+
+    cache.extend("s", 1, 2, [hi], [hi.model_dump()])
+    cached = cache.get("s")
+    assert [m.content for m in cached.messages] == ["Hello", "Hi"]
+    assert [d["content"] for d in cached.documents] == ["Hello", "Hi"]
+
+    again = Message(role="assistant", content="Again")
+    cache.extend("s", 1, 2, [again], [again.model_dump()])
+    assert cache.get("s") is None
+
+
+@pytest.mark.parametrize("mode", ["versioned", "local"])
+async def test_cached_session_round_trip(mode):
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
+    cache = SessionCache(mode=mode)
+    session_id, history = await get_or_create_session(sessions, cache=cache)
+    await append_session_messages(
+        sessions,
+        session_id,
+        [Message(role="user", content="Hello")],
+        turn=history.turn,
+        cache=cache,
+    )
+
+    _, history = await get_or_create_session(sessions, session_id, cache=cache)
+    assert history.turn == 1
+    assert all(isinstance(m, Message) for m in history)
+    assert [m.content for m in history] == ["Hello"]
+    assert cache.stats()["hits"] == 1
+
+
+async def test_versioned_cache_detects_write_from_other_worker():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
+    ours, theirs = SessionCache(), SessionCache()
+    session_id, _ = await get_or_create_session(sessions, cache=ours)
+    _, history = await get_or_create_session(sessions, session_id, cache=theirs)
+    await append_session_messages(
+        sessions,
+        session_id,
+        [Message(role="user", content="Hello")],
+        turn=history.turn,
+        cache=theirs,
+    )
+
+    _, history = await get_or_create_session(sessions, session_id, cache=ours)
+    assert history.turn == 1
+    assert [m.content for m in history] == ["Hello"]
+    assert ours.stats()["stale"] == 1
+
+
+async def test_local_cache_stale_write_is_rejected_and_dropped():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
+    ours, theirs = SessionCache(mode="local"), SessionCache(mode="local")
+    session_id, _ = await get_or_create_session(sessions, cache=ours)
+    _, history = await get_or_create_session(sessions, session_id, cache=theirs)
+    await append_session_messages(
+        sessions,
+        session_id,
+        [Message(role="user", content="Hello")],
+        turn=history.turn,
+        cache=theirs,
+    )
+
+    _, history = await get_or_create_session(sessions, session_id, cache=ours)
+    assert history.turn == 0
+    with pytest.raises(SessionConflict):
+        await append_session_messages(
+            sessions,
+            session_id,
+            [Message(role="user", content="Hi")],
+            turn=history.turn,
+            cache=ours,
+        )
+
+    _, history = await get_or_create_session(sessions, session_id, cache=ours)
+    assert history.turn == 1
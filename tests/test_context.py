@@ -0,0 +1,84 @@
+import json
+from app.context import (
+    compact_messages,
+    estimate_tokens,
+    latest_form_state,
+    recent_turns,
+)
+from app.insurance_agent import InsuranceAgent
+from app.models import Message
+
+
+def conversation(turns: int):
+    history = []
+    for i in range(turns):
+        history.append(Message(role="user", content=f"Answer number {i} " * 10))
+        history.append(
+            Message(
+                role="assistant",
+                content=json.dumps(
+                    {
+                        "reasoning": "Still collecting details " * 5,
+                        "next_question": f"Question {i + 1}?",
+                        "car_type": "Minivan",
+                        "licence_plate_number": "567-78AA" if i >= 2 else "",
+                        "manufacturer_or_brand": "Toyota",
+                        "year_of_construction": "",
+                        "complete": False,
+                        "birthdate": "",
+                        "name": "",
+                    }
+                ),
+            )
+        )
+    return history
+
+
+def test_estimate_tokens():
+    assert estimate_tokens([{"role": "user", "content": "a" * 40}]) == 14
+
+
+def test_latest_form_state_skips_plain_text_replies():
+    history = conversation(3) + [
+        Message(role="assistant", content="There is already a record for ...")
+    ]
+    assert latest_form_state(history) == {
+        "car_type": "Minivan",
+        "licence_plate_number": "567-78AA",
+        "manufacturer_or_brand": "Toyota",
+    }
+
+
+def test_recent_turns():
+    history = conversation(5)
+    recent = recent_turns(history, 2)
+    assert len(recent) == 4
+    assert recent[0].content.startswith("Answer number 3")
+    assert recent_turns(history, 10) == history
+
+
+def test_short_conversation_is_sent_unchanged():
+    history = conversation(2)
+    messages = compact_messages("prompt", history, window_turns=1, token_budget=10000)
+    assert messages == [{"role": "system", "content": "prompt"}] + [
+        h.model_dump() for h in history
+    ]
+
+
+def test_long_conversation_prompt_size_is_flat():
+    sizes = []
+    for turns in (10, 50, 200):
+        messages = compact_messages(
+            "prompt", conversation(turns), window_turns=2, token_budget=500
+        )
+        sizes.append(estimate_tokens(messages))
+        assert len(messages) == 6
+        assert "567-78AA" in messages[1]["content"]
+    assert max(sizes) - min(sizes) < 20
+
+
+def test_agent_uses_configured_window():
+    agent = InsuranceAgent()
+    agent.context = {"window_turns": 1, "token_budget": 100}
+    messages = agent.build_messages(conversation(20))
+    assert [m["role"] for m in messages] == ["system", "system", "user", "assistant"]
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+from app import db
+
+
+def test_client_options_from_environment(monkeypatch):
+    monkeypatch.setenv("MONGODB_MAX_POOL_SIZE", "8")
+    monkeypatch.setenv("MONGODB_MIN_POOL_SIZE", "1")
+    monkeypatch.setenv("MONGODB_COMPRESSORS", "zlib")
+    options = db.get_client_options()
+
+    assert options["maxPoolSize"] == 8
+    assert options["minPoolSize"] == 1
+    assert options["compressors"] == "zlib"
+    assert options["waitQueueTimeoutMS"] == 2000
+
+
+def test_client_options_without_compression(monkeypatch):
+    monkeypatch.delenv("MONGODB_COMPRESSORS", raising=False)
+    assert "compressors" not in db.get_client_options()
+
+
+def test_pool_stats():
+    stats = db.PoolStats()
+    stats.connection_created(SimpleNamespace())
+    stats.connection_created(SimpleNamespace())
+    stats.connection_checked_out(SimpleNamespace(duration=0.002))
+    stats.connection_checked_out(SimpleNamespace(duration=0.010))
+    stats.connection_checked_in(SimpleNamespace())
+    stats.connection_check_out_failed(SimpleNamespace(reason="timeout", duration=2.0))
+    stats.connection_closed(SimpleNamespace())
+
+    result = stats.stats()
+    assert result["open"] == 1
+    assert result["checked_out"] == 1
+    assert result["max_checked_out"] == 2
+    assert result["checkouts"] == 2
+    assert result["checkout_failures"] == {"timeout": 1}
+    assert result["wait_seconds_max"] == 2.0
+
+
+def test_connect_and_close(monkeypatch):
+    monkeypatch.setenv("MONGODB_MIN_POOL_SIZE", "0")
+    with (
+        patch("app.db.client", None),
+        patch("app.db.db", None),
+        patch("app.db.sessions", None),
+        patch("app.db.records", None),
+    ):
+        db.connect()
+        assert db.client is not None
+        assert db.sessions.name == "sessions"
+        assert db.records.name == "records"
+        assert db.client.options.pool_options.max_pool_size == 25
+
+        db.close()
+        assert db.client is None
+        assert db.sessions is None
+
+
+def test_connect_keeps_bound_collections(monkeypatch):
+    monkeypatch.setenv("MONGODB_MIN_POOL_SIZE", "0")
+    sentinel = object()
+    with (
+        patch("app.db.client", None),
+        patch("app.db.db", None),
+        patch("app.db.sessions", sentinel),
+        patch("app.db.records", None),
+    ):
+        db.connect()
+        assert db.sessions is sentinel
+        db.close()
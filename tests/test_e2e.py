@@ -1,5 +1,5 @@
 import pytest
-from app.app import app
+from app.app import app, prompt_registry
 from unittest.mock import patch, AsyncMock
 import json
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -93,7 +93,8 @@ async def test_complete_conversation_flow(async_client, test_db, mock_insurance_
     assert record["form_data"]["car_type"] == "Sedan"
     assert record["form_data"]["manufacturer_or_brand"] == "Toyota"
     assert record["form_data"]["year_of_construction"] == "2020"
-    assert record["prompt_used"] == "test prompt"
+    assert record["prompt_version"] == prompt_registry.current.version
+    assert "prompt_used" not in record
 
 
 @pytest.mark.asyncio
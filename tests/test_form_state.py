@@ -0,0 +1,299 @@
+import json
+import mongomock_motor
+import pytest
+from unittest.mock import AsyncMock, patch
+from app.cache import SessionCache
+from app.context import compact_messages, form_state_message
+from app.form_state import (
+    FormState,
+    FormTracker,
+    asked_fields,
+    extract_field,
+    valid_birthdate,
+    valid_car_type,
+    valid_plate,
+    valid_year,
+)
+from app.models import Message
+from app.sessions import append_session_messages, get_or_create_session
+
+KNOWN = {
+    "car_type": "Minivan",
+    "licence_plate_number": "567-78AA",
+    "manufacturer_or_brand": "Toyota",
+    "year_of_construction": "2021",
+    "name": "Zhenya",
+}
+
+
+def asked(question: str, **form) -> Message:
+    return Message(
+        role="assistant",
+        content=json.dumps({"next_question": question, "complete": False, **form}),
+    )
+
+
+def test_validators():
+    assert valid_plate(" 567-78aa ") == "567-78AA"
+    assert valid_plate("567_78AA") is None
+    assert valid_year("2021") == "2021"
+    assert valid_year("1850") is None
+    assert valid_year("soon") is None
+    assert valid_birthdate("20.12.1959") == "1959-12-20"
+    assert valid_birthdate("December 20, 1959") == "1959-12-20"
+    assert valid_birthdate("2020-01-01") is None
+    assert valid_car_type("station  WAGON") == "Station Wagon"
+    assert valid_car_type("Truck") is None
+
+
+@pytest.mark.parametrize(
+    "field, message, only_field, expected",
+    [
+        ("birthdate", "I was born on 1959-12-20", False, "1959-12-20"),
+        ("birthdate", "1959-12-20 or 1960-01-01", False, None),
+        ("year_of_construction", "It was built in 2021", False, "2021"),
+        ("year_of_construction", "2019, maybe 2020", False, None),
+        ("licence_plate_number", "My plate is 567-78AA.", True, "567-78AA"),
+        ("licence_plate_number", "maybe 2", True, None),
+        ("car_type", "A toyota minivan", False, "Minivan"),
+        ("name", "My name is Zhenya", True, "Zhenya"),
+        ("name", "Zhenya", False, None),
+        ("manufacturer_or_brand", "It's a Toyota", True, "Toyota"),
+        ("manufacturer_or_brand", "I think it's a Toyota, why?", True, None),
+    ],
+)
+def test_extract_field(field, message, only_field, expected):
+    assert extract_field(field, message, only_field) == expected
+
+
+def test_asked_fields():
+    history = [asked("What is your name and date of birth?")]
+    assert asked_fields(history) == ["birthdate", "name"]
+    assert asked_fields([asked("What year were you born?")]) == ["birthdate"]
+    assert asked_fields([Message(role="assistant", content="Hello")]) == []
+
+
+def test_merge_keeps_provenance_and_pending_changes():
+    state = FormState({"name": {"value": "Ann", "source": "agent", "turn": 0}})
+
+    changed, rejected = state.merge(
+        {"name": "Ann", "year_of_construction": "1850", "car_type": "coupe"},
+        "agent",
+        turn=3,
+    )
+
+    assert changed == ["car_type"]
+    assert rejected == ["year_of_construction"]
+    assert state.fields["car_type"] == {"value": "Coupe", "source": "agent", "turn": 3}
+    assert state.take_updates() == {"car_type": state.fields["car_type"]}
+    assert state.take_updates() == {}
+    state.discard("name")
+    assert state.take_updates() == {"name": None}
+    assert "name" in state.missing()
+
+
+def test_sessions_without_form_state_start_from_the_last_reply():
+    history = [
+        Message(role="user", content="Hi, I drive a sedan"),
+        asked("Plate?", car_type="Sedan", name="Unknown"),
+    ]
+
+    state = FormState.load(None, history)
+
+    assert state.values() == {"car_type": "Sedan"}
+    assert state.pending["car_type"]["source"] == "agent"
+
+
+def test_answer_that_completes_the_form_needs_no_model():
+    tracker = FormTracker()
+    state = FormState.load({}, [])
+    state.merge(KNOWN, "agent", turn=1)
+    history = [
+        asked("When were you born?"),
+        Message(role="user", content="20.12.1959"),
+    ]
+
+    reply = json.loads(tracker.read_answer(state, history, turn=2))
+
+    assert reply["complete"] is True
+    assert reply["birthdate"] == "1959-12-20"
+    assert state.fields["birthdate"]["source"] == "customer"
+    assert tracker.stats()["turns_without_model"] == 1
+    assert (
+        FormTracker(deterministic_completion=False).read_answer(
+            FormState({}), history, turn=2
+        )
+        is None
+    )
+
+
+@pytest.mark.parametrize(
+    "answer", ["Why do you ask", "I don't know", "No idea", "skip", "Ann"]
+)
+def test_free_text_answers_only_go_to_the_model_as_hints(answer):
+    tracker = FormTracker()
+    state = FormState({})
+    state.merge({**KNOWN, "birthdate": "1959-12-20", "name": None}, "customer", turn=1)
+    history = [asked("What is your name?"), Message(role="user", content=answer)]
+
+    # Any short reply fits a name, so only the model can tell one apart
+    assert tracker.read_answer(state, history, turn=2) is None
+    assert state.missing() == ["name"]
+    assert state.values().hints == {"name": answer}
+    message = form_state_message(state.values())["content"]
+    assert json.dumps({"name": answer}, separators=(",", ":")) in message
+    assert tracker.stats()["hinted_fields"] == 1
+
+
+def test_agent_values_need_the_customers_words():
+    tracker = FormTracker()
+    state = FormState({})
+    history = [
+        Message(role="user", content="I'm Ann, born 20.12.1959, plate 567 78aa"),
+        Message(role="user", content="It's a Toyota from 2021"),
+    ]
+    reply = {
+        **KNOWN,
+        "name": "Ann",
+        "licence_plate_number": "567-78AA",
+        "birthdate": "1959-12-20",
+    }
+
+    tracker.record_reply(state, reply, turn=2, history=history)
+
+    # The car type had to be filled in by the model
+    assert state.values() == {
+        "licence_plate_number": "567-78AA",
+        "manufacturer_or_brand": "Toyota",
+        "year_of_construction": "2021",
+        "name": "Ann",
+        "birthdate": "1959-12-20",
+    }
+    assert state.missing() == ["car_type"]
+    assert tracker.stats()["unsupported"] == {"car_type": 1}
+    # So an answer to another question can't complete the form
+    history += [asked("What is your name?"), Message(role="user", content="Ann")]
+    assert tracker.read_answer(state, history, turn=3) is None
+
+
+def test_form_state_is_sent_to_the_model():
+    history = [Message(role="user", content="Hi")]
+
+    messages = compact_messages(
+        "prompt", history, window_turns=2, token_budget=1000, form_state={"name": "Ann"}
+    )
+
+    assert messages[1]["role"] == "system"
+    assert '{"name":"Ann"}' in messages[1]["content"]
+    assert "Still missing: car_type, licence_plate_number" in messages[1]["content"]
+
+
+async def test_form_updates_are_written_with_the_turn():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
+    cache = SessionCache()
+    session_id, _ = await get_or_create_session(sessions, cache=cache)
+    entry = {"value": "Ann", "source": "customer", "turn": 0}
+    reply = [Message(role="assistant", content="{}")]
+
+    await append_session_messages(
+        sessions, session_id, reply, 0, cache, form_updates={"name": entry}
+    )
+    _, history = await get_or_create_session(sessions, session_id, cache=cache)
+    assert history.form_state == {"name": entry}
+
+    await append_session_messages(
+        sessions, session_id, reply, 1, cache, form_updates={"name": None}
+    )
+    session = await sessions.find_one({"_id": session_id})
+    assert session["form_state"] == {}
+    assert cache.get(session_id).form_state == {}
+
+
+async def test_chat_completes_from_the_answer(mock_db, async_client):
+    form_state = {
+        field: {"value": value, "source": "agent", "turn": 1}
+        for field, value in KNOWN.items()
+    }
+    await mock_db.sessions.insert_one(
+        {
+            "_id": "s1",
+            "history": [
+                {"role": "user", "content": "Hi"},
+                {"role": "assistant", "content": asked("Your birthdate?").content},
+            ],
+            "turn": 1,
+            "form_state": form_state,
+        }
+    )
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+    ) as respond:
+        response = await async_client.post(
+            "/chat", json={"session_id": "s1", "message": "I was born 1959-12-20"}
+        )
+
+    respond.assert_not_awaited()
+    assert response.json()["complete"] is True
+    record = await mock_db.records.find_one({"licence_plate": "567-78AA"})
+    assert record["form_data"]["birthdate"] == "1959-12-20"
+    session = await mock_db.sessions.find_one({"_id": "s1"})
+    assert session["form_state"]["birthdate"]["source"] == "customer"
+
+
+async def test_chat_asks_the_model_about_a_free_text_answer(mock_db, async_client):
+    known = {**KNOWN, "birthdate": "1959-12-20"}
+    del known["name"]
+    await mock_db.sessions.insert_one(
+        {
+            "_id": "s1",
+            "history": [
+                {"role": "user", "content": "Hi"},
+                {"role": "assistant", "content": asked("What is your name?").content},
+            ],
+            "turn": 1,
+            "form_state": {
+                field: {"value": value, "source": "customer", "turn": 1}
+                for field, value in known.items()
+            },
+        }
+    )
+    reply = asked("Could you tell me your name, please?", **known)
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", return_value=reply.content
+    ) as respond:
+        response = await async_client.post(
+            "/chat", json={"session_id": "s1", "message": "I don't know"}
+        )
+
+    assert respond.await_args.kwargs["form_state"].hints == {"name": "I don't know"}
+    assert response.json()["complete"] is False
+    assert await mock_db.records.count_documents({}) == 0
+
+
+async def test_chat_tracks_the_agent_reply(mock_db, async_client):
+    reply = asked("What year was it built?", car_type="Sedan", name="Ann")
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", return_value=reply.content
+    ) as respond:
+        first = await async_client.post(
+            "/chat", json={"session_id": None, "message": "Hi, I'm Ann"}
+        )
+        await async_client.post(
+            "/chat",
+            json={"session_id": first.json()["session_id"], "message": "In 2019"},
+        )
+
+    assert respond.await_args_list[0].kwargs["form_state"] == {}
+    # The year came from the customer's answer, the name from the first reply;
+    # its car type was never said by the customer
+    assert respond.await_args_list[1].kwargs["form_state"] == {
+        "name": "Ann",
+        "year_of_construction": "2019",
+    }
+    session = await mock_db.sessions.find_one({"_id": first.json()["session_id"]})
+    assert session["form_state"]["year_of_construction"]["source"] == "customer"
+    assert session["form_state"]["name"] == {
+        "value": "Ann",
+        "source": "agent",
+        "turn": 0,
+    }
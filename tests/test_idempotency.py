@@ -0,0 +1,206 @@
+import asyncio
+import json
+import pytest
+import mongomock_motor
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, patch
+from app.idempotency import IdempotencyStore, SessionLocks
+from app.service_exceptions import IdempotencyKeyReused
+
+REPLY = json.dumps({"next_question": "What is your name?", "complete": False})
+
+
+def slow_turn(result="done", delay=0.02, error=None):
+    async def turn():
+        turn.calls += 1
+        turn.running += 1
+        turn.max_running = max(turn.max_running, turn.running)
+        await asyncio.sleep(delay)
+        turn.running -= 1
+        if error is not None:
+            raise error
+        return result
+
+    turn.calls = turn.running = turn.max_running = 0
+    return turn
+
+
+async def test_identical_turns_are_coalesced():
+    locks = SessionLocks()
+    turn = slow_turn()
+
+    results = await asyncio.gather(
+        locks.run("s", "same", turn), locks.run("s", "same", turn)
+    )
+
+    assert results == ["done", "done"]
+    assert turn.calls == 1
+    assert locks.stats()["coalesced"] == 1
+    assert locks.stats()["sessions"] == 0
+
+
+async def test_different_turns_of_a_session_run_one_at_a_time():
+    locks = SessionLocks()
+    turn = slow_turn()
+
+    await asyncio.gather(locks.run("s", "a", turn), locks.run("s", "b", turn))
+
+    assert turn.calls == 2
+    assert turn.max_running == 1
+    assert locks.stats()["waited"] == 1
+
+
+async def test_other_sessions_are_not_blocked():
+    locks = SessionLocks()
+    turn = slow_turn()
+
+    await asyncio.gather(locks.run("s1", "a", turn), locks.run("s2", "a", turn))
+
+    assert turn.max_running == 2
+
+
+async def test_waiters_share_the_failure():
+    locks = SessionLocks()
+    turn = slow_turn(error=ValueError("boom"))
+
+    results = await asyncio.gather(
+        locks.run("s", "same", turn),
+        locks.run("s", "same", turn),
+        return_exceptions=True,
+    )
+
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert turn.calls == 1
+
+
+async def test_waiter_runs_the_turn_when_the_original_is_cancelled():
+    locks = SessionLocks()
+    turn = slow_turn()
+    original = asyncio.create_task(locks.run("s", "same", turn))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(locks.run("s", "same", turn))
+    await asyncio.sleep(0)
+
+    original.cancel()
+
+    assert await waiter == "done"
+    assert turn.calls == 2
+
+
+async def test_store_round_trip_and_expiry():
+    collection = mongomock_motor.AsyncMongoMockClient()["chatbot"]["chat_responses"]
+    store = IdempotencyStore(collection, ttl_seconds=60)
+    await store.ensure_indexes()
+
+    assert await store.get("s", "k", "10.0.0.1", "body") is None
+    await store.put("s", "k", "10.0.0.1", "body", {"agent_response": "Hi"})
+    assert await store.get("s", "k", "10.0.0.1", "body") == {"agent_response": "Hi"}
+    assert await store.get("other", "k", "10.0.0.1", "body") is None
+    with pytest.raises(IdempotencyKeyReused):
+        await store.get("s", "k", "10.0.0.1", "other body")
+
+    await collection.update_many(
+        {}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+    assert await store.get("s", "k", "10.0.0.1", "body") is None
+
+
+async def test_new_session_keys_are_scoped_to_the_client():
+    collection = mongomock_motor.AsyncMongoMockClient()["chatbot"]["chat_responses"]
+    store = IdempotencyStore(collection)
+    await store.put(None, "k", "10.0.0.1", "body", {"session_id": "s1"})
+
+    assert await store.get(None, "k", "10.0.0.1", "body") == {"session_id": "s1"}
+    assert await store.get(None, "k", "10.0.0.2", "body") is None
+
+
+@pytest.fixture
+def mongo():
+    database = mongomock_motor.AsyncMongoMockClient()["chatbot"]
+    with (
+        patch("app.db.sessions", database.sessions),
+        patch("app.db.records", database.records),
+        patch("app.db.chat_responses", database.chat_responses),
+    ):
+        yield database
+
+
+def test_retry_with_idempotency_key_is_replayed(mongo, client):
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+    ) as mock_respond:
+        mock_respond.return_value = REPLY
+        first = client.post(
+            "/chat",
+            json={"session_id": None, "message": "Hi"},
+            headers={"Idempotency-Key": "abc"},
+        )
+        retry = client.post(
+            "/chat",
+            json={"session_id": None, "message": "Hi"},
+            headers={"Idempotency-Key": "abc"},
+        )
+
+        assert retry.status_code == 200
+        assert retry.json() == first.json()
+        mock_respond.assert_awaited_once()
+
+        # The body field works for clients that can't send headers
+        client.post(
+            "/chat",
+            json={"session_id": None, "message": "Hi", "idempotency_key": "def"},
+        )
+        assert mock_respond.await_count == 2
+
+
+async def test_double_submit_is_coalesced(mongo, async_client):
+    await mongo.sessions.insert_one({"_id": "s1", "history": [], "turn": 0})
+
+    async def slow_reply(history, **kwargs):
+        await asyncio.sleep(0.02)
+        return REPLY
+
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", side_effect=slow_reply
+    ) as mock_respond:
+        request = {"session_id": "s1", "message": "Hi"}
+        first, second = await asyncio.gather(
+            async_client.post("/chat", json=request),
+            async_client.post("/chat", json=request),
+        )
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert mock_respond.call_count == 1
+    session = await mongo.sessions.find_one({"_id": "s1"})
+    assert len(session["history"]) == 2
+
+
+def test_key_reused_by_another_client_or_body(mongo, client):
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+    ) as mock_respond:
+        mock_respond.return_value = REPLY
+        headers = {"Idempotency-Key": "1"}
+        alice = client.post(
+            "/chat",
+            json={"session_id": None, "message": "hi I'm alice"},
+            headers=headers,
+        )
+        changed = client.post(
+            "/chat",
+            json={"session_id": None, "message": "hi I'm bob"},
+            headers=headers,
+        )
+        with patch("app.app.client_id", return_value="10.0.0.2"):
+            bob = client.post(
+                "/chat",
+                json={"session_id": None, "message": "hi I'm alice"},
+                headers=headers,
+            )
+
+    assert changed.status_code == 422
+    assert bob.status_code == 200
+    # Another client's request starts its own session
+    assert bob.json()["session_id"] != alice.json()["session_id"]
+    assert mock_respond.await_count == 2
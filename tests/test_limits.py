@@ -0,0 +1,285 @@
+import ipaddress
+import json
+import pytest
+import mongomock_motor
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+from pymongo.errors import PyMongoError
+from app.context import estimate_tokens
+from app.insurance_agent import InsuranceAgent
+from app.limits import (
+    BudgetExhausted,
+    MemoryBackend,
+    MongoBackend,
+    RateLimited,
+    RateLimiter,
+    TokenBudget,
+    TokenUsage,
+)
+from app.models import Message
+from app.service_exceptions import SessionConflict
+from app.session_writer import SessionWriter
+
+CAR_INFO = {
+    "reasoning": "Need the car type",
+    "next_question": "Which type of car do you drive?",
+    "car_type": "Sedan",
+    "licence_plate_number": "",
+    "manufacturer_or_brand": "",
+    "year_of_construction": "",
+    "complete": False,
+    "birthdate": "",
+    "name": "",
+}
+MESSAGES = [{"role": "user", "content": "x" * 40}]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def completion_with_usage(prompt_tokens=120, completion_tokens=30, reply=CAR_INFO):
+    calls = []
+
+    async def completion(model, messages, **kwargs):
+        calls.append(messages)
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(message=SimpleNamespace(content=json.dumps(reply)))
+            ],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+            ),
+        )
+
+    completion.calls = calls
+    return completion
+
+
+def test_usage_reported_or_estimated():
+    usage = TokenUsage()
+    usage.add(SimpleNamespace(prompt_tokens=100, completion_tokens=20), MESSAGES, "")
+    usage.add({"prompt_tokens": 5, "completion_tokens": 1}, MESSAGES, "")
+    # Left out by the provider: about four characters per token
+    usage.add(None, MESSAGES, "y" * 80)
+
+    assert usage.prompt_tokens == 105 + estimate_tokens(MESSAGES)
+    assert usage.completion_tokens == 21 + 20
+    assert (usage.calls, usage.estimated) == (3, 1)
+
+
+def test_budget_refuses_once_used_up():
+    budget = TokenBudget(session_tokens=1000)
+    budget.check("s1", 999)
+    with pytest.raises(BudgetExhausted):
+        budget.check("s1", 1000)
+    assert budget.stats()["exhausted"] == 1
+
+
+@pytest.fixture(params=["memory", "mongo"])
+def backend(request):
+    if request.param == "memory":
+        return MemoryBackend()
+    return MongoBackend(mongomock_motor.AsyncMongoMockClient()["chatbot"].rate_limits)
+
+
+async def test_bucket_allows_burst_then_refills(backend):
+    clock = Clock()
+    limiter = RateLimiter(
+        backend, client_turns_per_minute=6, client_burst=2, clock=clock
+    )
+    await limiter.check("10.0.0.1", None)
+    await limiter.check("10.0.0.1", None)
+    with pytest.raises(RateLimited) as refused:
+        await limiter.check("10.0.0.1", None)
+    assert (refused.value.scope, refused.value.retry_after) == ("client", 10)
+
+    # Other clients have their own bucket
+    await limiter.check("10.0.0.2", None)
+    clock.now += 10
+    await limiter.check("10.0.0.1", None)
+    assert limiter.stats()["limited"] == {"client": 1, "session": 0}
+
+
+async def test_session_bucket_only_for_known_sessions():
+    clock = Clock()
+    limiter = RateLimiter(
+        MemoryBackend(), session_turns_per_minute=1, session_burst=1, clock=clock
+    )
+    await limiter.check("10.0.0.1", None)
+    await limiter.check("10.0.0.1", None)
+    await limiter.check("10.0.0.1", "s1")
+    with pytest.raises(RateLimited) as refused:
+        await limiter.check("10.0.0.2", "s1")
+    assert (refused.value.scope, refused.value.retry_after) == ("session", 60)
+
+
+async def test_mongo_buckets_are_shared_between_workers():
+    collection = mongomock_motor.AsyncMongoMockClient()["chatbot"].rate_limits
+    clock = Clock()
+    workers = [
+        RateLimiter(MongoBackend(collection), client_burst=3, clock=clock)
+        for _ in range(2)
+    ]
+    for worker in workers + workers[:1]:
+        await worker.check("10.0.0.1", None)
+    with pytest.raises(RateLimited):
+        await workers[1].check("10.0.0.1", None)
+
+
+async def test_backend_errors_let_turns_through():
+    backend = AsyncMock()
+    backend.take.side_effect = PyMongoError("down")
+    limiter = RateLimiter(backend)
+    await limiter.check("10.0.0.1", "s1")
+    assert limiter.stats()["errors"] == 2
+
+
+async def test_agent_collects_usage_of_every_call():
+    agent = InsuranceAgent(completion=completion_with_usage())
+    usage = TokenUsage()
+    history = [Message(role="user", content="hello")]
+    await agent.respond(history, usage=usage)
+    await agent.complete_fields(history, {}, ["name"], usage=usage)
+
+    assert (usage.prompt_tokens, usage.completion_tokens, usage.calls) == (240, 60, 2)
+
+
+async def test_stream_usage_from_last_chunk():
+    async def completion(model, messages, stream=False, stream_options=None, **kw):
+        assert stream_options == {"include_usage": True}
+
+        async def chunks():
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content="{}"))]
+            )
+            yield SimpleNamespace(
+                choices=[],
+                usage=SimpleNamespace(prompt_tokens=50, completion_tokens=7),
+            )
+
+        return chunks()
+
+    agent = InsuranceAgent(completion=completion)
+    usage = TokenUsage()
+    deltas = await agent.respond_stream(
+        [Message(role="user", content="hello")], usage=usage
+    )
+    assert [d async for d in deltas] == ["{}"]
+    assert (usage.total, usage.estimated) == (57, 0)
+
+
+async def test_chat_rate_limited(mock_db, async_client):
+    limiter = RateLimiter(MemoryBackend(), client_turns_per_minute=1, client_burst=1)
+    agent = InsuranceAgent(completion=completion_with_usage())
+    with (
+        patch("app.app.rate_limiter", limiter),
+        patch("app.app.insurance_agent", agent),
+    ):
+        body = {"session_id": None, "message": "hello"}
+        first = await async_client.post("/chat", json=body)
+        second = await async_client.post("/chat", json=body)
+
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert second.headers["Retry-After"] == "60"
+    assert len(agent.completion.calls) == 1
+
+
+@pytest.mark.parametrize(
+    "trusted, statuses", [([], [200, 429, 429]), (["127.0.0.0/8"], [200, 200, 429])]
+)
+async def test_chat_rate_limited_per_forwarded_address(
+    mock_db, async_client, trusted, statuses
+):
+    limiter = RateLimiter(MemoryBackend(), client_turns_per_minute=1, client_burst=1)
+    agent = InsuranceAgent(completion=completion_with_usage())
+    proxies = [ipaddress.ip_network(network) for network in trusted]
+    with (
+        patch("app.app.rate_limiter", limiter),
+        patch("app.app.trusted_proxies", proxies),
+        patch("app.app.insurance_agent", agent),
+    ):
+        body = {"session_id": None, "message": "hello"}
+        responses = [
+            await async_client.post(
+                "/chat", json=body, headers={"X-Forwarded-For": forwarded}
+            )
+            for forwarded in ["203.0.113.5", "203.0.113.6, 127.0.0.2", "203.0.113.6"]
+        ]
+
+    # Only a trusted proxy's X-Forwarded-For tells callers apart
+    assert [r.status_code for r in responses] == statuses
+
+
+async def test_chat_tokens_kept_on_session_until_budget_is_used(mock_db, async_client):
+    agent = InsuranceAgent(completion=completion_with_usage())
+    with (
+        patch("app.app.token_budget", TokenBudget(session_tokens=250)),
+        patch("app.app.insurance_agent", agent),
+    ):
+        first = await async_client.post(
+            "/chat", json={"session_id": None, "message": "hello"}
+        )
+        session_id = first.json()["session_id"]
+        body = {"session_id": session_id, "message": "a sedan"}
+        second = await async_client.post("/chat", json=body)
+        third = await async_client.post("/chat", json=body)
+
+    assert (first.status_code, second.status_code) == (200, 200)
+    assert third.status_code == 429
+    assert third.json()["detail"] == "This session has used up its token budget"
+    assert len(agent.completion.calls) == 2
+    session = await mock_db.sessions.find_one({"_id": session_id})
+    assert session["tokens_used"] == 300
+
+
+async def test_failed_turn_still_counts_its_tokens(mock_db, async_client):
+    # Neither the reply nor the follow-up has a next question
+    reply = {**CAR_INFO, "next_question": ""}
+    agent = InsuranceAgent(completion=completion_with_usage(reply=reply))
+    with patch("app.app.insurance_agent", agent):
+        response = await async_client.post(
+            "/chat", json={"session_id": None, "message": "hello"}
+        )
+
+    assert response.status_code == 500
+    assert len(agent.completion.calls) == 2
+    session = await mock_db.sessions.find_one({})
+    assert session["history"] == []
+    assert session["tokens_used"] == 300
+
+
+async def test_budget_checked_before_follow_up(mock_db, async_client):
+    reply = {**CAR_INFO, "next_question": ""}
+    agent = InsuranceAgent(completion=completion_with_usage(reply=reply))
+    with (
+        patch("app.app.token_budget", TokenBudget(session_tokens=100)),
+        patch("app.app.insurance_agent", agent),
+    ):
+        response = await async_client.post(
+            "/chat", json={"session_id": None, "message": "hello"}
+        )
+
+    # The first call used up the budget, so the follow-up isn't made
+    assert response.status_code == 429
+    assert len(agent.completion.calls) == 1
+    session = await mock_db.sessions.find_one({})
+    assert session["tokens_used"] == 150
+
+
+async def test_refused_write_behind_still_counts_its_tokens():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"].sessions
+    await sessions.insert_one({"_id": "s1", "history": [], "turn": 4})
+    writer = SessionWriter(sessions, "s1", turn=3)
+    writer.start()
+    await writer.append([Message(role="user", content="hi")], tokens=150)
+    with pytest.raises(SessionConflict):
+        await writer.close()
+
+    session = await sessions.find_one({"_id": "s1"})
+    assert (session["history"], session["tokens_used"]) == ([], 150)
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import pytest
+from types import SimpleNamespace
+from app.insurance_agent import InsuranceAgent
+from app.llm_router import CircuitBreaker, LLMRouter, ModelRoute, RouterExhausted
+from app.models import Message
+from app.service_exceptions import AgentNotAvailable
+
+CAR_INFO = json.dumps(
+    {
+        "reasoning": "All details given",
+        "next_question": "",
+        "car_type": "Sedan",
+        "licence_plate_number": "ABC123",
+        "manufacturer_or_brand": "Toyota",
+        "year_of_construction": "2020",
+        "complete": True,
+        "birthdate": "1990-01-01",
+        "name": "John Doe",
+    }
+)
+
+
+def fake_completion(behaviour):
+    # behaviour maps a model to (delay in seconds, content or exception)
+    calls = []
+
+    async def completion(model, messages, **kwargs):
+        calls.append(model)
+        delay, outcome = behaviour[model]
+        await asyncio.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=outcome))]
+        )
+
+    completion.calls = calls
+    return completion
+
+
+def router(*models, **kwargs):
+    kwargs.setdefault("hedge_after_seconds", 0.05)
+    return LLMRouter([ModelRoute(model=m, timeout_seconds=1) for m in models], **kwargs)
+
+
+async def test_primary_answers_without_hedging():
+    llm = router("a", "b")
+    completion = fake_completion({"a": (0, CAR_INFO), "b": (0, CAR_INFO)})
+
+    assert await llm.complete(completion, []) == CAR_INFO
+    assert completion.calls == ["a"]
+
+
+async def test_slow_primary_is_hedged():
+    llm = router("a", "b")
+    completion = fake_completion({"a": (0.5, CAR_INFO), "b": (0, CAR_INFO)})
+
+    assert await llm.complete(completion, []) == CAR_INFO
+    assert completion.calls == ["a", "b"]
+    stats = llm.stats()
+    assert stats["b"]["wins"] == 1
+    assert stats["b"]["hedges"] == 1
+    # Losing the race doesn't count against the primary
+    assert stats["a"]["failures"] == 0
+    assert stats["a"]["state"] == "closed"
+
+
+async def test_failure_moves_on_immediately():
+    llm = router("a", "b", hedge_after_seconds=10)
+    completion = fake_completion({"a": (0, RuntimeError("down")), "b": (0, CAR_INFO)})
+
+    assert await asyncio.wait_for(llm.complete(completion, []), 1) == CAR_INFO
+    assert llm.stats()["a"]["failures"] == 1
+
+
+async def test_per_model_timeout():
+    llm = LLMRouter(
+        [ModelRoute("a", timeout_seconds=0.01), ModelRoute("b", timeout_seconds=1)],
+        hedging=False,
+    )
+    completion = fake_completion({"a": (0.5, CAR_INFO), "b": (0, CAR_INFO)})
+
+    assert await llm.complete(completion, []) == CAR_INFO
+    assert llm.stats()["a"]["timeouts"] == 1
+
+
+async def test_first_valid_reply_wins():
+    llm = router("a", "b")
+    completion = fake_completion(
+        {"a": (0, "Sorry, I can't help with that"), "b": (0, CAR_INFO)}
+    )
+
+    assert await llm.complete(completion, []) == CAR_INFO
+    assert llm.stats()["a"]["invalid"] == 1
+
+
+async def test_repairable_reply_is_not_failed_over():
+    # Fenced or incomplete replies are left to the response parser
+    llm = router("a", "b")
+    fenced = f"```json\n{CAR_INFO}\n```"
+    partial = '{"next_question": "What is your name?"}'
+    completion = fake_completion({"a": (0, fenced), "b": (0, CAR_INFO)})
+
+    assert await llm.complete(completion, []) == fenced
+    assert completion.calls == ["a"]
+
+    llm = router("a", "b")
+    completion = fake_completion({"a": (0, partial), "b": (0, CAR_INFO)})
+    assert await llm.complete(completion, []) == partial
+    assert completion.calls == ["a"]
+    assert llm.stats()["a"]["invalid"] == 0
+
+
+async def test_invalid_reply_is_returned_when_nothing_validates():
+    llm = router("a")
+    completion = fake_completion({"a": (0, "not json")})
+
+    assert await llm.complete(completion, []) == "not json"
+
+
+async def test_exhausted_when_every_model_fails():
+    llm = router("a", "b")
+    completion = fake_completion(
+        {"a": (0, RuntimeError("down")), "b": (0, RuntimeError("down"))}
+    )
+
+    with pytest.raises(RouterExhausted):
+        await llm.complete(completion, [])
+
+
+async def test_ewma_steers_traffic_to_the_faster_model():
+    llm = router("slow", "fast", hedging=False)
+    completion = fake_completion({"slow": (0.03, CAR_INFO), "fast": (0, CAR_INFO)})
+
+    await llm.complete(completion, [])
+    await llm.complete(completion, [])
+    await llm.complete(completion, [])
+
+    # Both get measured once, after that the faster one goes first
+    assert completion.calls == ["slow", "fast", "fast"]
+    assert [r.model for r in llm.ranked()] == ["fast", "slow"]
+
+
+async def test_hedge_delay_follows_p95_once_measured():
+    llm = router("a", min_samples=3)
+    route = llm.routes[0]
+    assert llm.hedge_delay(route) == 0.05
+    route.latencies.extend([0.1, 0.2, 0.3, 0.4])
+    assert llm.hedge_delay(route) == 0.3
+
+
+def test_circuit_breaker_opens_and_half_opens():
+    now = [0.0]
+    breaker = CircuitBreaker(
+        failure_threshold=2, reset_seconds=10, clock=lambda: now[0]
+    )
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    now[0] = 10
+    assert breaker.available()
+    assert breaker.allow()
+    # Only one trial request while half open
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    now[0] = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+async def test_open_breaker_skips_model():
+    llm = router("a", "b")
+    for _ in range(3):
+        llm.routes[0].breaker.record_failure()
+    completion = fake_completion({"a": (0, CAR_INFO), "b": (0, CAR_INFO)})
+
+    assert await llm.complete(completion, []) == CAR_INFO
+    assert completion.calls == ["b"]
+
+
+async def test_stream_fails_over_while_opening():
+    llm = router("a", "b")
+    completion = fake_completion({"a": (0, RuntimeError("down")), "b": (0, CAR_INFO)})
+
+    await llm.open_stream(completion, [], stream=True)
+    assert completion.calls == ["a", "b"]
+
+
+async def test_agent_routes_completions():
+    completion = fake_completion({"a": (0, RuntimeError("down")), "b": (0, CAR_INFO)})
+    agent = InsuranceAgent(completion=completion)
+    agent.router = router("a", "b")
+
+    assert await agent.respond([Message(role="user", content="Hi")]) == CAR_INFO
+
+    agent.completion = fake_completion(
+        {"a": (0, RuntimeError("down")), "b": (0, RuntimeError("down"))}
+    )
+    with pytest.raises(AgentNotAvailable):
+        await agent.respond([Message(role="user", content="Hi")])
@@ -0,0 +1,86 @@
+import json
+import os
+import pytest
+import subprocess
+import sys
+from contextlib import nullcontext
+from unittest.mock import AsyncMock, patch
+from prometheus_client import REGISTRY
+from app import metrics
+from app.service_exceptions import AgentNotAvailable
+
+
+@pytest.fixture
+def mock_db_session():
+    with (
+        patch("app.db.sessions", new_callable=AsyncMock) as mock_sessions,
+        patch("app.db.records", new_callable=AsyncMock) as mock_records,
+    ):
+        yield mock_sessions, mock_records
+
+
+def sample(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_chat_records_stage_timings(mock_db_session, client):
+    mock_sessions, mock_records = mock_db_session
+    mock_sessions.find_one.return_value = None
+    mock_records.find_one.return_value = None
+    stages = ["get_or_create_session", "respond", "detect_duplicate", "update_session"]
+    before = {s: sample("chat_stage_seconds_count", {"stage": s}) for s in stages}
+
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+    ) as mock_respond:
+        mock_respond.return_value = json.dumps(
+            {"next_question": "Name?", "licence_plate_number": "X1", "complete": False}
+        )
+        response = client.post("/chat", json={"session_id": None, "message": "hi"})
+    assert response.status_code == 200
+
+    for stage in stages:
+        assert sample("chat_stage_seconds_count", {"stage": stage}) == before[stage] + 1
+
+    scrape = client.get("/metrics")
+    assert scrape.status_code == 200
+    assert 'chat_stage_seconds_bucket{le="0.001",stage="respond"}' in scrape.text
+
+
+def test_chat_counts_failures(mock_db_session, client):
+    mock_sessions, _ = mock_db_session
+    mock_sessions.find_one.return_value = None
+    before = sample("chat_errors_total", {"kind": "agent_not_available"})
+
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+    ) as mock_respond:
+        mock_respond.side_effect = AgentNotAvailable("down")
+        response = client.post("/chat", json={"session_id": None, "message": "hi"})
+    assert response.status_code == 503
+
+    assert sample("chat_errors_total", {"kind": "agent_not_available"}) == before + 1
+
+
+def test_metrics_disabled(mock_db_session, client, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", False)
+    assert isinstance(metrics.stage("respond"), nullcontext)
+    assert client.get("/metrics").status_code == 404
+
+
+WORKER = """
+from app import metrics
+metrics.stage_seconds.labels("respond").observe(0.2)
+metrics.record_error("database")
+"""
+
+
+def test_multiprocess_aggregation(tmp_path, monkeypatch):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", WORKER], env=env, check=True)
+
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    text = metrics.render().decode()
+    assert 'chat_errors_total{kind="database"} 2.0' in text
+    assert 'chat_stage_seconds_count{stage="respond"} 2.0' in text
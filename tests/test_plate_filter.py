@@ -0,0 +1,83 @@
+import pytest
+import mongomock_motor
+from unittest.mock import AsyncMock, MagicMock
+from app.plate_filter import BloomFilter, PlateFilter
+from app.sessions import detect_duplicate, save_record
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    plates = [f"P{i:05d}" for i in range(1000)]
+    for plate in plates:
+        bloom.add(plate)
+
+    assert all(plate in bloom for plate in plates)
+    # A plate whose bits were all set already is indistinguishable from a repeat
+    assert 990 <= bloom.count <= 1000
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = BloomFilter(capacity=5000, error_rate=0.01)
+    for i in range(5000):
+        bloom.add(f"P{i:05d}")
+
+    false_positives = sum(f"N{i:05d}" in bloom for i in range(20000))
+    assert false_positives / 20000 < 0.02
+    assert bloom.estimated_error_rate() == pytest.approx(0.01, abs=0.005)
+
+
+def test_bloom_filter_rejects_bad_settings():
+    with pytest.raises(ValueError):
+        BloomFilter(capacity=0, error_rate=0.01)
+    with pytest.raises(ValueError):
+        BloomFilter(capacity=10, error_rate=1)
+
+
+def test_plate_filter_falls_through_until_ready():
+    plate_filter = PlateFilter(capacity=100)
+    assert plate_filter.might_contain("ABC123") is True
+    assert plate_filter.stats()["not_ready"] == 1
+
+
+async def test_plate_filter_sync_and_precheck():
+    records = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    await save_record(records, "567-78AA", {"name": "A"}, "prompt")
+    await records.insert_one({"licence_plate": "LEGACY1"})
+    plate_filter = PlateFilter(capacity=100)
+
+    assert await plate_filter.sync(records) == 2
+    assert plate_filter.might_contain("56778aa")
+    assert plate_filter.might_contain("LEGACY1")
+    assert not plate_filter.might_contain("NEW-1")
+
+    await save_record(records, "NEW-1", {"name": "B"}, "prompt", plate_filter)
+    assert plate_filter.might_contain("NEW1")
+
+
+async def test_detect_duplicate_skips_mongo_for_unknown_plate():
+    plate_filter = PlateFilter(capacity=100)
+    plate_filter.ready = True
+    plate_filter.add("ABC123")
+    records = MagicMock()
+    records.find_one = AsyncMock(return_value=None)
+
+    assert await detect_duplicate(records, "XYZ789", plate_filter) is False
+    records.find_one.assert_not_awaited()
+
+    assert await detect_duplicate(records, "ABC-123", plate_filter) is False
+    records.find_one.assert_awaited_once()
+    stats = plate_filter.stats()
+    assert stats["definite_misses"] == 1
+    assert stats["possible_hits"] == 1
+    assert stats["false_positives"] == 1
+
+
+async def test_incremental_sync_picks_up_new_records():
+    records = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    plate_filter = PlateFilter(capacity=100)
+    await plate_filter.sync(records)
+    # Written by another worker after the first sync
+    await save_record(records, "OTHER-1", {"name": "C"}, "prompt")
+
+    await plate_filter.sync(records)
+    assert plate_filter.might_contain("OTHER1")
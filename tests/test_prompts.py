@@ -0,0 +1,165 @@
+import json
+import os
+import mongomock_motor
+import pytest
+import yaml
+from unittest.mock import AsyncMock, patch
+from app.app import reload_config
+from app.config.config import Config
+from app.insurance_agent import InsuranceAgent
+from app.prompts import PromptRegistry, migrate_records, prompt_version
+
+REPLY = json.dumps({"next_question": "What is your name?", "complete": False})
+
+
+def test_prompt_version_is_a_content_hash():
+    assert prompt_version("Be brief") == prompt_version("Be brief")
+    assert prompt_version("Be brief") != prompt_version("Be brief.")
+    assert len(prompt_version("Be brief")) == 16
+
+
+async def test_previous_prompts_stay_available():
+    prompts = mongomock_motor.AsyncMongoMockClient()["chatbot"]["prompts"]
+    registry = PromptRegistry("first", prompts, retain=2)
+    first = registry.current
+    await registry.save(first)
+
+    second = await registry.publish("second")
+    assert await registry.publish("second") is second
+    await registry.publish("third")
+
+    assert registry.current.text == "third"
+    assert (await registry.get(second.version)).text == "second"
+    # Dropped from memory, read back from the collection
+    assert first.version not in registry.stats()["retained"]
+    assert (await registry.get(first.version)).text == "first"
+    assert registry.stats()["loaded"] == 1
+    assert await prompts.count_documents({}) == 3
+
+
+async def test_unknown_prompt_falls_back_to_current():
+    registry = PromptRegistry("current")
+
+    assert (await registry.get("0000")).text == "current"
+    assert (await registry.get(None)).text == "current"
+    assert registry.stats()["missing"] == 1
+
+
+async def test_migrate_records():
+    database = mongomock_motor.AsyncMongoMockClient()["chatbot"]
+    await database.records.insert_many(
+        [{"licence_plate": f"P{i}", "prompt_used": f"prompt {i % 2}"} for i in range(5)]
+    )
+
+    assert await migrate_records(database.records, database.prompts, 2) == 5
+
+    record = await database.records.find_one({"licence_plate": "P1"})
+    assert record["prompt_version"] == prompt_version("prompt 1")
+    assert "prompt_used" not in record
+    assert await database.prompts.count_documents({}) == 2
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    config = Config()
+    saved = (config.config_data, config.version, config.mtime_ns)
+    path = tmp_path / "config.yaml"
+    path.write_text(Config.path.read_text())
+    monkeypatch.setattr(Config, "path", path)
+    config.mtime_ns = path.stat().st_mtime_ns
+    yield path
+    config.config_data, config.version, config.mtime_ns = saved
+
+
+def rewrite(path, **changes):
+    data = yaml.safe_load(path.read_text())
+    data.update(changes)
+    mtime_ns = path.stat().st_mtime_ns
+    path.write_text(yaml.safe_dump(data))
+    os.utime(path, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+
+
+async def test_reload_config(config_file):
+    registry = PromptRegistry(Config().system_prompt)
+    old = registry.current
+    agent = InsuranceAgent(completion=AsyncMock())
+    with (
+        patch("app.app.prompt_registry", registry),
+        patch("app.app.insurance_agent", agent),
+    ):
+        assert await reload_config() is False
+
+        rewrite(config_file, system_prompt="Be brief", model="gpt-4o")
+        assert await reload_config() is True
+
+        assert agent.model == "gpt-4o"
+        assert list(agent.router.stats()) == ["gpt-4o"]
+        assert registry.current.text == "Be brief"
+        assert (await registry.get(old.version)) == old
+
+        # A broken file is ignored until it is fixed
+        config_file.write_text("system_prompt: [")
+        os.utime(config_file, ns=(1, 1))
+        assert await reload_config() is False
+        assert Config().system_prompt == "Be brief"
+
+
+async def test_failed_reload_changes_nothing_and_is_retried(config_file):
+    registry = PromptRegistry(Config().system_prompt)
+    old = registry.current
+    agent = InsuranceAgent(completion=AsyncMock())
+    model = agent.model
+    with (
+        patch("app.app.prompt_registry", registry),
+        patch("app.app.insurance_agent", agent),
+    ):
+        rewrite(config_file, system_prompt="Be terse", model="gpt-4o")
+        with patch.object(registry, "publish", side_effect=RuntimeError("down")):
+            with pytest.raises(RuntimeError):
+                await reload_config()
+        assert (Config().model_name, agent.model) == (model, model)
+        assert registry.current == old
+
+        # The file wasn't marked as applied, so the next check tries again
+        assert await reload_config() is True
+        assert (Config().model_name, agent.model) == ("gpt-4o", "gpt-4o")
+        assert registry.current.text == "Be terse"
+
+        # Routing without models' names fails before the prompt is published
+        rewrite(config_file, system_prompt="Other", router={"models": [{}]})
+        with pytest.raises(KeyError):
+            await reload_config()
+        assert Config().system_prompt == registry.current.text == "Be terse"
+
+
+@pytest.fixture
+def sessions():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
+    with (
+        patch("app.db.sessions", sessions),
+        patch("app.db.records", new_callable=AsyncMock),
+        patch("app.app.prompt_registry", PromptRegistry("prompt A")) as registry,
+    ):
+        yield sessions, registry
+
+
+async def test_sessions_keep_their_prompt(sessions, async_client):
+    sessions, registry = sessions
+    with patch(
+        "app.insurance_agent.InsuranceAgent.respond", return_value=REPLY
+    ) as respond:
+        first = await async_client.post(
+            "/chat", json={"session_id": None, "message": "Hi"}
+        )
+        session_id = first.json()["session_id"]
+        await registry.publish("prompt B")
+
+        await async_client.post(
+            "/chat", json={"session_id": session_id, "message": "Ann"}
+        )
+        await async_client.post("/chat", json={"session_id": None, "message": "Hi"})
+
+    prompts = [call.kwargs["system_prompt"] for call in respond.await_args_list]
+    assert prompts == ["prompt A", "prompt A", "prompt B"]
+    session = await sessions.find_one({"_id": session_id})
+    assert session["prompt_version"] == prompt_version("prompt A")
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import pytest
+import mongomock_motor
+from unittest.mock import AsyncMock, MagicMock, patch
+from pymongo.errors import PyMongoError
+from fastapi.testclient import TestClient
+from app import db
+from app.app import app
+from app.cache import SessionCache
+from app.models import ChatRequest
+from app.record_writer import RecordWriter
+from app.sessions import save_record
+
+
+@pytest.fixture
+async def collections():
+    database = mongomock_motor.AsyncMongoMockClient()["chatbot"]
+    await db.ensure_record_indexes(database.records)
+    await database.sessions.insert_many(
+        [{"_id": f"s{i}", "history": [], "turn": 1} for i in range(3)]
+    )
+    return database.records, database.sessions
+
+
+async def test_flushes_when_batch_is_full(collections):
+    records, sessions = collections
+    writer = RecordWriter(records, sessions, max_batch=2, flush_interval_seconds=60)
+    writer.start()
+
+    await writer.submit("s0", "AA-1", {"name": "A"}, "prompt")
+    await writer.submit("s1", "BB-2", {"name": "B"}, "prompt")
+    await asyncio.sleep(0.01)
+
+    assert await records.count_documents({}) == 2
+    assert (await sessions.find_one({"_id": "s0"}))["record_status"] == "saved"
+    assert writer.stats()["batches"] == 1
+    await writer.close()
+
+
+async def test_close_flushes_pending_records(collections):
+    records, sessions = collections
+    writer = RecordWriter(records, sessions, max_batch=100, flush_interval_seconds=60)
+    writer.start()
+    await writer.submit("s0", "AA-1", {"name": "A"}, "prompt")
+    assert await records.count_documents({}) == 0
+
+    await writer.close()
+
+    assert await records.count_documents({}) == 1
+    assert writer.stats()["pending"] == 0
+
+
+async def test_duplicates_are_reported_on_the_session(collections):
+    records, sessions = collections
+    await save_record(records, "AA1", {"name": "Earlier"}, "prompt")
+    cache = SessionCache(max_size=10, ttl_seconds=60)
+    cache.store("s1", 1, [], [])
+    writer = RecordWriter(records, sessions, session_cache=cache)
+
+    await writer.submit("s0", "BB-2", {"name": "B"}, "prompt")
+    await writer.submit("s1", "aa-1", {"name": "A"}, "prompt")
+    await writer.flush()
+
+    session = await sessions.find_one({"_id": "s1"})
+    assert session["record_status"] == "duplicate"
+    assert session["turn"] == 2
+    assert (
+        "already a record for licence plate aa-1" in session["history"][-1]["content"]
+    )
+    assert cache.peek("s1") is None
+    assert (await sessions.find_one({"_id": "s0"}))["record_status"] == "saved"
+    assert writer.stats()["duplicates"] == 1
+    assert writer.stats()["inserted"] == 1
+
+
+async def test_fire_and_forget_leaves_sessions_alone(collections):
+    records, sessions = collections
+    writer = RecordWriter(records, sessions, durability="fire_and_forget")
+
+    await writer.submit("s0", "AA-1", {"name": "A"}, "prompt")
+    await writer.flush()
+
+    assert await records.count_documents({}) == 1
+    assert "record_status" not in await sessions.find_one({"_id": "s0"})
+
+
+async def test_failed_batch_is_retried(collections):
+    records, sessions = collections
+    writer = RecordWriter(records, sessions)
+    writer.records = MagicMock(insert_many=AsyncMock(side_effect=PyMongoError("down")))
+    await writer.submit("s0", "AA-1", {"name": "A"}, "prompt")
+
+    with pytest.raises(PyMongoError):
+        await writer.flush()
+    assert writer.stats()["pending"] == 1
+
+    writer.records = records
+    await writer.flush()
+    assert await records.count_documents({}) == 1
+
+
+def test_rejects_unknown_durability():
+    records = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    with pytest.raises(ValueError):
+        RecordWriter(records, None, durability="eventually")
+
+
+def test_chat_completion_is_queued():
+    writer = MagicMock(submit=AsyncMock(), close=AsyncMock())
+    with (
+        patch("app.app.build_record_writer", return_value=writer),
+        patch("app.db.sessions", new_callable=AsyncMock) as mock_sessions,
+        patch("app.db.records", new_callable=AsyncMock) as mock_records,
+        patch(
+            "app.insurance_agent.InsuranceAgent.respond", new_callable=AsyncMock
+        ) as mock_respond,
+        patch("app.app.save_record", new_callable=AsyncMock) as mock_save,
+    ):
+        mock_sessions.find_one.return_value = None
+        mock_records.find_one.return_value = None
+        mock_respond.return_value = json.dumps(
+            {
+                "car_type": "Sedan",
+                "licence_plate_number": "ABC123",
+                "manufacturer_or_brand": "Toyota",
+                "year_of_construction": "2020",
+                "birthdate": "1990-01-01",
+                "name": "John Doe",
+                "complete": True,
+            }
+        )
+        with TestClient(app) as test_client:
+            response = test_client.post(
+                "/chat", json=ChatRequest(session_id="", message="Hi").model_dump()
+            )
+
+        assert response.json()["complete"] is True
+        writer.submit.assert_awaited_once()
+        assert writer.submit.await_args.args[1] == "ABC123"
+        mock_save.assert_not_awaited()
+        writer.close.assert_awaited_once()
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import mongomock_motor
+import pytest
+from unittest.mock import AsyncMock, Mock
+from app.archive import compress_history
+from app.replay import RateLimiter, completing_turn, diff_fields, replay
+
+FORM = {
+    "car_type": "Sedan",
+    "licence_plate_number": "ABC-123",
+    "manufacturer_or_brand": "Toyota",
+    "year_of_construction": "2020",
+    "birthdate": "1990-01-01",
+    "name": "John Doe",
+}
+
+
+def session(session_id: str, plate: str, complete: bool = True) -> dict:
+    return {
+        "_id": session_id,
+        "status": "complete" if complete else "open",
+        "history": [
+            {"role": "user", "content": "Hi"},
+            {"role": "assistant", "content": json.dumps({"complete": False})},
+            {"role": "user", "content": f"My plate is {plate}"},
+            {
+                "role": "assistant",
+                "content": json.dumps(
+                    dict(FORM, licence_plate_number=plate, complete=True)
+                ),
+            },
+        ],
+    }
+
+
+@pytest.fixture
+async def database():
+    database = mongomock_motor.AsyncMongoMockClient()["chatbot"]
+    await database.records.insert_many(
+        [
+            {
+                "licence_plate": plate,
+                "licence_plate_normalized": plate.replace("-", ""),
+                "form_data": dict(
+                    FORM, licence_plate_number=plate, session_id=session_id
+                ),
+                "prompt_used": "old prompt",
+            }
+            for session_id, plate in (("s1", "ABC-123"), ("s2", "XYZ-9"))
+        ]
+    )
+    await database.sessions.insert_many(
+        [session("s1", "ABC-123"), session("open", "ABC-123", complete=False)]
+    )
+    archived = session("s2", "XYZ-9")
+    archived["history"] = compress_history(archived["history"])
+    await database.sessions_archive.insert_one(archived)
+    return database
+
+
+def test_completing_turn_stops_before_the_final_reply():
+    history, reply = completing_turn(session("s", "ABC-123")["history"])
+
+    assert [m.role for m in history] == ["user", "assistant", "user"]
+    assert reply["complete"] is True
+    assert completing_turn(session("s", "A")["history"][:2]) is None
+
+
+def test_diff_ignores_case_spacing_and_plate_format():
+    actual = dict(FORM, name="john  doe", licence_plate_number="abc 123")
+    assert diff_fields(FORM, actual) == {}
+
+    assert diff_fields(FORM, dict(FORM, car_type="Coupe")) == {
+        "car_type": {"expected": "Sedan", "actual": "Coupe"}
+    }
+
+
+async def test_replay_writes_a_row_per_session(database, tmp_path):
+    agent = AsyncMock()
+    agent.system_prompt = "new prompt"
+
+    async def respond(history):
+        plate = history[-1].content.split()[-1]
+        brand = "Toyota" if plate == "ABC-123" else "Honda"
+        return json.dumps(
+            dict(
+                FORM,
+                licence_plate_number=plate,
+                manufacturer_or_brand=brand,
+                complete=True,
+            )
+        )
+
+    agent.respond.side_effect = respond
+    output = tmp_path / "replay.jsonl"
+
+    summary = await replay(agent, database, output, concurrency=2)
+
+    rows = {row["session_id"]: row for row in map(json.loads, output.open())}
+    assert set(rows) == {"s1", "s2"}
+    assert rows["s1"]["status"] == "match"
+    assert rows["s1"]["prompt_changed"] is True
+    assert rows["s2"]["differences"] == {
+        "manufacturer_or_brand": {"expected": "Toyota", "actual": "Honda"}
+    }
+    assert summary["sessions"] == 2
+    assert summary["field_differences"] == {"manufacturer_or_brand": 1}
+
+
+async def test_replay_records_agent_errors(database, tmp_path):
+    agent = AsyncMock()
+    agent.system_prompt = "new prompt"
+    agent.respond.side_effect = RuntimeError("rate limited")
+    output = tmp_path / "replay.jsonl"
+
+    summary = await replay(agent, database, output, sources=("sessions",))
+
+    row = json.loads(output.read_text())
+    assert row["status"] == "error"
+    assert row["error"] == "rate limited"
+    assert summary["error"] == 1
+
+
+async def test_replay_matches_the_record_of_the_same_session(database, tmp_path):
+    agent = AsyncMock()
+    agent.system_prompt = "new prompt"
+    agent.respond.return_value = json.dumps(dict(FORM, complete=True))
+    # A later session completed for the same plate has no record of its own
+    await database.sessions.insert_one(session("s3", "ABC-123"))
+    output = tmp_path / "replay.jsonl"
+
+    await replay(agent, database, output, sources=("sessions",))
+
+    rows = {row["session_id"]: row for row in map(json.loads, output.open())}
+    assert rows["s1"]["status"] == "match"
+    assert rows["s3"] == {
+        "session_id": "s3",
+        "status": "skipped",
+        "reason": "no saved record",
+    }
+
+
+async def test_replay_goes_on_after_a_failing_session(database, tmp_path):
+    agent = AsyncMock()
+    agent.system_prompt = "new prompt"
+    agent.respond.return_value = json.dumps(dict(FORM, complete=True))
+    broken = session("broken", "ABC-123")
+    broken["history"][0] = {"role": "user"}
+    await database.sessions.insert_one(broken)
+    output = tmp_path / "replay.jsonl"
+
+    summary = await replay(agent, database, output, sources=("sessions",))
+
+    rows = {row["session_id"]: row for row in map(json.loads, output.open())}
+    assert rows["broken"]["status"] == "error"
+    assert rows["s1"]["status"] == "match"
+    assert summary["error"] == 1
+
+
+async def test_replay_stops_reading_when_a_worker_dies(database, tmp_path, monkeypatch):
+    await database.sessions.insert_many(
+        [session(f"more-{i}", "ABC-123") for i in range(10)]
+    )
+    agent = AsyncMock()
+    agent.system_prompt = "new prompt"
+    agent.respond.return_value = json.dumps(dict(FORM, complete=True))
+    monkeypatch.setattr("app.replay.json.dumps", Mock(side_effect=OSError("full")))
+
+    # The queue holds two sessions, so a stuck cursor loop would never return
+    with pytest.raises(ExceptionGroup):
+        await asyncio.wait_for(
+            replay(agent, database, tmp_path / "replay.jsonl", concurrency=1),
+            timeout=5,
+        )
+
+
+async def test_rate_limiter_spaces_calls(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(
+        "app.replay.asyncio.sleep", AsyncMock(side_effect=sleeps.append)
+    )
+    limiter = RateLimiter(rate=10)
+
+    for _ in range(3):
+        await limiter.wait()
+
+    assert len(sleeps) == 2
+    assert all(0 < s <= 0.2 for s in sleeps)
@@ -0,0 +1,164 @@
+import mongomock_motor
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, patch
+from app import db
+from app.models import Record
+from app.reports import RecordFilter, RecordReports
+
+START = datetime(2025, 1, 1, 9)
+
+
+def record(i: int, car_type: str, brand: str, created_at: datetime) -> dict:
+    return {
+        "licence_plate": f"P{i}",
+        "licence_plate_normalized": f"P{i}",
+        "form_data": {"car_type": car_type, "manufacturer_or_brand": brand},
+        # Written before prompts were versioned
+        "prompt_used": "prompt",
+        "created_at": created_at,
+        "updated_at": created_at,
+    }
+
+
+@pytest.fixture
+async def records():
+    collection = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    await collection.insert_many(
+        [
+            record(0, "Sedan", "Toyota", START),
+            # Same timestamp, so _id has to break the tie
+            record(1, "Sedan", "Honda", START),
+            record(2, "Coupe", "Toyota", START + timedelta(hours=1)),
+            record(3, "Sedan", "Toyota", START + timedelta(days=1)),
+            record(4, "Minivan", "Kia", START + timedelta(days=2)),
+        ]
+    )
+    return collection
+
+
+async def test_keyset_pages_cover_every_record_once(records):
+    reports = RecordReports(records)
+    seen, cursor = [], None
+    while True:
+        page, cursor = await reports.page(RecordFilter(), limit=2, cursor=cursor)
+        seen += [r["licence_plate"] for r in page]
+        if cursor is None:
+            break
+
+    assert seen == ["P4", "P3", "P2", "P1", "P0"]
+    assert "prompt_used" not in page[0]
+
+
+async def test_page_filters(records):
+    reports = RecordReports(records)
+    filters = RecordFilter(
+        start=START, end=START + timedelta(days=1, minutes=1), car_type="Sedan"
+    )
+
+    page, cursor = await reports.page(filters)
+
+    assert [r["licence_plate"] for r in page] == ["P3", "P1", "P0"]
+    assert cursor is None
+
+
+async def test_counts(records):
+    reports = RecordReports(records)
+
+    assert await reports.counts(RecordFilter(), "car_type") == [
+        {"car_type": "Sedan", "count": 3},
+        {"car_type": "Coupe", "count": 1},
+        {"car_type": "Minivan", "count": 1},
+    ]
+    assert await reports.counts(RecordFilter(brand="Toyota"), "day") == [
+        {"day": "2025-01-01", "count": 2},
+        {"day": "2025-01-02", "count": 1},
+    ]
+
+
+async def test_report_indexes():
+    records = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    await db.ensure_report_indexes(records)
+
+    indexes = await records.index_information()
+    assert indexes["created_at_id"]["key"] == [("created_at", -1), ("_id", -1)]
+    assert indexes["car_type_created_at_id"]["key"][0] == ("form_data.car_type", 1)
+    assert "manufacturer_or_brand_created_at_id" in indexes
+
+
+def test_unknown_read_preference():
+    records = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    with pytest.raises(ValueError):
+        RecordReports(records, read_preference="anywhere")
+
+
+def test_record_timestamps_are_set_per_record():
+    before = datetime.now()
+    saved = Record(
+        licence_plate="A",
+        licence_plate_normalized="A",
+        form_data={},
+        prompt_version="v",
+    )
+    assert saved.created_at >= before
+
+
+@pytest.fixture
+def mock_db(records):
+    with (
+        patch("app.db.sessions", new_callable=AsyncMock),
+        patch("app.db.records", records),
+    ):
+        yield
+
+
+@pytest.fixture
+def ops_client(mock_db, records, client, monkeypatch):
+    monkeypatch.setenv("OPS_TOKEN", "secret")
+    client.headers["X-Ops-Token"] = "secret"
+    with patch("app.app.record_reports", RecordReports(records)):
+        yield client
+
+
+def test_report_endpoints(ops_client):
+    client = ops_client
+    response = client.get("/reports/records", params={"car_type": "Sedan", "limit": 2})
+    assert response.status_code == 200
+    body = response.json()
+    assert [r["licence_plate"] for r in body["records"]] == ["P3", "P1"]
+    assert isinstance(body["records"][0]["_id"], str)
+
+    response = client.get(
+        "/reports/records",
+        params={"car_type": "Sedan", "limit": 2, "cursor": body["next_cursor"]},
+    )
+    assert [r["licence_plate"] for r in response.json()["records"]] == ["P0"]
+    assert response.json()["next_cursor"] is None
+
+    response = client.get("/reports/counts", params={"by": "brand"})
+    assert response.json()["counts"][0] == {"brand": "Toyota", "count": 3}
+
+    assert client.get("/reports/records", params={"cursor": "nope"}).status_code == 400
+    assert client.get("/reports/counts", params={"by": "plate"}).status_code == 422
+
+
+def test_reports_need_the_ops_token(ops_client, monkeypatch):
+    params = {"by": "brand"}
+    assert ops_client.get("/reports/counts", params=params).status_code == 200
+    del ops_client.headers["X-Ops-Token"]
+    for headers in ({}, {"X-Ops-Token": "wrong"}):
+        response = ops_client.get("/reports/records", headers=headers)
+        assert response.status_code == 401
+        response = ops_client.get("/reports/counts", params=params, headers=headers)
+        assert response.status_code == 401
+
+    # Nobody gets reports while no token is configured
+    monkeypatch.delenv("OPS_TOKEN")
+    response = ops_client.get("/reports/records", headers={"X-Ops-Token": ""})
+    assert response.status_code == 401
+
+
+def test_reporting_is_off_by_default(mock_db, client, monkeypatch):
+    monkeypatch.setenv("OPS_TOKEN", "secret")
+    headers = {"X-Ops-Token": "secret"}
+    assert client.get("/reports/records", headers=headers).status_code == 404
@@ -0,0 +1,125 @@
+import mongomock_motor
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock
+from pymongo.errors import PyMongoError
+from app.insurance_agent import InsuranceAgent
+from app.models import Message
+from app.response_cache import MemoryBackend, MongoBackend, ResponseCache
+
+BYPASS = [r"\d", r"(?i)\b(my name is|i am|i'm|call me|born)\b"]
+
+
+def hello(content="Hi"):
+    return [Message(role="user", content=content)]
+
+
+def test_key_normalizes_case_whitespace_and_punctuation():
+    cache = ResponseCache(MemoryBackend(10, 60), BYPASS)
+    key = cache.key("model", "prompt", hello("Hi"))
+
+    assert cache.key("model", "prompt", hello("  hi! ")) == key
+    assert cache.key("model", "prompt", hello("hi there")) != key
+    assert cache.key("other-model", "prompt", hello("Hi")) != key
+    assert cache.key("model", "new prompt", hello("Hi")) != key
+
+
+def test_personal_data_and_long_conversations_bypass_the_cache():
+    cache = ResponseCache(MemoryBackend(10, 60), BYPASS)
+
+    assert cache.cacheable(hello("I want a quote"))
+    assert not cache.cacheable(hello("My name is Ann"))
+    assert not cache.cacheable(hello("plate 567-78AA"))
+    assert not cache.cacheable(hello("hi") + [Message(role="assistant", content="{}")])
+
+
+async def test_memory_backend_hit_and_saved_latency():
+    cache = ResponseCache(MemoryBackend(10, 60), BYPASS)
+    compute = AsyncMock(return_value='{"next_question": "Your name?"}')
+
+    first = await cache.get_or_compute("model", "prompt", hello("Hi"), compute)
+    second = await cache.get_or_compute("model", "prompt", hello("hi."), compute)
+
+    assert first == second
+    compute.assert_awaited_once()
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
+    assert stats["saved_latency_seconds"] >= 0
+
+
+async def test_bypassed_turns_are_not_stored():
+    cache = ResponseCache(MemoryBackend(10, 60), BYPASS)
+    compute = AsyncMock(return_value="{}")
+
+    await cache.get_or_compute("model", "prompt", hello("I'm Ann"), compute)
+    await cache.get_or_compute("model", "prompt", hello("I'm Ann"), compute)
+
+    assert compute.await_count == 2
+    assert cache.stats()["bypassed"] == 2
+    assert cache.stats()["misses"] == 0
+
+
+async def test_empty_responses_are_not_cached():
+    cache = ResponseCache(MemoryBackend(10, 60), BYPASS)
+    compute = AsyncMock(return_value="")
+
+    await cache.get_or_compute("model", "prompt", hello(), compute)
+    await cache.get_or_compute("model", "prompt", hello(), compute)
+
+    assert compute.await_count == 2
+
+
+async def test_mongo_backend_shares_entries_and_expires_them():
+    collection = mongomock_motor.AsyncMongoMockClient()["chatbot"]["llm_responses"]
+    backend = MongoBackend(collection, ttl_seconds=60)
+    await backend.ensure_indexes()
+    compute = AsyncMock(return_value="{}")
+
+    await ResponseCache(backend, BYPASS).get_or_compute(
+        "model", "prompt", hello(), compute
+    )
+    other_worker = ResponseCache(MongoBackend(collection, 60), BYPASS)
+    await other_worker.get_or_compute("model", "prompt", hello(), compute)
+    assert other_worker.stats()["hits"] == 1
+
+    await collection.update_many(
+        {}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+    await other_worker.get_or_compute("model", "prompt", hello(), compute)
+    assert compute.await_count == 2
+
+
+async def test_backend_errors_fall_back_to_the_model():
+    backend = AsyncMock()
+    backend.get.side_effect = PyMongoError("down")
+    backend.set.side_effect = PyMongoError("down")
+    cache = ResponseCache(backend, BYPASS)
+
+    result = await cache.get_or_compute(
+        "model", "prompt", hello(), AsyncMock(return_value="{}")
+    )
+
+    assert result == "{}"
+    assert cache.stats()["errors"] == 2
+
+
+async def test_agent_uses_the_cache_when_configured():
+    completion = AsyncMock()
+    completion.return_value.choices[0].message.content = '{"next_question": "Name?"}'
+    agent = InsuranceAgent(completion=completion)
+    agent.response_cache = ResponseCache(MemoryBackend(10, 60), BYPASS)
+
+    await agent.respond(hello())
+    assert await agent.respond(hello("HI")) == '{"next_question": "Name?"}'
+
+    completion.assert_awaited_once()
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_size=1, ttl_seconds=60)
+    backend.cache.put("a", {"response": "1", "latency": 0})
+    backend.cache.put("b", {"response": "2", "latency": 0})
+
+    assert backend.cache.get("a") is None
+    assert backend.cache.get("b") == {"response": "2", "latency": 0}
@@ -0,0 +1,129 @@
+import json
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+from app.insurance_agent import InsuranceAgent
+from app.llm_router import LLMRouter, ModelRoute
+from app.models import Message
+from app.response_parser import ResponseParser, load_object
+from app.service_exceptions import InvalidAgentResponse, MalformedAgentResponse
+
+FORM = {
+    "car_type": "Sedan",
+    "licence_plate_number": "ABC123",
+    "manufacturer_or_brand": "Toyota",
+    "year_of_construction": "2020",
+    "birthdate": "1990-01-01",
+    "name": "John Doe",
+    "complete": True,
+}
+HISTORY = [Message(role="user", content="It's a Toyota")]
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ('{"name": "Ann"}', {"name": "Ann"}),
+        ('```json\n{"name": "Ann"}\n```', {"name": "Ann"}),
+        ('Sure! {"name": "Ann"} Anything else?', {"name": "Ann"}),
+        # Cut off mid-value: the unfinished field is dropped
+        ('{"name": "Ann", "car_type": "Sed', {"name": "Ann"}),
+        ('{"name": "Ann", "complete": false', {"name": "Ann", "complete": False}),
+    ],
+)
+def test_load_object(raw, expected):
+    data, _ = load_object(raw)
+    assert data == expected
+
+
+def test_load_object_without_an_object():
+    assert load_object("I can't help with that") == (None, True)
+    assert load_object("[1, 2]") == (None, True)
+
+
+async def test_clean_reply_is_kept_as_is():
+    parser = ResponseParser()
+    raw = json.dumps(FORM)
+
+    parsed = await parser.parse(raw, HISTORY)
+
+    assert parsed.data == FORM
+    assert parsed.content == raw
+    assert parser.stats()["repaired"] == 0
+
+
+async def test_repaired_reply_is_reserialized():
+    parser = ResponseParser()
+
+    parsed = await parser.parse(f"```json\n{json.dumps(FORM)}\n```", HISTORY)
+
+    assert json.loads(parsed.content) == FORM
+    assert parser.stats()["repaired"] == 1
+
+
+async def test_malformed_reply():
+    parser = ResponseParser(reprompt=AsyncMock())
+
+    with pytest.raises(MalformedAgentResponse):
+        await parser.parse("not json", HISTORY)
+    parser.reprompt.assert_not_awaited()
+    assert parser.stats()["malformed"] == 1
+
+
+async def test_incomplete_form_reprompts_only_missing_fields():
+    reprompt = AsyncMock(return_value='{"car_type": "Coupe", "name": "Ann"}')
+    parser = ResponseParser(reprompt=reprompt)
+    # car_type isn't one of the allowed values, name was never sent
+    reply = dict(FORM, car_type="Truck")
+    del reply["name"]
+
+    parsed = await parser.parse(json.dumps(reply), HISTORY)
+
+    assert reprompt.await_args.args[2] == ["car_type", "name"]
+    assert parsed.data == dict(FORM, car_type="Coupe", name="Ann")
+    assert parsed.reprompted == ["car_type", "name"]
+    stats = parser.stats()
+    assert stats["reprompt_fixed"] == 1
+    assert stats["repair_rate"] == 1.0
+
+
+async def test_failed_reprompt_is_invalid():
+    parser = ResponseParser(reprompt=AsyncMock(side_effect=RuntimeError("down")))
+
+    with pytest.raises(InvalidAgentResponse):
+        await parser.parse(json.dumps(dict(FORM, name="")), HISTORY)
+    assert parser.stats()["invalid"] == 1
+
+
+async def test_require_without_reprompt():
+    parser = ResponseParser()
+    parsed = await parser.parse('{"complete": false}', HISTORY)
+
+    with pytest.raises(InvalidAgentResponse):
+        await parser.require(parsed, ["next_question"], HISTORY)
+
+
+async def test_agent_follow_up_is_short():
+    captured = AsyncMock(
+        return_value=SimpleNamespace(
+            choices=[
+                SimpleNamespace(message=SimpleNamespace(content='{"name": "Ann"}'))
+            ]
+        )
+    )
+    agent = InsuranceAgent(completion=captured)
+    agent.router = LLMRouter([ModelRoute("a")])
+    history = [
+        Message(role="user", content="Hi"),
+        Message(role="assistant", content=json.dumps({"car_type": "Sedan"})),
+        Message(role="user", content="I'm Ann"),
+    ]
+
+    raw = await agent.complete_fields(history, {"birthdate": "1990-01-01"}, ["name"])
+
+    assert json.loads(raw) == {"name": "Ann"}
+    messages = captured.await_args.kwargs["messages"]
+    assert len(messages) == 2
+    assert '"car_type":"Sedan"' in messages[0]["content"]
+    assert '"birthdate":"1990-01-01"' in messages[0]["content"]
+    assert messages[1] == {"role": "user", "content": "I'm Ann"}
@@ -1,15 +1,22 @@
 from datetime import datetime
 from app.sessions import (
     get_or_create_session,
-    update_session,
+    append_session_messages,
     detect_duplicate,
     save_record,
+    normalize_plate,
+    backfill_normalized_plates,
+    backfill_session_status,
+    SessionHistory,
 )
+from app import db
 import pytest
 from app.models import Message
 import mongomock_motor
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from pymongo.errors import PyMongoError
+from pydantic import ValidationError
+from app.service_exceptions import SessionConflict
 
 
 async def test_mock_client():
@@ -55,22 +62,71 @@ async def test_get_or_create_session_existing():
     assert isinstance(history, list)
 
 
-async def test_update_session():
+async def test_append_session_messages():
     sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
-    session_id, _ = await get_or_create_session(sessions)
-    messages = [
-        Message(role="user", content="Hello"),
-        Message(role="assistant", content="Hi there"),
-    ]
+    session_id, history = await get_or_create_session(sessions)
+    assert history.turn == 0
+
+    turn = await append_session_messages(
+        sessions,
+        session_id,
+        [
+            Message(role="user", content="Hello"),
+            Message(role="assistant", content="Hi there"),
+        ],
+        turn=history.turn,
+    )
+    assert turn == 1
+    turn = await append_session_messages(
+        sessions, session_id, [Message(role="user", content="Again")], turn=turn
+    )
+    assert turn == 2
+
+    _, history = await get_or_create_session(sessions, session_id)
+    assert [h.content for h in history] == ["Hello", "Hi there", "Again"]
+    assert history.turn == 2
+    session = await sessions.find_one({"_id": session_id})
+    assert isinstance(session["updated_at"], datetime)
 
-    await update_session(sessions, session_id, messages)
+
+async def test_append_session_messages_stale_turn():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
+    session_id, _ = await get_or_create_session(sessions)
+    await append_session_messages(
+        sessions, session_id, [Message(role="user", content="Hello")], turn=0
+    )
+
+    # A retried or concurrent write for the same turn must not be applied twice
+    with pytest.raises(SessionConflict):
+        await append_session_messages(
+            sessions, session_id, [Message(role="user", content="Hello")], turn=0
+        )
 
     session = await sessions.find_one({"_id": session_id})
-    assert session is not None
-    assert len(session["history"]) == 2
-    assert session["history"][0]["role"] == "user"
-    assert session["history"][0]["content"] == "Hello"
-    assert isinstance(session["updated_at"], datetime)
+    assert len(session["history"]) == 1
+
+
+async def test_append_session_messages_legacy_session():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
+    await sessions.insert_one(
+        {
+            "_id": "legacy",
+            "history": [{"role": "user", "content": "Hello"}],
+            "created_at": datetime.now(),
+        }
+    )
+    _, history = await get_or_create_session(sessions, "legacy")
+    assert history.turn == 0
+
+    await append_session_messages(
+        sessions,
+        "legacy",
+        [Message(role="assistant", content="Hi there")],
+        turn=history.turn,
+    )
+    _, history = await get_or_create_session(sessions, "legacy")
+    assert [h.content for h in history] == ["Hello", "Hi there"]
+    assert history.turn == 1
 
 
 async def test_detect_duplicate_true():
@@ -82,7 +138,7 @@ async def test_detect_duplicate_true():
             "key": "value",
             "another_key": True,
         },
-        "prompt_used": "test prompt",
+        "prompt_version": "0123abcd",
         "created_at": datetime.now(),
         "updated_at": datetime.now(),
     }
@@ -111,15 +167,97 @@ async def test_save_record():
         "name": "John Doe",
         "is_valid": True,
     }
-    prompt = "test prompt"
-
-    await save_record(records, licence_plate, data, prompt)
+    assert await save_record(records, licence_plate, data, "0123abcd") is True
 
     record = await records.find_one({"licence_plate": licence_plate})
     assert record is not None
     assert record["licence_plate"] == licence_plate
+    assert record["licence_plate_normalized"] == "XYZ789"
     assert record["form_data"] == data
-    assert record["prompt_used"] == prompt
+    assert record["prompt_version"] == "0123abcd"
+
+
+def test_normalize_plate():
+    assert normalize_plate("567-78AA") == "56778AA"
+    assert normalize_plate(" 56778aa ") == "56778AA"
+
+
+async def test_save_record_normalized_plate_conflict():
+    records = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    with patch("app.db.records", records):
+        await db.ensure_indexes()
+
+    assert await save_record(records, "567-78AA", {"name": "A"}, "prompt") is True
+    assert await save_record(records, "56778aa", {"name": "B"}, "prompt") is False
+    assert await records.count_documents({}) == 1
+    assert await detect_duplicate(records, "567 78 aa") is True
+
+
+async def test_backfill_normalized_plates():
+    records = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    with patch("app.db.records", records):
+        await db.ensure_indexes()
+    # Saved before plates were normalized
+    await records.insert_many(
+        [
+            {"licence_plate": "567-78AA"},
+            {"licence_plate": "56778aa"},
+            {"licence_plate": "AB 12"},
+            {"licence_plate": ""},
+        ]
+    )
+    assert await detect_duplicate(records, "56778 AA") is False
+
+    counts = await backfill_normalized_plates(records, batch_size=2)
+
+    assert counts == {"backfilled": 2, "duplicates": 1, "skipped": 1}
+    assert await detect_duplicate(records, "56778 AA") is True
+    assert await save_record(records, "56778aa", {"name": "B"}, "prompt") is False
+    assert await records.count_documents({}) == 4
+    # Nothing left that can be backfilled
+    assert await backfill_normalized_plates(records) == {
+        "backfilled": 0,
+        "duplicates": 1,
+        "skipped": 1,
+    }
+
+
+async def test_backfill_session_status():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"]["sessions"]
+    completed = '{"name": "A", "complete": true}'
+    # Saved before sessions had a status
+    await sessions.insert_many(
+        [
+            {"history": [{"role": "assistant", "content": completed}]},
+            {
+                "history": [
+                    {"role": "assistant", "content": completed},
+                    {"role": "assistant", "content": "There is already a record"},
+                ]
+            },
+            {"history": [{"role": "assistant", "content": '{"complete": false}'}]},
+            {"history": [{"role": "user", "content": "Hi"}]},
+            {"history": [], "status": "complete"},
+        ]
+    )
+
+    counts = await backfill_session_status(sessions, batch_size=2)
+
+    assert counts == {"open": 3, "complete": 1}
+    assert await sessions.count_documents({"status": "complete"}) == 2
+    assert await sessions.count_documents({"status": "open"}) == 3
+    assert await backfill_session_status(sessions) == {"open": 0, "complete": 0}
+
+
+async def test_ensure_indexes():
+    records = mongomock_motor.AsyncMongoMockClient()["chatbot"]["records"]
+    with patch("app.db.records", records):
+        await db.ensure_indexes()
+        await db.ensure_indexes()
+
+    indexes = await records.index_information()
+    assert indexes["licence_plate_normalized_unique"]["unique"] is True
+    assert "licence_plate" in indexes
 
 
 async def test_get_or_create_session_find_one_error():
@@ -137,12 +275,12 @@ async def test_get_or_create_session_insert_one_error():
         await get_or_create_session(mock_sessions, None)
 
 
-async def test_update_session_update_one_error():
+async def test_append_session_messages_update_one_error():
     mock_sessions = MagicMock()
     mock_sessions.update_one.side_effect = PyMongoError("update_one failed")
     with pytest.raises(PyMongoError):
-        await update_session(
-            mock_sessions, "session_id", [Message(role="user", content="test")]
+        await append_session_messages(
+            mock_sessions, "session_id", [Message(role="user", content="test")], 0
         )
 
 
@@ -158,3 +296,20 @@ async def test_save_record_insert_one_error():
     mock_records.insert_one.side_effect = PyMongoError("insert_one ")
     with pytest.raises(PyMongoError):
         await save_record(mock_records, "PLATE123", {"key": "value"}, "prompt")
+
+
+def test_session_history_reuses_stored_documents():
+    stored = [{"role": "user", "content": "Hello"}]
+    history = SessionHistory.load(stored, turn=3)
+    history.append(Message(role="assistant", content="Hi"))
+
+    documents = history.documents()
+    assert documents[0] is stored[0]
+    assert documents[1] == {"role": "assistant", "content": "Hi"}
+    assert history.documents() is documents
+    assert history.turn == 3
+
+
+def test_session_history_validates_on_load():
+    with pytest.raises(ValidationError):
+        SessionHistory.load([{"role": "user"}])
@@ -0,0 +1,67 @@
+import subprocess
+import sys
+import time
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+from app import insurance_agent
+
+
+def test_app_import_does_not_load_litellm():
+    code = "import sys, app.app; print('litellm' in sys.modules)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert output.stdout.strip() == "False"
+
+
+async def test_default_completion_loads_litellm_on_first_call():
+    litellm = SimpleNamespace(acompletion=AsyncMock(return_value="reply"))
+    with patch("app.insurance_agent.load_litellm", return_value=litellm):
+        assert await insurance_agent.acompletion(model="m", messages=[]) == "reply"
+    litellm.acompletion.assert_awaited_once_with(model="m", messages=[])
+
+
+async def test_warm_up_skips_injected_completion():
+    agent = insurance_agent.InsuranceAgent(completion=AsyncMock())
+    with patch("app.insurance_agent.load_litellm") as load:
+        await agent.warm_up()
+    load.assert_not_called()
+
+
+def wait_for_ready(client, attempts: int = 50):
+    for _ in range(attempts):
+        response = client.get("/ready")
+        if response.status_code == 200:
+            break
+        time.sleep(0.01)
+    return response
+
+
+@pytest.fixture
+def agent():
+    agent = MagicMock()
+    agent.warm_up = AsyncMock()
+    with (
+        patch("app.db.sessions", new_callable=AsyncMock),
+        patch("app.db.records", new_callable=AsyncMock),
+        patch("app.app.insurance_agent", agent),
+    ):
+        yield agent
+
+
+def test_ready_after_warm_up(agent, client):
+    with patch("app.db.warm_up", AsyncMock(return_value=True)):
+        response = wait_for_ready(client)
+
+    assert response.status_code == 200
+    assert response.json() == {"ready": True, "database": True, "agent": True}
+    agent.warm_up.assert_awaited_once()
+
+
+def test_not_ready_without_database(agent, client):
+    with patch("app.db.warm_up", AsyncMock(return_value=False)):
+        response = wait_for_ready(client, attempts=3)
+
+    assert response.status_code == 503
+    assert response.json()["database"] is False
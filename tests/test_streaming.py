@@ -0,0 +1,150 @@
+import json
+import pytest
+from types import SimpleNamespace
+from unittest.mock import patch
+from app.insurance_agent import InsuranceAgent
+from app.models import Message
+from app.service_exceptions import AgentNotAvailable
+from app.streaming import NextQuestionExtractor
+
+CAR_INFO = {
+    "reasoning": "Need the car type",
+    "next_question": 'Which "type" of car do you drive?',
+    "car_type": "Sedan",
+    "licence_plate_number": "",
+    "manufacturer_or_brand": "",
+    "year_of_construction": "",
+    "complete": False,
+    "birthdate": "",
+    "name": "",
+}
+
+
+def chunked(text: str, size: int):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+def fake_streaming_completion(payload: dict, chunk_size: int = 3, fail_after=None):
+    calls = []
+
+    async def completion(model, messages, stream=False, **kwargs):
+        calls.append({"model": model, "messages": messages, "stream": stream})
+
+        async def chunks():
+            for i, piece in enumerate(chunked(json.dumps(payload), chunk_size)):
+                if fail_after is not None and i == fail_after:
+                    raise RuntimeError("connection reset")
+                yield SimpleNamespace(
+                    choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))]
+                )
+
+        return chunks()
+
+    completion.calls = calls
+    return completion
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1000])
+def test_extractor_emits_next_question_incrementally(chunk_size):
+    extractor = NextQuestionExtractor()
+    emitted = [extractor.feed(c) for c in chunked(json.dumps(CAR_INFO), chunk_size)]
+
+    assert "".join(emitted) == CAR_INFO["next_question"]
+    assert extractor.field_complete
+    assert json.loads(extractor.text) == CAR_INFO
+    if chunk_size < 10:
+        assert len([e for e in emitted if e]) > 1
+
+
+def test_extractor_without_field():
+    extractor = NextQuestionExtractor()
+    assert extractor.feed('{"complete": true}') == ""
+    assert extractor.emitted == ""
+
+
+async def test_agent_respond_stream():
+    completion = fake_streaming_completion(CAR_INFO)
+    agent = InsuranceAgent(completion=completion)
+    deltas = await agent.respond_stream([Message(role="user", content="hi")])
+
+    text = "".join([d async for d in deltas])
+    assert json.loads(text) == CAR_INFO
+    assert completion.calls[0]["stream"] is True
+    assert completion.calls[0]["messages"][0]["role"] == "system"
+
+
+async def test_agent_respond_stream_error_mid_stream():
+    agent = InsuranceAgent(completion=fake_streaming_completion(CAR_INFO, fail_after=2))
+    deltas = await agent.respond_stream([Message(role="user", content="hi")])
+    with pytest.raises(AgentNotAvailable):
+        [d async for d in deltas]
+
+
+def read_events(client, body):
+    with client.stream("POST", "/chat/stream", json=body) as response:
+        assert response.status_code == 200
+        return [json.loads(line) for line in response.iter_lines() if line]
+
+
+def test_chat_stream(mock_db, client):
+    agent = InsuranceAgent(completion=fake_streaming_completion(CAR_INFO))
+    with patch("app.app.insurance_agent", agent):
+        events = read_events(client, {"session_id": None, "message": "hello"})
+
+    assert events[0]["event"] == "session"
+    deltas = [e["text"] for e in events if e["event"] == "delta"]
+    assert "".join(deltas) == CAR_INFO["next_question"]
+    assert events[-1] == {
+        "event": "done",
+        "session_id": events[0]["session_id"],
+        "agent_response": CAR_INFO["next_question"],
+        "complete": False,
+    }
+
+
+async def test_chat_stream_saves_complete_record(mock_db, async_client):
+    completed = dict(
+        CAR_INFO,
+        licence_plate_number="ABC123",
+        manufacturer_or_brand="Toyota",
+        year_of_construction="2020",
+        birthdate="1990-01-01",
+        name="John Doe",
+        complete=True,
+    )
+    agent = InsuranceAgent(completion=fake_streaming_completion(completed))
+    with patch("app.app.insurance_agent", agent):
+        async with async_client.stream(
+            "POST", "/chat/stream", json={"session_id": None, "message": "hello"}
+        ) as response:
+            events = [json.loads(line) async for line in response.aiter_lines()]
+
+    assert events[-1]["event"] == "done"
+    assert events[-1]["complete"] is True
+    assert await mock_db.records.count_documents({"licence_plate": "ABC123"}) == 1
+    session = await mock_db.sessions.find_one({"_id": events[0]["session_id"]})
+    assert [h["role"] for h in session["history"]] == ["user", "assistant"]
+
+
+def test_chat_stream_error_event(mock_db, client):
+    agent = InsuranceAgent(completion=fake_streaming_completion(CAR_INFO, fail_after=5))
+    with patch("app.app.insurance_agent", agent):
+        events = read_events(client, {"session_id": None, "message": "hello"})
+
+    assert events[-1] == {
+        "event": "error",
+        "status": 503,
+        "detail": "AI Agent is temporarily unavailable",
+    }
+
+
+def test_chat_stream_unavailable_before_first_token(mock_db, client):
+    async def failing_completion(*args, **kwargs):
+        raise RuntimeError("provider down")
+
+    agent = InsuranceAgent(completion=failing_completion)
+    with patch("app.app.insurance_agent", agent):
+        response = client.post(
+            "/chat/stream", json={"session_id": None, "message": "hello"}
+        )
+    assert response.status_code == 503
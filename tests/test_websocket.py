@@ -0,0 +1,214 @@
+import asyncio
+import json
+import pytest
+import mongomock_motor
+from types import SimpleNamespace
+from unittest.mock import patch
+from app import app as app_module
+from app.insurance_agent import InsuranceAgent
+from app.models import Message
+from app.service_exceptions import SessionConflict
+from app.session_writer import SessionWriter
+
+CAR_INFO = {
+    "reasoning": "Need the car type",
+    "next_question": "Which type of car do you drive?",
+    "car_type": "Sedan",
+    "licence_plate_number": "",
+    "manufacturer_or_brand": "",
+    "year_of_construction": "",
+    "complete": False,
+    "birthdate": "",
+    "name": "",
+}
+
+
+def streaming_completion(payload: dict, failures: int = 0):
+    calls = []
+
+    async def completion(model, messages, stream=False, **kwargs):
+        calls.append(messages)
+        if len(calls) <= failures:
+            raise RuntimeError("provider down")
+
+        async def chunks():
+            text = json.dumps(payload)
+            for i in range(0, len(text), 5):
+                yield SimpleNamespace(
+                    choices=[
+                        SimpleNamespace(delta=SimpleNamespace(content=text[i : i + 5]))
+                    ]
+                )
+
+        return chunks()
+
+    completion.calls = calls
+    return completion
+
+
+def conversation(messages):
+    return [m["content"] for m in messages if m["role"] != "system"]
+
+
+def read_turn(websocket):
+    events = []
+    while not events or events[-1]["event"] not in ("done", "error"):
+        events.append(websocket.receive_json())
+    return events
+
+
+def test_turns_share_one_session_load(mock_db, client):
+    agent = InsuranceAgent(completion=streaming_completion(CAR_INFO))
+    loads = []
+    load_session = app_module.load_session
+
+    async def counting_load(session_id):
+        loads.append(session_id)
+        return await load_session(session_id)
+
+    with (
+        patch("app.app.insurance_agent", agent),
+        patch("app.app.load_session", counting_load),
+    ):
+        with client.websocket_connect("/chat/ws") as websocket:
+            session_id = websocket.receive_json()["session_id"]
+            websocket.send_json({"message": "hello"})
+            first = read_turn(websocket)
+            websocket.send_json({"message": "a sedan"})
+            second = read_turn(websocket)
+
+    assert loads == [None]
+    deltas = [e["text"] for e in first if e["event"] == "delta"]
+    assert "".join(deltas) == CAR_INFO["next_question"]
+    assert second[-1] == {
+        "event": "done",
+        "session_id": session_id,
+        "agent_response": CAR_INFO["next_question"],
+        "complete": False,
+    }
+    # The second model call saw the first turn from memory
+    assert conversation(agent.completion.calls[1])[:2] == [
+        "hello",
+        json.dumps(CAR_INFO),
+    ]
+    # Written behind, and flushed when the connection closed
+    session = asyncio.run(mock_db.sessions.find_one({"_id": session_id}))
+    assert session["turn"] == 2
+    assert [h["content"] for h in session["history"] if h["role"] == "user"] == [
+        "hello",
+        "a sedan",
+    ]
+
+
+def test_resumes_session_from_query(mock_db, client):
+    agent = InsuranceAgent(completion=streaming_completion(CAR_INFO))
+    with patch("app.app.insurance_agent", agent):
+        with client.websocket_connect("/chat/ws") as websocket:
+            session_id = websocket.receive_json()["session_id"]
+            websocket.send_json({"message": "hello"})
+            read_turn(websocket)
+        with client.websocket_connect(f"/chat/ws?session_id={session_id}") as websocket:
+            assert websocket.receive_json()["session_id"] == session_id
+            websocket.send_json({"message": "a sedan"})
+            assert read_turn(websocket)[-1]["event"] == "done"
+
+    session = asyncio.run(mock_db.sessions.find_one({"_id": session_id}))
+    assert session["turn"] == 2
+    assert len(session["history"]) == 4
+
+
+def test_invalid_message_keeps_connection(mock_db, client):
+    agent = InsuranceAgent(completion=streaming_completion(CAR_INFO))
+    with patch("app.app.insurance_agent", agent):
+        with client.websocket_connect("/chat/ws") as websocket:
+            websocket.receive_json()
+            websocket.send_text("hello")
+            error = websocket.receive_json()
+            websocket.send_json({"message": "hello"})
+            events = read_turn(websocket)
+
+    assert error["event"] == "error"
+    assert error["status"] == 422
+    assert events[-1]["event"] == "done"
+
+
+def test_failed_turn_is_not_kept(mock_db, client):
+    agent = InsuranceAgent(completion=streaming_completion(CAR_INFO, failures=1))
+    with patch("app.app.insurance_agent", agent):
+        with client.websocket_connect("/chat/ws") as websocket:
+            session_id = websocket.receive_json()["session_id"]
+            websocket.send_json({"message": "lost"})
+            failed = read_turn(websocket)
+            websocket.send_json({"message": "hello"})
+            events = read_turn(websocket)
+
+    assert failed[-1] == {
+        "event": "error",
+        "status": 503,
+        "detail": "AI Agent is temporarily unavailable",
+    }
+    assert events[-1]["event"] == "done"
+    # The failed turn's message is neither written nor sent to the model again
+    assert conversation(agent.completion.calls[1]) == ["hello"]
+    session = asyncio.run(mock_db.sessions.find_one({"_id": session_id}))
+    assert [h["role"] for h in session["history"]] == ["user", "assistant"]
+
+
+async def new_session(sessions, turn=0):
+    await sessions.insert_one({"_id": "s1", "history": [], "turn": turn})
+
+
+def messages(n):
+    return [
+        Message(role="user", content=f"m{n}"),
+        Message(role="assistant", content="ok"),
+    ]
+
+
+async def test_writer_combines_queued_appends():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"].sessions
+    await new_session(sessions)
+    writer = SessionWriter(sessions, "s1", turn=0)
+    writer.start()
+    for n in range(3):
+        assert (
+            await writer.append(messages(n), form_updates={"name": {"value": n}})
+            == n + 1
+        )
+    await writer.close()
+
+    session = await sessions.find_one({"_id": "s1"})
+    assert writer.writes == 1
+    assert session["turn"] == 3
+    assert [h["content"] for h in session["history"]][::2] == ["m0", "m1", "m2"]
+    assert session["form_state"] == {"name": {"value": 2}}
+
+
+async def test_writer_holds_appends_back_when_full():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"].sessions
+    await new_session(sessions)
+    writer = SessionWriter(sessions, "s1", turn=0, max_pending=1)
+    await writer.append(messages(0))
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(writer.append(messages(1)), 0.05)
+    writer.start()
+    await writer.append(messages(1))
+    await writer.close()
+
+    assert (await sessions.find_one({"_id": "s1"}))["turn"] == 2
+
+
+async def test_writer_stops_after_conflict():
+    sessions = mongomock_motor.AsyncMongoMockClient()["chatbot"].sessions
+    await new_session(sessions, turn=4)
+    writer = SessionWriter(sessions, "s1", turn=3)
+    writer.start()
+    await writer.append(messages(0))
+    with pytest.raises(SessionConflict):
+        await writer.flush()
+    with pytest.raises(SessionConflict):
+        await writer.append(messages(1))
+    with pytest.raises(SessionConflict):
+        await writer.close()
+
+    assert (await sessions.find_one({"_id": "s1"}))["history"] == []